@@ -0,0 +1,88 @@
+"""
+Ventral root sweep concatenation: np.append (old transform_ventral_root_recording) vs. the preallocated two pass fill,
+on a synthetic sweep of 60 recording files x 60 s at 10 kHz
+
+The text files are generated once (about 1.5 GB) and reused by later runs.
+
+Usage (from the repo directory):
+    python -m benchmarks.bench_vr_concatenation [sweep_dir] [n_files] [secs_per_file]
+"""
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+import pandas as pd
+from roibaview.ventral_root import convert_time_stamps_to_secs, transform_ventral_root_recording
+
+FR = 10000
+
+
+def secs_to_time_stamps(secs):
+    # secs --> hhmmss.ms (163417.4532)
+    hours = secs // 3600
+    minutes = (secs - hours * 3600) // 60
+    return hours * 10000 + minutes * 100 + (secs - hours * 3600 - minutes * 60)
+
+
+def make_synthetic_sweep(sweep_dir, n_files=60, secs_per_file=60, gap_secs=0.5, seed=0):
+    # Same format as the recording text files: voltage, two other columns, time stamp (tab separated, no header)
+    os.makedirs(sweep_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    n_samples = int(secs_per_file * FR)
+    t_start = 10 * 3600
+    for k in range(n_files):
+        f_name = f'{sweep_dir}/recording_{k:03d}.txt'
+        if not os.path.exists(f_name):
+            data = pd.DataFrame({
+                0: rng.normal(0, 0.1, n_samples),
+                1: np.zeros(n_samples, dtype=int),
+                2: np.zeros(n_samples, dtype=int),
+                3: secs_to_time_stamps(t_start + np.arange(n_samples) / FR),
+            })
+            data.to_csv(f_name, sep='\t', header=False, index=False, float_format='%.4f')
+        t_start += secs_per_file + gap_secs
+    return [f'{sweep_dir}/{f}' for f in sorted(os.listdir(sweep_dir))]
+
+
+def legacy_transform(vr_files, vr_fr):
+    # Old transform_ventral_root_recording: every file is appended to the result (the result is copied every time)
+    vr_files = list(np.sort(vr_files))
+    dummy_01 = pd.read_csv(vr_files[0], sep='\t', header=None)
+    vr_values = dummy_01.iloc[:, 0].to_numpy()
+    t_last = convert_time_stamps_to_secs(dummy_01.iloc[-1, 3], method=0)
+    for f_name in vr_files[1:]:
+        dummy = pd.read_csv(f_name, sep='\t', header=None)
+        t_rel_distance = convert_time_stamps_to_secs(dummy.iloc[0, 3], method=0) - t_last
+        n_zeros = np.zeros(int(vr_fr * t_rel_distance))
+        values = dummy.iloc[:, 0].to_numpy()
+        vr_values = np.append(vr_values, n_zeros)
+        vr_values = np.append(vr_values, values)
+        t_last = convert_time_stamps_to_secs(dummy.iloc[-1, 3], method=0)
+    return vr_values
+
+
+def main(sweep_dir=None, n_files=60, secs_per_file=60):
+    sweep_dir = sweep_dir or f'{tempfile.gettempdir()}/roibaview_vr_benchmark'
+    t0 = time.perf_counter()
+    vr_files = make_synthetic_sweep(sweep_dir, n_files, secs_per_file)
+    size_mb = sum(os.path.getsize(f) for f in vr_files) / 2**20
+    print(f'{len(vr_files)} files ({size_mb:.0f} MB) ready after {time.perf_counter() - t0:.1f} s: {sweep_dir}')
+
+    t0 = time.perf_counter()
+    legacy_values = legacy_transform(vr_files, FR)
+    t_legacy = time.perf_counter() - t0
+    print(f'        np.append: {t_legacy:.2f} s, {legacy_values.shape[0]} samples')
+
+    t0 = time.perf_counter()
+    vr_trace = transform_ventral_root_recording(vr_files, FR)
+    t_fill = time.perf_counter() - t0
+    print(f'preallocated fill: {t_fill:.2f} s, {vr_trace.shape[0]} samples')
+
+    n = min(legacy_values.shape[0], vr_trace.shape[0])
+    print(f'speed up: {t_legacy / t_fill:.1f}x, same values: {np.allclose(legacy_values[:n], vr_trace["Volt"][:n])}')
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    main(args[0] if len(args) > 0 else None, *[int(a) for a in args[1:3]])
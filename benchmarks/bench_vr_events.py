@@ -0,0 +1,75 @@
+"""
+Ventral root event pairing and merging: per event loop (old VentralRootDetection.find_vr_events) vs. the vectorized
+peak_tables helpers, on a synthetic binary trace of 1 hour at 10 kHz
+
+Usage (from the repo directory):
+    python -m benchmarks.bench_vr_events
+"""
+import time
+import numpy as np
+from roibaview.peak_tables import find_vr_event_edges, merge_vr_events
+
+FR = 10000
+DURATION_SECS = 3600
+DURATION_TH_SECS = 5
+MINIMAL_EVENT_DISTANCE = 4
+
+
+def synthetic_binary(n_events=5000, seed=0):
+    # Random events of 1 ms to 1 s (some overlap, so there are also a few long ones)
+    rng = np.random.default_rng(seed)
+    binary = np.zeros(FR * DURATION_SECS, dtype=np.int8)
+    onsets = np.sort(rng.integers(1, binary.shape[0] - 2 * FR, n_events))
+    durations = rng.integers(10, FR, n_events)
+    for onset, duration in zip(onsets, durations):
+        binary[onset:onset + duration] = 1
+    return binary
+
+
+def legacy_merge(binary, time_axis):
+    onsets_offsets = np.diff(binary, append=0)
+    onset_times = time_axis[np.where(onsets_offsets > 0)[0]]
+    offset_times = time_axis[np.where(onsets_offsets < 0)[0]]
+    idx_remove = (offset_times - onset_times) > DURATION_TH_SECS
+    onset_times = onset_times[np.invert(idx_remove)]
+    offset_times = offset_times[np.invert(idx_remove)]
+
+    events = sorted(zip(onset_times, offset_times), key=lambda x: x[0])
+    merged_onset_times = []
+    merged_offset_times = []
+    current_onset_time, current_offset_time = events[0]
+    for onset_time, offset_time in events[1:]:
+        if onset_time - current_offset_time <= MINIMAL_EVENT_DISTANCE:
+            current_offset_time = max(current_offset_time, offset_time)
+        else:
+            merged_onset_times.append(current_onset_time)
+            merged_offset_times.append(current_offset_time)
+            current_onset_time, current_offset_time = onset_time, offset_time
+    merged_onset_times.append(current_onset_time)
+    merged_offset_times.append(current_offset_time)
+    return np.array(merged_onset_times), np.array(merged_offset_times)
+
+
+def vectorized_merge(binary, time_axis):
+    onset_idx, offset_idx = find_vr_event_edges(binary)
+    onset_idx, offset_idx = merge_vr_events(
+        onset_idx, offset_idx, time_axis[1] - time_axis[0], DURATION_TH_SECS, MINIMAL_EVENT_DISTANCE)
+    return time_axis[onset_idx], time_axis[offset_idx]
+
+
+def main(repeats=3):
+    binary = synthetic_binary()
+    time_axis = np.linspace(0, binary.shape[0] / FR, binary.shape[0])
+    print(f'{binary.shape[0]} samples, {np.sum(np.diff(binary) > 0)} events')
+
+    for name, func in [('per event loop', legacy_merge), ('vectorized', vectorized_merge)]:
+        timings = []
+        for _ in range(repeats):
+            t0 = time.perf_counter()
+            onset_times, _ = func(binary, time_axis)
+            timings.append(time.perf_counter() - t0)
+        print(f'{name:>15}: {min(timings):.3f} s (best of {repeats}), {onset_times.shape[0]} merged events')
+
+
+if __name__ == '__main__':
+    main()
@@ -2,21 +2,22 @@ import os
 import numpy as np
 import pandas as pd
 import configparser
-from datetime import datetime
 from PyQt6.QtWidgets import QMessageBox, QListWidget, QListWidgetItem, QDialog, QApplication
-from PyQt6.QtCore import pyqtSignal, QObject, Qt
+from PyQt6.QtCore import pyqtSignal, QObject, Qt, QPointF
 from PyQt6.QtGui import QPen, QBrush, QColor
 import pyqtgraph as pg
-from roibaview.data_handler import DataHandler, TransformData
+from roibaview.data_handler import DataHandler, TransformData, TraceProvider
 from roibaview.csv_handling import CSVHandler
 from roibaview.gui import BrowseFileDialog, InputDialog, SimpleInputDialog, ChangeStyle
-from roibaview.data_plotter import DataPlotter, PyqtgraphSettings
+from roibaview.data_plotter import DataPlotter, PyqtgraphSettings, LodPyramid
 from roibaview.peak_detection import PeakDetection
 from roibaview.ventral_root_detection import VentralRootDetection
 from roibaview.custom_view_box import CustomViewBoxMenu
 from roibaview.registration import Registrator
 from roibaview.video_viewer import VideoViewer
 from roibaview.video_converter import VideoConverter
+from roibaview.refresh_scheduler import RefreshScheduler
+from roibaview.data_export import DataExporter
 
 
 class Controller(QObject):
@@ -44,10 +45,15 @@ class Controller(QObject):
         self.selected_data_sets_rows = []
         self.selected_data_sets_items = []
         self.current_roi_idx = 0
+        # y range of the video cursor line (None: needs to be computed again)
+        self.video_y_range = None
 
         # Get a Data Transformer
         self.data_transformer = TransformData()
 
+        # Get a Data Exporter
+        self.data_exporter = DataExporter(self.data_handler)
+
         # # Replace View Box menu
         # self.view_box = self.gui.trace_plot_item.getViewBox()
         # self.view_box.menu = CustomViewBoxMenu(self.view_box)
@@ -64,6 +70,20 @@ class Controller(QObject):
         # Get DataPlotter
         self.data_plotter = DataPlotter(self.gui.trace_plot_item)
 
+        # Get a Refresh Scheduler (at most one redraw per display frame)
+        refresh_rate = QApplication.primaryScreen().refreshRate()
+        if refresh_rate <= 0:
+            refresh_rate = 60
+        self.refresh_scheduler = RefreshScheduler(frame_interval_ms=1000 / refresh_rate, parent=self)
+
+        # Stacked ROI View (shows a block of ROIs at once)
+        self.stacked_mode = False
+        self.stacked_block_size = 25
+        self.stacked_pyramid = None
+        self.stacked_pyramid_key = None
+        self.stacked_spacing = 1
+        self.stacked_style = ('#000000', 1)
+
         # Get a File Browser
         self.file_browser = BrowseFileDialog(self.gui)
 
@@ -103,6 +123,13 @@ class Controller(QObject):
             'dir': 'NaN',
         }
 
+        # Ventral root conversion: RAM budget for all workers together (GB) and max. number of workers
+        # (auto: half of the physical memory, workers depend on whether disk or CPU is the bottleneck)
+        self.config['VENTRAL_ROOT'] = {
+            'ram_budget_gb': 'auto',
+            'max_workers': 'auto',
+        }
+
         with open('roibaview/config.ini', 'w') as configfile:
             self.config.write(configfile)
 
@@ -124,15 +151,17 @@ class Controller(QObject):
         self.gui.prev_button.clicked.connect(self.prev_roi)
 
         # ROI changed
-        self.signal_roi_idx_changed.connect(lambda: self.update_plots(change_global=False))
-        self.signal_roi_idx_changed.connect(self.check_peak_detector)
+        self.signal_roi_idx_changed.connect(
+            lambda: self.refresh_scheduler.request('roi', self.update_plots, False))
+        self.signal_roi_idx_changed.connect(
+            lambda: self.refresh_scheduler.request('detector', self.check_peak_detector))
 
         # Context Menu
         self.gui.data_sets_list_rename.triggered.connect(self.rename_data_set)
         self.gui.data_sets_list_delete.triggered.connect(self.delete_data_set)
         self.gui.data_sets_list_delete_col.triggered.connect(self.delete_column)
 
-        self.gui.data_sets_list_export.triggered.connect(self.export_to_csv)
+        self.gui.data_sets_list_export.triggered.connect(self.export_data_set)
         self.gui.data_sets_list_time_offset.triggered.connect(self.time_offset)
         self.gui.data_sets_list_y_offset.triggered.connect(self.y_offset)
         self.gui.data_sets_list_to_df_f.triggered.connect(lambda: self.context_menu('df_f'))
@@ -154,7 +183,7 @@ class Controller(QObject):
         # Tools
         # Video Viewer
         self.gui.tools_menu_open_video_viewer.triggered.connect(self.open_video_viewer)
-        self.video_viewer.TimePoint.connect(self.connect_video_to_plot)
+        self.video_viewer.TimePoint.connect(self.video_time_point_changed)
         # Convert csv file
         self.gui.tools_menu_convert_csv.triggered.connect(self.convert_csv_files)
         # Remove Column from csv file
@@ -167,9 +196,17 @@ class Controller(QObject):
         self.gui.tools_menu_create_stimulus.triggered.connect(self.create_stimulus_from_file)
         # Ventral Root Event Detection
         self.gui.tools_menu_detect_vr.triggered.connect(self._ventral_root_detection)
+        self.gui.tools_menu_detect_vr_batch.triggered.connect(self.ventral_root_batch_detection)
         # Peak Detection
         self.gui.tools_menu_detect_peaks.triggered.connect(self._start_peak_detection)
 
+        # View
+        self.gui.view_menu_stacked.triggered.connect(self.toggle_stacked_mode)
+        self.data_plotter.master_plot.vb.sigXRangeChanged.connect(
+            lambda: self.refresh_scheduler.request('stacked_range', self.stacked_range_changed))
+        self.gui.view_menu_refresh_stats.triggered.connect(self.show_refresh_statistics)
+        self.gui.view_menu_events.triggered.connect(lambda: self.update_plots(change_global=False))
+
         # KeyBoard Bindings
         self.gui.key_pressed.connect(self.on_key_press)
         self.data_plotter.master_plot.scene().sigMouseClicked.connect(self.on_mouse_click)
@@ -197,6 +234,8 @@ class Controller(QObject):
 
         # Remove the column
         self.data_handler.delete_column(data_set_type, data_set_name, col_nr)
+        self.stacked_pyramid_key = None
+        self.video_y_range = None
 
     def draw_selection(self, status='start'):
         if status == 'exit' and self.cut_out_region is not None:
@@ -221,52 +260,48 @@ class Controller(QObject):
         if self.cut_out_region is not None:
 
             # Get tag info from user
-            dialog = SimpleInputDialog('Save Selection', 'Tag:')
-            if dialog.exec() == dialog.DialogCode.Accepted:
-                tag_name = dialog.get_input()
+            dialog = InputDialog(dialog_type='cut_selection')
+            if dialog.exec() == QDialog.DialogCode.Accepted:
+                received = dialog.get_input()
+                tag_name = received['tag']
+                all_rois = received['all_rois']
             else:
                 return None
 
+            file_dir = self.file_browser.save_file_name('csv file (*.csv);;hdf5 file (*.hdf5 *.h5);;npz file (*.npz)')
+            if not file_dir:
+                return None
+
             min_x, max_x = self.cut_out_region.getRegion()
 
-            # Get all data that is visible on the plot
-            # Prepare Data Frame for csv file
-            results = pd.DataFrame()
-            k = 0
-            for data_set in self.data_plotter.master_plot.listDataItems():
-                column_name = f'{data_set.name()}_{tag_name}'
-                x = data_set.getData()[0]
-                y = data_set.getData()[1]
-
-                if y is not None and x is not None:
-                    # Find the indices of the region
-                    min_idx = np.searchsorted(x, min_x)
-                    max_idx = np.searchsorted(x, max_x)
-
-                    # Extract and store the selected region
-                    if k == 0:
-                        selected_x = x[min_idx:max_idx]
-                        results['Time'] = selected_x
-
-                    selected_y = y[min_idx:max_idx]
-                    results[column_name] = selected_y
-                    k += 1
+            # The region is read directly from the data sets (not from the plotted data, which might be downsampled)
+            regions = []
+            for data_set_name, data_set_type in zip(self.selected_data_sets, self.selected_data_sets_type):
+                if data_set_type == 'data_sets' and not all_rois:
+                    if self.stacked_mode and self.stacked_pyramid is not None:
+                        cols = list(range(self.current_roi_idx, self.current_roi_idx + self.stacked_pyramid.n_traces))
+                    else:
+                        cols = [self.current_roi_idx]
+                else:
+                    cols = None
+                regions.append(self.data_exporter.get_region(data_set_type, data_set_name, min_x, max_x, cols=cols))
 
             # Store to HDD
-            results.to_csv(f'roibaview/temp/{datetime.now().strftime("%Y_%m_%d_%H_%M_%S")}_{tag_name}.csv')
+            self.data_exporter.export_region(file_dir, regions, tag=tag_name)
             # Remove Selection Markers from Plot
             self.data_plotter.master_plot.removeItem(self.cut_out_region)
+            self.cut_out_region = None
+            self.signal_selection_status = False
 
     def _ventral_root_detection(self):
         if len(self.selected_data_sets) > 0:
             self.gui.freeze_gui(True)
             data_set_name, data_set_type, data_set_item = self.get_selected_data_sets(k=0)
-            current_data_set = self.data_handler.get_data_set(data_set_name=data_set_name, data_set_type=data_set_type)
-            meta_data = self.data_handler.get_data_set_meta_data(data_set_type=data_set_type, data_set_name=data_set_name)
+            # Only the trace of the current ROI is loaded (without y offset)
+            trace_provider = TraceProvider(self.data_handler, data_set_type, data_set_name, apply_y_offset=False)
 
             self.vr_detection = VentralRootDetection(
-                data=current_data_set,
-                fr=meta_data['sampling_rate'],
+                trace_provider=trace_provider,
                 master_plot=self.data_plotter.master_plot,
                 roi=self.current_roi_idx,
             )
@@ -275,8 +310,11 @@ class Controller(QObject):
                 self.gui.freeze_gui(False)
                 self.vr_detection = None
 
-    def export_to_csv(self):
-        file_dir = self.file_browser.save_file_name('csv file, (*.csv *.txt)')
+    def export_data_set(self):
+        file_formats = 'csv file (*.csv *.txt);;numpy file (*.npy);;hdf5 file (*.hdf5 *.h5);;nwb-like file (*.nwb)'
+        if self.data_exporter.parquet_available():
+            file_formats += ';;parquet file (*.parquet)'
+        file_dir = self.file_browser.save_file_name(file_formats)
         if file_dir:
             if len(self.selected_data_sets) > 1:
                 dlg = QMessageBox()
@@ -288,11 +326,9 @@ class Controller(QObject):
             if len(self.selected_data_sets) == 0:
                 return None
 
-            # Export selected data set to csv
+            # Export selected data set (chunk by chunk)
             data_set_name, data_set_type, data_set_item = self.get_selected_data_sets(0)
-            # meta_data = self.data_handler.get_data_set_meta_data(data_set_type=data_set_type, data_set_name=data_set_name)
-            df = pd.DataFrame(self.data_handler.get_data_set(data_set_type=data_set_type, data_set_name=data_set_name))
-            df.to_csv(file_dir, index=False, header=False)
+            self.data_exporter.export_data_set(file_dir, data_set_type, data_set_name)
 
     def create_stimulus_from_file(self):
         file_dir = self.file_browser.browse_file('csv file, (*.csv *.txt)')
@@ -344,11 +380,11 @@ class Controller(QObject):
             :
             └── sweep_n
 
-        All vr text files from one sweep will then be combined into one meaningful and solid data file (csv)
+        All vr text files from one sweep will then be combined into one meaningful and solid data file (hdf5)
+        Sweeps that did not change since the last run are skipped (see ventral_root_manifest.json)
         :return:
         """
-        from joblib import Parallel, delayed
-        from roibaview.ventral_root import transform_ventral_root_parallel, pickle_stuff
+        from roibaview.ventral_root import convert_ventral_root_sweeps
         file_structure = '''
         Expects following file structure:
         └── vr_data
@@ -361,10 +397,11 @@ class Controller(QObject):
             :
             └── sweep_n
             
-        All vr text files from one sweep will then be combined into one meaningful and solid data file (csv)
+        All vr text files from one sweep will then be combined into one meaningful and solid data file (hdf5)
+        All sweeps are joined into "ventral_root_sweeps.h5" (virtual data sets, no copies)
+        Sweeps that did not change since the last run are skipped (see ventral_root_manifest.json)
         '''
 
-        store_to_dict = False
         vr_rec_dur = 60  # in secs
         vr_fr = 10000  # in Hz
 
@@ -383,21 +420,46 @@ class Controller(QObject):
             print( 'This relies heavily on CPU, RAM and HDD. HDD is normally the bottleneck, so make sure to use a fast one!')
             print('... Please Wait ...')
             print('')
-            # Process all sweeps in parallel
-            sweep_numbers = os.listdir(file_dir)
-            results = Parallel(n_jobs=-2)(delayed(
-                transform_ventral_root_parallel)(save_dir, file_dir, vr_rec_dur, vr_fr, i) for i in
-                                          sweep_numbers)
-            if store_to_dict:
-                print('STORING DICT TO HDD')
-                vr_recordings = dict()
-                for res in results:
-                    sw = list(res.keys())[0]
-                    vr_recordings[sw] = res[sw]
-                pickle_stuff(f'{save_dir}/all_ventral_root.pickle', data=vr_recordings)
+            # Process all new or changed sweeps in parallel (each worker writes its own hdf5 file)
+            ram_budget = self.config.get('VENTRAL_ROOT', 'ram_budget_gb', fallback='auto')
+            max_workers = self.config.get('VENTRAL_ROOT', 'max_workers', fallback='auto')
+            sweep_files, failed = convert_ventral_root_sweeps(
+                file_dir, save_dir, vr_rec_dur, vr_fr,
+                n_jobs=None if max_workers == 'auto' else int(max_workers),
+                ram_budget=None if ram_budget == 'auto' else int(float(ram_budget) * 2**30),
+            )
+            if len(failed) > 0:
+                print(f'ERROR: {len(failed)} sweeps failed (see ventral_root_manifest.json): {failed}')
+
+            # Optionally import the sweeps into the current viewer file as global data sets
+            reply = QMessageBox.question(
+                self.gui, 'Ventral Root',
+                'Import the converted sweeps as global data sets?',
+                QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No, QMessageBox.StandardButton.No
+            )
+            if reply == QMessageBox.StandardButton.Yes:
+                for sw, sweep_file in sweep_files.items():
+                    name = self.data_handler.import_hdf5_data_set(
+                        'global_data_sets', sw, sweep_file, f'global_data_sets/{sw}')
+                    if name is not None:
+                        self.add_data_set_to_list('global_data_sets', name)
 
             print('++++ FINISHED PROCESSING ++++')
 
+    def ventral_root_batch_detection(self):
+        # Detect ventral root events in all sweep files (from "Convert Ventral Root Files") of a directory
+        from roibaview.ventral_root_batch import run_vr_batch
+        parameter_file = self.file_browser.browse_file('json file, (*.json)')
+        if not parameter_file:
+            return
+        sweep_dir = self.file_browser.browse_directory()
+        if not sweep_dir:
+            return
+        out_file = self.file_browser.save_file_name('csv file, (*.csv)')
+        if out_file:
+            print('This can take some time ... Please Wait ...')
+            run_vr_batch(parameter_file, sweep_dir, out_file)
+
     def pick_lw(self):
         if len(self.selected_data_sets) > 1:
             dlg = QMessageBox()
@@ -466,34 +528,79 @@ class Controller(QObject):
                 except TypeError:
                     print('ERROR: "delimiter" must be a 1-character string')
 
+    def get_video_y_range(self):
+        # The y range of the video cursor line only changes if the selection, the ROI or the offsets change.
+        # So it is computed once from the cached min/max values of the data handler.
+        if self.video_y_range is None:
+            y_min = []
+            y_max = []
+            for data_set_name, data_set_type in zip(self.selected_data_sets, self.selected_data_sets_type):
+                meta_data = self.data_handler.get_data_set_meta_data(data_set_type, data_set_name)
+                if data_set_type == 'data_sets':
+                    if self.stacked_mode and self.stacked_pyramid is not None:
+                        roi_idx = slice(self.current_roi_idx, self.current_roi_idx + self.stacked_pyramid.n_traces)
+                    else:
+                        roi_idx = self.current_roi_idx
+                    y_range = self.data_handler.get_y_range(data_set_type, data_set_name, roi_idx=roi_idx)
+                else:
+                    y_range = self.data_handler.get_y_range(data_set_type, data_set_name)
+                if y_range is None:
+                    continue
+                y_min.append(y_range[0] + meta_data['y_offset'])
+                y_max.append(y_range[1] + meta_data['y_offset'])
+                if data_set_type == 'data_sets' and self.stacked_mode and self.stacked_pyramid is not None:
+                    # The first ROI of the block is shifted to the top
+                    y_max[-1] += (self.stacked_pyramid.n_traces - 1) * self.stacked_spacing
+            if len(y_min) == 0:
+                return None
+            self.video_y_range = [np.min(y_min), np.max(y_max)]
+        return self.video_y_range
+
+    def video_time_point_changed(self, time_point):
+        # Video frames can come in faster than the plot can be redrawn, only the latest time point is drawn
+        self.refresh_scheduler.request('video', self.connect_video_to_plot, time_point)
+
+    def show_refresh_statistics(self):
+        report = self.refresh_scheduler.frame_time_report()
+        QMessageBox.information(self.gui, 'Plot Refresh Statistics', report)
+
     def connect_video_to_plot(self, time_point):
         for v in self.video_viewers:
             if v.connected_to_data_trace:
                 if len(self.selected_data_sets) > 0:
-                    y_min = []
-                    y_max = []
-                    for data_set_name, data_set_type in zip(self.selected_data_sets, self.selected_data_sets_type):
-                        if data_set_type == 'data_sets':
-                            data = self.data_handler.get_roi_data(data_set_name, roi_idx=self.current_roi_idx)
-                        else:
-                            data = self.data_handler.get_data_set('global_data_sets', data_set_name)
-                        y_min.append(np.min(data))
-                        y_max.append(np.max(data))
-                    y_range = [np.min(y_min), np.max(y_max)]
-                    self.data_plotter.update_video_plot(time_point, y_range)
+                    y_range = self.get_video_y_range()
+                    if y_range is not None:
+                        self.data_plotter.update_video_plot(time_point, y_range)
                 else:
-                    self.data_plotter.clear_plot_data(name='video')
+                    self.data_plotter.clear_video_plot()
             else:
-                self.data_plotter.clear_plot_data(name='video')
+                self.data_plotter.clear_video_plot()
 
     def open_video_viewer(self):
-        self.video_viewers.append(VideoViewer())
+        self.video_viewers.append(VideoViewer(self.config))
         self.video_viewers[-1].show()
-        self.video_viewers[-1].TimePoint.connect(self.connect_video_to_plot)
+        self.video_viewers[-1].TimePoint.connect(self.video_time_point_changed)
+        self.video_viewers[-1].TracesExtracted.connect(self.add_video_traces)
 
         # self.video_viewer = VideoViewer()
         # self.video_viewer.show()
 
+    def add_video_traces(self, traces, fr, time_offset, roi_names, data_set_name):
+        # ROI traces extracted in the video viewer become a new data set
+        check_if_exists = self.data_handler.check_if_exists('data_sets', data_set_name)
+        if check_if_exists:
+            return None
+        self.data_handler.add_new_data_set(
+            data_set_type='data_sets',
+            data_set_name=data_set_name,
+            data=traces,
+            sampling_rate=fr,
+            time_offset=time_offset,
+            y_offset=0,
+            header=np.array(roi_names, dtype=object),
+        )
+        self.add_data_set_to_list('data_sets', data_set_name)
+
     def open_video_converter(self):
         self.video_converter = VideoConverter(self.config)
         self.video_converter.show()
@@ -582,6 +689,9 @@ class Controller(QObject):
                     # print('')
                     self.data_handler.delete_data_set(dt, ds)
                     self.remove_selected_data_set_from_list(ds, item)
+                self.stacked_pyramid = None
+                self.stacked_pyramid_key = None
+                self.video_y_range = None
 
     def tiff_registration(self):
         registrator = Registrator()
@@ -600,15 +710,14 @@ class Controller(QObject):
         if len(self.selected_data_sets) > 0:
             self.gui.freeze_gui(True)
             data_set_name, data_set_type, data_set_item = self.get_selected_data_sets(k=0)
-            # current_data = self.data_handler.get_roi_data(data_set_name, roi_idx=self.current_roi_idx)
-            current_data_set = self.data_handler.get_data_set(data_set_name=data_set_name, data_set_type=data_set_type)
-            meta_data = self.data_handler.get_data_set_meta_data(data_set_type=data_set_type, data_set_name=data_set_name)
+            # Only the trace of the current ROI is loaded (with y offset)
+            trace_provider = TraceProvider(self.data_handler, data_set_type, data_set_name)
 
             self.peak_detection = PeakDetection(
-                data=current_data_set + meta_data['y_offset'],
-                fr=meta_data['sampling_rate'],
+                trace_provider=trace_provider,
                 master_plot=self.data_plotter.master_plot,
                 roi=self.current_roi_idx,
+                scheduler=self.refresh_scheduler,
             )
             # self.peak_detection.signal_roi_changed.connect(lambda value: print("Variable changed:", value))
             self.peak_detection.show()
@@ -755,17 +864,83 @@ class Controller(QObject):
     def next_roi(self):
         # First check if there are active data sets
         if 'data_sets' in self.selected_data_sets_type:
-            self.current_roi_idx = (self.current_roi_idx + 1) % self.data_handler.roi_count
+            if self.stacked_mode:
+                # Go to the next block of ROIs
+                self.current_roi_idx = self.current_roi_idx + self.stacked_block_size
+                if self.current_roi_idx >= self.data_handler.roi_count:
+                    self.current_roi_idx = 0
+            else:
+                self.current_roi_idx = (self.current_roi_idx + 1) % self.data_handler.roi_count
             self.signal_roi_idx_changed.emit()
 
     def prev_roi(self):
         # First check if there are active data sets
         if 'data_sets' in self.selected_data_sets_type:
-            self.current_roi_idx = (self.current_roi_idx - 1) % self.data_handler.roi_count
+            if self.stacked_mode:
+                # Go to the previous block of ROIs
+                self.current_roi_idx = self.current_roi_idx - self.stacked_block_size
+                if self.current_roi_idx < 0:
+                    last_block = (self.data_handler.roi_count - 1) // self.stacked_block_size
+                    self.current_roi_idx = last_block * self.stacked_block_size
+            else:
+                self.current_roi_idx = (self.current_roi_idx - 1) % self.data_handler.roi_count
             self.signal_roi_idx_changed.emit()
 
+    def toggle_stacked_mode(self):
+        self.stacked_mode = self.gui.view_menu_stacked.isChecked()
+        if self.stacked_mode:
+            # Blocks always start at a multiple of the block size
+            self.current_roi_idx = self.current_roi_idx - self.current_roi_idx % self.stacked_block_size
+        self.stacked_pyramid = None
+        self.stacked_pyramid_key = None
+        self.update_plots(change_global=False)
+
+    def update_stacked_plot(self):
+        # Draw the current block of ROIs of the first selected data set stacked on top of each other
+        data_sets = [ds for ds, dt in zip(self.selected_data_sets, self.selected_data_sets_type) if dt == 'data_sets']
+        if len(data_sets) == 0:
+            self.stacked_pyramid = None
+            self.stacked_pyramid_key = None
+            self.data_plotter.clear_plot_data(name='data')
+            return
+        data_set_name = data_sets[0]
+        block_start = self.current_roi_idx
+        block_end = block_start + self.stacked_block_size
+        meta_data = self.data_handler.get_data_set_meta_data('data_sets', data_set_name)
+        key = (data_set_name, block_start, meta_data['time_offset'], meta_data['y_offset'])
+
+        reset_range = False
+        if self.stacked_pyramid_key != key:
+            block = self.data_handler.get_roi_block('data_sets', data_set_name, block_start, block_end)
+            if block is None:
+                return
+            self.stacked_pyramid = LodPyramid(
+                block + meta_data['y_offset'],
+                fr=meta_data['sampling_rate'],
+                time_offset=meta_data['time_offset']
+            )
+            self.stacked_spacing = self.stacked_pyramid.get_spacing()
+            self.stacked_pyramid_key = key
+            reset_range = True
+
+        self.stacked_style = (meta_data['color'], meta_data['lw'])
+        self.data_plotter.update_stacked(
+            self.stacked_pyramid, self.stacked_spacing,
+            color=self.stacked_style[0], lw=self.stacked_style[1], reset_range=reset_range
+        )
+        block_end = block_start + self.stacked_pyramid.n_traces
+        self.data_plotter.master_plot.setTitle(f'ROIs: {block_start + 1} - {block_end}')
+
+    def stacked_range_changed(self):
+        # Redraw the visible window of the stacked ROIs with the matching level of detail
+        if self.stacked_mode and self.stacked_pyramid is not None:
+            self.data_plotter.update_stacked(
+                self.stacked_pyramid, self.stacked_spacing, color=self.stacked_style[0], lw=self.stacked_style[1])
+
     def update_plots(self, change_global=True):
         # print(f'ROI: {self.current_roi_idx}')
+        # Selection, ROI or offsets might have changed
+        self.video_y_range = None
         # get new roi data
         roi_data = []
         time_points = []
@@ -773,9 +948,11 @@ class Controller(QObject):
         global_time_points = []
         meta_data_list = list()
         global_meta_data_list = list()
+        event_times = []
+        event_values = []
 
         for data_set_name, data_set_type in zip(self.selected_data_sets, self.selected_data_sets_type):
-            if data_set_type == 'data_sets':
+            if data_set_type == 'data_sets' and not self.stacked_mode:
                 r = self.data_handler.get_roi_data(data_set_name, roi_idx=self.current_roi_idx)
                 meta_data = self.data_handler.get_data_set_meta_data('data_sets', data_set_name)
                 fr = meta_data['sampling_rate']
@@ -791,6 +968,11 @@ class Controller(QObject):
 
                 roi_data.append(r + y_offset)
                 meta_data_list.append(meta_data)
+                if self.gui.view_menu_events.isChecked():
+                    # Stored events of this ROI (e.g. from batch peak detection), no detection needed
+                    t, y = self.get_stored_events(data_set_name, time_points[-1], roi_data[-1])
+                    event_times.extend(t)
+                    event_values.extend(y)
             if data_set_type == 'global_data_sets' and change_global:
                 r = self.data_handler.get_data_set('global_data_sets', data_set_name)
                 meta_data = self.data_handler.get_data_set_meta_data('global_data_sets', data_set_name)
@@ -802,11 +984,14 @@ class Controller(QObject):
                 global_meta_data_list.append(meta_data)
 
         # Update Plot
-        if len(roi_data) > 0:
+        if self.stacked_mode:
+            self.update_stacked_plot()
+        elif len(roi_data) > 0:
             self.data_plotter.update(time_points, roi_data, meta_data_list)
             self.data_plotter.master_plot.setTitle(f'ROI: {self.current_roi_idx+1}')
         else:
             self.data_plotter.clear_plot_data(name='data')
+        self.data_plotter.update_events(event_times, event_values)
 
         # Update Global Plot
         if change_global:
@@ -815,6 +1000,19 @@ class Controller(QObject):
             else:
                 self.data_plotter.clear_plot_data(name='global')
 
+    def get_stored_events(self, data_set_name, time_axis, trace):
+        # Get the event times and the trace values at the events of the current ROI for all stored event types
+        times = []
+        values = []
+        for event_type in self.data_handler.get_event_types('data_sets', data_set_name):
+            events = self.data_handler.get_events('data_sets', data_set_name, event_type, roi_idx=self.current_roi_idx)
+            if events is None or events.shape[0] == 0:
+                continue
+            idx = np.clip(events['idx'], 0, trace.shape[0] - 1)
+            times.append(time_axis[idx])
+            values.append(trace[idx])
+        return times, values
+
     def data_set_selection_changed(self):
         # Get selected data sets
         self.selected_data_sets = [item.text() for item in self.gui.sender().selectedItems()]
@@ -893,10 +1091,14 @@ class Controller(QObject):
         file_dir = self.file_browser.browse_file('hdf5 file, (*.hdf5)')
         if file_dir:
             self.data_handler.open_file(file_dir)
+            # Data sets of the new file can have the same names as the old ones
+            self.stacked_pyramid = None
+            self.stacked_pyramid_key = None
+            self.video_y_range = None
             data_structure = self.data_handler.get_info()
-            # Add new data set to the list in the GUI
-            for data_set_type in data_structure:
-                for ds in data_structure[data_set_type]:
+            # Add new data set to the list in the GUI (other groups, e.g. peak tables, are not data sets)
+            for data_set_type in ['data_sets', 'global_data_sets']:
+                for ds in data_structure.get(data_set_type, []):
                     self.add_data_set_to_list(data_set_type, ds)
 
             # Get the ROI count (from the first data set)
@@ -914,6 +1116,9 @@ class Controller(QObject):
         if button == QMessageBox.StandardButton.Yes:
             self.data_handler.new_file()
             self.gui.data_sets_list.clear()
+            self.stacked_pyramid = None
+            self.stacked_pyramid_key = None
+            self.video_y_range = None
 
     def _create_short_cuts(self):
         pass
@@ -976,7 +1181,11 @@ class Controller(QObject):
     #     self.gui.close()
 
     def mouse_moved(self, event):
+        # Only update the label once per display frame
+        self.refresh_scheduler.request('mouse', self.update_mouse_label, QPointF(event))
+
+    def update_mouse_label(self, pos):
         vb = self.gui.trace_plot_item.vb
-        if self.gui.trace_plot_item.sceneBoundingRect().contains(event):
-            mouse_point = vb.mapSceneToView(event)
+        if self.gui.trace_plot_item.sceneBoundingRect().contains(pos):
+            mouse_point = vb.mapSceneToView(pos)
             self.gui.mouse_label.setText(f"<p style='color:black'>X： {mouse_point.x():.4f} <br> Y: {mouse_point.y():.4f}</p>")
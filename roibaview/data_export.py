@@ -0,0 +1,290 @@
+import os
+import json
+import zipfile
+import h5py
+import numpy as np
+import pandas as pd
+
+
+class DataExporter:
+    """ Export data sets (or parts of them) directly from the hdf5 file of the DataHandler
+
+    The data is copied chunk by chunk, so the memory usage does not depend on the size of the data set.
+    The output format is selected by the file extension.
+    """
+    region_formats = ['.csv', '.hdf5', '.h5', '.npz']
+    data_set_formats = ['.csv', '.txt', '.npy', '.parquet', '.hdf5', '.h5', '.nwb']
+
+    def __init__(self, data_handler, chunk_size=2**20):
+        self.data_handler = data_handler
+        self.chunk_size = chunk_size
+
+    @staticmethod
+    def get_sample_idx(time_point, n_samples, fr, time_offset):
+        # Sample index of a time point (same time axis as TransformData.compute_time_axis())
+        dt = (n_samples / fr) / (n_samples - 1) if n_samples > 1 else 1 / fr
+        idx = int(np.round((time_point - time_offset) / dt))
+        return min(max(idx, 0), n_samples), dt
+
+    @staticmethod
+    def parquet_available():
+        try:
+            import pyarrow
+            return True
+        except ModuleNotFoundError:
+            return False
+
+    @staticmethod
+    def get_column_names(meta_data, n_cols):
+        if 'roi_names' in meta_data:
+            names = meta_data['roi_names']
+        else:
+            names = meta_data.get('header_names', None)
+        # Older data sets might only have a single name (or none) for all columns
+        if names is None or np.ndim(names) == 0 or len(names) != n_cols:
+            names = np.arange(n_cols)
+        return [str(n) for n in names]
+
+    def get_region(self, data_set_type, data_set_name, t_start, t_end, cols=None):
+        # Collect everything needed to export the time window [t_start, t_end] of a data set
+        # cols: None (all columns) or a list of column indices
+        meta_data = self.data_handler.get_data_set_meta_data(data_set_type, data_set_name)
+        layout = self.data_handler.get_data_set_layout(data_set_type, data_set_name)
+        if meta_data is None or layout is None:
+            return None
+        (n_samples, n_cols), dtype = layout
+        fr = meta_data['sampling_rate']
+        start_idx, dt = self.get_sample_idx(t_start, n_samples, fr, meta_data['time_offset'])
+        end_idx, _ = self.get_sample_idx(t_end, n_samples, fr, meta_data['time_offset'])
+        column_names = self.get_column_names(meta_data, n_cols)
+        if cols is None:
+            cols = list(range(n_cols))
+        cols = sorted(c for c in cols if 0 <= c < n_cols)
+        region = dict(
+            data_set_type=data_set_type,
+            data_set_name=data_set_name,
+            cols=cols,
+            column_names=[column_names[c] for c in cols],
+            start_idx=start_idx,
+            end_idx=max(end_idx, start_idx),
+            dt=dt,
+            fr=fr,
+            time_offset=meta_data['time_offset'],
+            y_offset=meta_data['y_offset'],
+            # The y offset might change the data type (e.g. int + float)
+            dtype=np.result_type(dtype, np.asarray(meta_data['y_offset']).dtype),
+        )
+        return region
+
+    def iter_region(self, region, rows_per_chunk=None):
+        # Yields (time axis, data) chunks of a region (y offset is applied like in the plot)
+        for start, chunk in self.data_handler.iter_chunks(
+                region['data_set_type'], region['data_set_name'],
+                start_idx=region['start_idx'], end_idx=region['end_idx'],
+                cols=region['cols'], chunk_size=self.chunk_size, rows_per_chunk=rows_per_chunk):
+            t = np.arange(start, start + chunk.shape[0]) * region['dt'] + region['time_offset']
+            yield t, chunk + region['y_offset']
+
+    def iter_region_time(self, region):
+        # Yields the time axis of a region chunk by chunk (without reading any data)
+        for start in range(region['start_idx'], region['end_idx'], self.chunk_size):
+            end = min(start + self.chunk_size, region['end_idx'])
+            yield np.arange(start, end) * region['dt'] + region['time_offset']
+
+    def export_region(self, file_dir, regions, tag=''):
+        # Export a list of regions (see get_region()) to a csv, hdf5 or npz file
+        regions = [r for r in regions if r is not None and len(r['cols']) > 0 and r['end_idx'] > r['start_idx']]
+        if len(regions) == 0:
+            print('ERROR: Nothing to export!')
+            return False
+        ext = os.path.splitext(file_dir)[1].lower()
+        if ext == '.csv':
+            self._region_to_csv(file_dir, regions, tag)
+        elif ext in ['.hdf5', '.h5']:
+            self._region_to_hdf5(file_dir, regions, tag)
+        elif ext == '.npz':
+            self._region_to_npz(file_dir, regions, tag)
+        else:
+            print(f'ERROR: Unknown file format "{ext}". Use one of: {self.region_formats}')
+            return False
+        return True
+
+    def _region_to_csv(self, file_dir, regions, tag):
+        # Regions with the same time axis are written side by side into one file, otherwise one file per data set
+        def same_time_axis(a, b):
+            return (a['end_idx'] - a['start_idx'] == b['end_idx'] - b['start_idx']
+                    and np.isclose(a['dt'], b['dt'])
+                    and np.isclose(a['start_idx'] * a['dt'] + a['time_offset'],
+                                   b['start_idx'] * b['dt'] + b['time_offset']))
+
+        if all(same_time_axis(regions[0], r) for r in regions[1:]):
+            groups = [(file_dir, regions)]
+        else:
+            base, ext = os.path.splitext(file_dir)
+            groups = [(f'{base}_{r["data_set_name"]}{ext}', [r]) for r in regions]
+
+        for out_file, group in groups:
+            header = ['Time']
+            for r in group:
+                header.extend([f'{r["data_set_name"]}_{c}_{tag}' for c in r['column_names']])
+            # All regions of one file have to be read with the same number of rows per chunk
+            rows_per_chunk = max(self.chunk_size // (len(header) - 1), 1)
+            with open(out_file, 'w', newline='') as fh:
+                fh.write(','.join(header) + '\n')
+                for chunks in zip(*[self.iter_region(r, rows_per_chunk) for r in group]):
+                    t = chunks[0][0]
+                    values = np.column_stack([t] + [c[1] for c in chunks])
+                    pd.DataFrame(values).to_csv(fh, header=False, index=False)
+
+    def _region_to_hdf5(self, file_dir, regions, tag):
+        with h5py.File(file_dir, 'w') as f:
+            f.attrs['tag'] = tag
+            for r in regions:
+                n_rows = r['end_idx'] - r['start_idx']
+                group = f.create_group(r['data_set_name'])
+                group.attrs['data_type'] = r['data_set_type']
+                group.attrs['sampling_rate'] = float(r['fr'])
+                group.attrs['start_time'] = r['start_idx'] * r['dt'] + r['time_offset']
+                group.attrs['start_idx'] = r['start_idx']
+                group.attrs['roi_names'] = r['column_names']
+                data = group.create_dataset('data', shape=(n_rows, len(r['cols'])), dtype=r['dtype'], chunks=True)
+                time = group.create_dataset('time', shape=(n_rows,), dtype='f8', chunks=True)
+                row = 0
+                for t, chunk in self.iter_region(r):
+                    data[row:row + chunk.shape[0]] = chunk
+                    time[row:row + chunk.shape[0]] = t
+                    row += chunk.shape[0]
+
+    def _region_to_npz(self, file_dir, regions, tag):
+        # npz files are zip files of npy files: the npy header is written first and then the data chunk by chunk
+        with zipfile.ZipFile(file_dir, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as zf:
+            self._write_npy_to_zip(zf, 'tag', np.array(tag))
+            for r in regions:
+                name = r['data_set_name']
+                n_rows = r['end_idx'] - r['start_idx']
+                self._write_npy_to_zip(zf, f'{name}_roi_names', np.array(r['column_names']))
+                self._write_npy_to_zip(zf, f'{name}_sampling_rate', np.array(r['fr']))
+                self._stream_npy_to_zip(zf, f'{name}_time', (n_rows,), np.dtype('f8'), self.iter_region_time(r))
+                self._stream_npy_to_zip(
+                    zf, name, (n_rows, len(r['cols'])), np.dtype(r['dtype']), (c for _, c in self.iter_region(r)))
+
+    @staticmethod
+    def _write_npy_to_zip(zf, key, array):
+        with zf.open(f'{key}.npy', 'w', force_zip64=True) as fh:
+            np.lib.format.write_array(fh, array, allow_pickle=False)
+
+    @staticmethod
+    def _stream_npy_to_zip(zf, key, shape, dtype, chunks):
+        header = {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': shape}
+        with zf.open(f'{key}.npy', 'w', force_zip64=True) as fh:
+            np.lib.format.write_array_header_2_0(fh, header)
+            for chunk in chunks:
+                fh.write(np.ascontiguousarray(chunk, dtype=dtype).tobytes())
+
+    # ==================================================================================================================
+    # EXPORT ENTIRE DATA SETS
+    # ------------------------------------------------------------------------------------------------------------------
+    def export_data_set(self, file_dir, data_set_type, data_set_name):
+        # Export an entire data set. The output format is selected by the file extension.
+        meta_data = self.data_handler.get_data_set_meta_data(data_set_type, data_set_name)
+        layout = self.data_handler.get_data_set_layout(data_set_type, data_set_name)
+        if meta_data is None or layout is None:
+            return False
+        ext = os.path.splitext(file_dir)[1].lower()
+        if ext in ['.csv', '.txt']:
+            self._data_set_to_csv(file_dir, data_set_type, data_set_name)
+        elif ext == '.npy':
+            self._data_set_to_npy(file_dir, data_set_type, data_set_name, layout, meta_data)
+        elif ext == '.parquet':
+            if not self.parquet_available():
+                print('ERROR: Exporting to parquet needs the "pyarrow" package!')
+                return False
+            self._data_set_to_parquet(file_dir, data_set_type, data_set_name, layout, meta_data)
+        elif ext in ['.hdf5', '.h5']:
+            self._data_set_to_hdf5(file_dir, data_set_type, data_set_name, layout, meta_data)
+        elif ext == '.nwb':
+            self._data_set_to_nwb(file_dir, data_set_type, data_set_name, layout, meta_data)
+        else:
+            print(f'ERROR: Unknown file format "{ext}". Use one of: {self.data_set_formats}')
+            return False
+        return True
+
+    @staticmethod
+    def get_export_meta_data(meta_data, n_cols):
+        # Meta data that is stored next to the exported values (only simple types, so it can be stored as json)
+        result = dict()
+        for k in ['name', 'data_type', 'sampling_rate', 'time_offset', 'y_offset']:
+            if k in meta_data:
+                v = meta_data[k]
+                result[k] = v.item() if isinstance(v, np.generic) else v
+        result['roi_names'] = DataExporter.get_column_names(meta_data, n_cols)
+        return result
+
+    def _data_set_to_csv(self, file_dir, data_set_type, data_set_name):
+        # Same format as before (no header, no index), but written chunk by chunk
+        with open(file_dir, 'w', newline='') as fh:
+            for _, chunk in self.data_handler.iter_chunks(data_set_type, data_set_name, chunk_size=self.chunk_size):
+                pd.DataFrame(chunk).to_csv(fh, header=False, index=False)
+
+    def _data_set_to_npy(self, file_dir, data_set_type, data_set_name, layout, meta_data):
+        # The npy file is created as memory map and filled chunk by chunk. The meta data goes into a json file.
+        shape, dtype = layout
+        out = np.lib.format.open_memmap(file_dir, mode='w+', dtype=dtype, shape=shape)
+        for start, chunk in self.data_handler.iter_chunks(data_set_type, data_set_name, chunk_size=self.chunk_size):
+            out[start:start + chunk.shape[0]] = chunk
+        out.flush()
+        del out
+        with open(f'{os.path.splitext(file_dir)[0]}_meta_data.json', 'w') as fh:
+            json.dump(self.get_export_meta_data(meta_data, shape[1]), fh, indent=4)
+
+    def _data_set_to_parquet(self, file_dir, data_set_type, data_set_name, layout, meta_data):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        shape, dtype = layout
+        export_meta_data = self.get_export_meta_data(meta_data, shape[1])
+        # Column names must be unique
+        names = export_meta_data['roi_names']
+        if len(set(names)) != len(names):
+            names = [f'{k}_{n}' for k, n in enumerate(names)]
+        schema = pa.schema(
+            [pa.field(n, pa.from_numpy_dtype(dtype)) for n in names],
+            metadata={'roibaview': json.dumps(export_meta_data)}
+        )
+        # Each chunk becomes one row group
+        with pq.ParquetWriter(file_dir, schema) as writer:
+            for _, chunk in self.data_handler.iter_chunks(data_set_type, data_set_name, chunk_size=self.chunk_size):
+                table = pa.Table.from_arrays([pa.array(chunk[:, k]) for k in range(chunk.shape[1])], schema=schema)
+                writer.write_table(table)
+
+    def _data_set_to_hdf5(self, file_dir, data_set_type, data_set_name, layout, meta_data):
+        # Standalone hdf5 file with the same layout as the viewer file, so it can be opened again in the viewer
+        shape, dtype = layout
+        with h5py.File(file_dir, 'w') as f:
+            f.create_group('data_sets')
+            f.create_group('global_data_sets')
+            out = f[data_set_type].create_dataset(data_set_name, shape=shape, dtype=dtype, chunks=True)
+            for k in meta_data:
+                out.attrs[k] = meta_data[k]
+            for start, chunk in self.data_handler.iter_chunks(data_set_type, data_set_name, chunk_size=self.chunk_size):
+                out[start:start + chunk.shape[0]] = chunk
+
+    def _data_set_to_nwb(self, file_dir, data_set_type, data_set_name, layout, meta_data):
+        # NWB-like layout (a TimeSeries in "acquisition"). This is not a validated NWB file!
+        shape, dtype = layout
+        export_meta_data = self.get_export_meta_data(meta_data, shape[1])
+        with h5py.File(file_dir, 'w') as f:
+            f.attrs['session_description'] = 'exported from RoiBaView'
+            f.attrs['identifier'] = data_set_name
+            series = f.create_group('acquisition').create_group(data_set_name)
+            series.attrs['neurodata_type'] = 'TimeSeries'
+            series.attrs['description'] = data_set_type
+            out = series.create_dataset('data', shape=shape, dtype=dtype, chunks=True)
+            out.attrs['unit'] = 'n.a.'
+            out.attrs['conversion'] = 1.0
+            out.attrs['offset'] = float(export_meta_data['y_offset'])
+            starting_time = series.create_dataset('starting_time', data=float(export_meta_data['time_offset']))
+            starting_time.attrs['rate'] = float(export_meta_data['sampling_rate'])
+            starting_time.attrs['unit'] = 'seconds'
+            series.create_dataset('roi_names', data=np.array(export_meta_data['roi_names'], dtype=h5py.string_dtype()))
+            for start, chunk in self.data_handler.iter_chunks(data_set_type, data_set_name, chunk_size=self.chunk_size):
+                out[start:start + chunk.shape[0]] = chunk
@@ -26,6 +26,13 @@ Data Structure:
 :   :
 │   └── global_set_n
 │
+├── events
+│   ├── data_sets
+│   │   └── set_01
+│   │       ├── peaks (one column per field: roi, time, ... + index: roi_ptr, time_order)
+│   │       └── vr_events
+│   └── global_data_sets
+│
 └── some_other_stuff
     ├── stuff_01
     └── info
@@ -39,6 +46,8 @@ class DataHandler(QObject):
         QObject.__init__(self)
         self._set_csv_import_settings()
         self.temp_file_name = f'roibaview/temp/temp_data.hdf5'
+        # Column wise min/max values of the data sets: {(data_set_type, data_set_name): (y_min, y_max)}
+        self.y_range_cache = dict()
         self.create_new_temp_hdf5_file()
         self.roi_count = 0
 
@@ -52,9 +61,11 @@ class DataHandler(QObject):
 
     def create_new_temp_hdf5_file(self):
         # Will create an empty hdf5 file into the temp directory with one group called "data_sets"
+        self.y_range_cache = dict()
         with h5py.File(self.temp_file_name, 'w') as f:
             f.create_group('data_sets')
             f.create_group('global_data_sets')
+            f.create_group('events')
 
     def import_csv(self, file_dir, data_name, sampling_rate, data_set_type):
         # The .csv file: Each Column is the data of one ROI so the shape is (Samples, ROIs)
@@ -128,6 +139,10 @@ class DataHandler(QObject):
                     dset[...] = modified_data  # Overwrite without deleting the dataset
                     self.roi_count = modified_data.shape[1]
 
+                    # The stored min/max values are not valid anymore
+                    self._clear_y_range(f, data_set_type, data_set_name)
+                    self._delete_events_of_roi(f, data_set_type, data_set_name, col_nr)
+
                 except IndexError:
                     return None
 
@@ -138,12 +153,18 @@ class DataHandler(QObject):
                 # print(f[data_set_type][data_set_name])
                 # f[data_set_type][data_set_name][:] = 0
                 del f[data_set_type][data_set_name]
+                self.y_range_cache.pop((data_set_type, data_set_name), None)
+                if 'events' in f and data_set_type in f['events'] and data_set_name in f['events'][data_set_type]:
+                    del f['events'][data_set_type][data_set_name]
 
     def rename_data_set(self, data_set_type, data_set_name, new_name):
         with h5py.File(self.temp_file_name, 'r+') as f:
             if data_set_name in f[data_set_type]:
                 f[data_set_type][new_name] = f[data_set_type][data_set_name]
                 del f[data_set_type][data_set_name]
+                self.y_range_cache.pop((data_set_type, data_set_name), None)
+                if 'events' in f and data_set_type in f['events'] and data_set_name in f['events'][data_set_type]:
+                    f['events'][data_set_type].move(data_set_name, new_name)
 
     def add_new_data_set(self, data_set_type, data_set_name, data, sampling_rate, time_offset, y_offset, header):
         # Open the temp hdf5 file and store data set there
@@ -157,6 +178,7 @@ class DataHandler(QObject):
 
             # CREATE NEW DATASET
             new_entry = f[data_set_type].create_dataset(data_set_name, data=data, chunks=True)
+            self.y_range_cache.pop((data_set_type, data_set_name), None)
             if data_set_type == 'global_data_sets':
                 header_name = 'header_names'
             else:
@@ -173,6 +195,29 @@ class DataHandler(QObject):
 
             return already_exists
 
+    def import_hdf5_data_set(self, data_set_type, data_set_name, file_dir, source_path, chunk_size=2**20):
+        # Copy a data set (samples, columns) from another hdf5 file (e.g. a converted ventral root sweep) into the
+        # temp file, chunk by chunk, together with its attributes
+        with h5py.File(file_dir, 'r') as src, h5py.File(self.temp_file_name, 'r+') as f:
+            if source_path not in src:
+                print('ERROR: Data set not found!')
+                return None
+            if data_set_name in f[data_set_type]:
+                print('ERROR: Data set with this name already exists!')
+                return None
+            source = src[source_path]
+            new_entry = f[data_set_type].create_dataset(
+                data_set_name, shape=source.shape, dtype=source.dtype, chunks=True if source.shape[0] > 0 else None)
+            rows_per_chunk = max(chunk_size // max(source.shape[1], 1), 1)
+            for start in range(0, source.shape[0], rows_per_chunk):
+                new_entry[start:start + rows_per_chunk] = source[start:start + rows_per_chunk]
+            for k in source.attrs:
+                new_entry.attrs[k] = source.attrs[k]
+            new_entry.attrs['name'] = data_set_name
+            new_entry.attrs['data_type'] = data_set_type
+            self.y_range_cache.pop((data_set_type, data_set_name), None)
+            return data_set_name
+
     def add_meta_data(self, data_set_type, data_set_name, metadata_dict):
         with h5py.File(self.temp_file_name, 'r+') as f:
             # Check if data set is available
@@ -224,11 +269,242 @@ class DataHandler(QObject):
                 print('ERROR: ROI Index is outside of data set range!')
                 return None
 
+    def get_roi_block(self, data_set_type, data_set_name, start_idx, stop_idx):
+        # Get the data of a block of neighbouring columns (ROIs) [start_idx, stop_idx) in a specific data set
+        # Only this block is read from the hdf5 file, not the entire data set
+        with h5py.File(self.temp_file_name, 'r') as f:
+            # Check if data set is available
+            if data_set_name in f[data_set_type]:
+                data_set = f[data_set_type][data_set_name]
+            else:
+                print('ERROR: Data set not found!')
+                return None
+            stop_idx = min(stop_idx, data_set.shape[1])
+            if start_idx < 0 or start_idx >= stop_idx:
+                print('ERROR: ROI Index is outside of data set range!')
+                return None
+            return data_set[:, start_idx:stop_idx]
+
+    def get_data_set_layout(self, data_set_type, data_set_name):
+        # Get shape and dtype of a data set without reading its data
+        with h5py.File(self.temp_file_name, 'r') as f:
+            # Check if data set is available
+            if data_set_name in f[data_set_type]:
+                data_set = f[data_set_type][data_set_name]
+                return data_set.shape, data_set.dtype
+            else:
+                print('ERROR: Data set not found!')
+                return None
+
+    def iter_chunks(self, data_set_type, data_set_name, start_idx=0, end_idx=None, cols=None, chunk_size=2**20,
+                    rows_per_chunk=None):
+        # Read the rows [start_idx, end_idx) of a data set chunk by chunk (roughly chunk_size values per chunk or
+        # a fixed number of rows per chunk)
+        # cols: None (all columns), a slice or a sorted list of column indices
+        # Yields (first row index of the chunk, chunk)
+        with h5py.File(self.temp_file_name, 'r') as f:
+            # Check if data set is available
+            if data_set_name not in f[data_set_type]:
+                print('ERROR: Data set not found!')
+                return
+            data_set = f[data_set_type][data_set_name]
+            n_rows, n_cols = data_set.shape
+            if end_idx is None or end_idx > n_rows:
+                end_idx = n_rows
+            if cols is None:
+                cols = slice(None)
+            elif not isinstance(cols, slice) and len(cols) > 0 and list(cols) == list(range(cols[0], cols[-1] + 1)):
+                # Reading a slice is much faster than fancy indexing in h5py
+                cols = slice(cols[0], cols[-1] + 1)
+            if rows_per_chunk is None:
+                n_selected = len(range(n_cols)[cols]) if isinstance(cols, slice) else len(cols)
+                rows_per_chunk = max(chunk_size // max(n_selected, 1), 1)
+            for start in range(start_idx, end_idx, rows_per_chunk):
+                end = min(start + rows_per_chunk, end_idx)
+                yield start, data_set[start:end, cols]
+
+    def get_y_range(self, data_set_type, data_set_name, roi_idx=None):
+        # Get min and max value of a data set (roi_idx=None) or of some of its columns (roi_idx: int or slice)
+        # The column wise min/max values are only computed once and are stored as attributes ('y_min', 'y_max') in
+        # the hdf5 file. After that no data has to be read from the file anymore.
+        key = (data_set_type, data_set_name)
+        if key not in self.y_range_cache:
+            with h5py.File(self.temp_file_name, 'r+') as f:
+                # Check if data set is available
+                if data_set_name not in f[data_set_type]:
+                    print('ERROR: Data set not found!')
+                    return None
+                data_set = f[data_set_type][data_set_name]
+                n_cols = data_set.shape[1]
+                if 'y_min' in data_set.attrs and 'y_max' in data_set.attrs and len(data_set.attrs['y_min']) == n_cols:
+                    y_min = np.array(data_set.attrs['y_min'])
+                    y_max = np.array(data_set.attrs['y_max'])
+                else:
+                    y_min, y_max = self._compute_y_range(data_set)
+                    data_set.attrs['y_min'] = y_min
+                    data_set.attrs['y_max'] = y_max
+            self.y_range_cache[key] = (y_min, y_max)
+
+        y_min, y_max = self.y_range_cache[key]
+        if roi_idx is not None:
+            y_min = y_min[roi_idx]
+            y_max = y_max[roi_idx]
+        return np.nanmin(y_min), np.nanmax(y_max)
+
+    @staticmethod
+    def _compute_y_range(data_set, chunk_size=2**20):
+        # Column wise min/max of a hdf5 data set, reading only a few rows at a time
+        n_rows, n_cols = data_set.shape
+        rows_per_chunk = max(chunk_size // max(n_cols, 1), 1)
+        y_min = np.full(n_cols, np.inf)
+        y_max = np.full(n_cols, -np.inf)
+        for start in range(0, n_rows, rows_per_chunk):
+            chunk = data_set[start:start + rows_per_chunk]
+            y_min = np.fmin(y_min, np.nanmin(chunk, axis=0))
+            y_max = np.fmax(y_max, np.nanmax(chunk, axis=0))
+        return y_min, y_max
+
+    def _clear_y_range(self, f, data_set_type, data_set_name):
+        data_set = f[data_set_type][data_set_name]
+        for k in ['y_min', 'y_max']:
+            if k in data_set.attrs:
+                del data_set.attrs[k]
+        self.y_range_cache.pop((data_set_type, data_set_name), None)
+
+    def add_events(self, data_set_type, data_set_name, event_type, events, parameters=None, replace_rois=None):
+        # Store an event table (numpy structured array with at least the fields 'roi' and 'time') of a data set.
+        # Every field is stored as its own column, sorted by ROI and time. Two indices are added:
+        #   roi_ptr: events of ROI k are rows roi_ptr[k]:roi_ptr[k+1]
+        #   time_order: row numbers sorted by time (over all ROIs)
+        # replace_rois=None replaces the whole table, otherwise only the events of these ROIs are replaced.
+        with h5py.File(self.temp_file_name, 'r+') as f:
+            if data_set_name not in f[data_set_type]:
+                print('ERROR: Data set not found!')
+                return
+            n_rois = f[data_set_type][data_set_name].shape[1]
+            group = f.require_group('events').require_group(data_set_type).require_group(data_set_name)
+            if replace_rois is not None and event_type in group:
+                old_events = self._read_events(group[event_type])
+                if old_events.dtype == events.dtype:
+                    keep = np.isin(old_events['roi'], replace_rois, invert=True)
+                    events = np.concatenate([old_events[keep], events])
+                else:
+                    print('WARNING: Event fields do not match, replacing the entire event table!')
+            if parameters is None and event_type in group:
+                parameters = dict(group[event_type].attrs)
+            self._write_events(group, event_type, events, n_rois, parameters)
+
+    @staticmethod
+    def _write_events(group, event_type, events, n_rois, parameters=None):
+        if event_type in group:
+            del group[event_type]
+        events = events[np.lexsort((events['time'], events['roi']))]
+        table = group.create_group(event_type)
+        chunks = True if events.shape[0] > 0 else None
+        for field in events.dtype.names:
+            table.create_dataset(field, data=events[field], chunks=chunks)
+        roi_ptr = np.searchsorted(events['roi'], np.arange(n_rois + 1), side='left')
+        table.create_dataset('roi_ptr', data=roi_ptr.astype('i8'))
+        table.create_dataset('time_order', data=np.argsort(events['time'], kind='stable').astype('i8'), chunks=chunks)
+        # Field names in their original order (the group itself is sorted alphabetically)
+        table.attrs['fields'] = list(events.dtype.names)
+        # Store the used parameters (None: parameter was not used)
+        if parameters is not None:
+            for k in parameters:
+                if parameters[k] is not None and k != 'fields':
+                    table.attrs[k] = parameters[k]
+
+    @staticmethod
+    def _read_events(table, rows=slice(None)):
+        # Read rows (slice or sorted index array) of all fields of an event table into a numpy structured array
+        fields = [str(k) for k in table.attrs['fields']]
+        if isinstance(rows, np.ndarray) and rows.shape[0] == 0:
+            rows = slice(0, 0)
+        columns = [table[k][rows] for k in fields]
+        events = np.empty(columns[0].shape[0], dtype=[(k, c.dtype) for k, c in zip(fields, columns)])
+        for k, c in zip(fields, columns):
+            events[k] = c
+        return events
+
+    def _get_event_table(self, f, data_set_type, data_set_name, event_type):
+        try:
+            return f['events'][data_set_type][data_set_name][event_type]
+        except KeyError:
+            print(f'ERROR: No {event_type} events found for this data set!')
+            return None
+
+    def get_event_types(self, data_set_type, data_set_name):
+        with h5py.File(self.temp_file_name, 'r') as f:
+            if 'events' in f and data_set_type in f['events'] and data_set_name in f['events'][data_set_type]:
+                return list(f['events'][data_set_type][data_set_name].keys())
+            return []
+
+    def get_events(self, data_set_type, data_set_name, event_type, roi_idx=None, t_start=None, t_end=None):
+        # Get the events of one ROI (roi_idx) or of all ROIs (roi_idx=None), optionally only in a time window.
+        # Only the matching rows are read from the file.
+        with h5py.File(self.temp_file_name, 'r') as f:
+            table = self._get_event_table(f, data_set_type, data_set_name, event_type)
+            if table is None:
+                return None
+            if roi_idx is not None:
+                roi_ptr = table['roi_ptr']
+                if roi_idx < 0 or roi_idx >= roi_ptr.shape[0] - 1:
+                    print('ERROR: ROI not found!')
+                    return None
+                start, end = roi_ptr[roi_idx:roi_idx + 2]
+                if t_start is not None or t_end is not None:
+                    # Events of one ROI are sorted by time
+                    times = table['time'][start:end]
+                    lo = np.searchsorted(times, -np.inf if t_start is None else t_start, side='left')
+                    hi = np.searchsorted(times, np.inf if t_end is None else t_end, side='right')
+                    start, end = start + lo, start + hi
+                return self._read_events(table, slice(start, end))
+
+            if t_start is None and t_end is None:
+                return self._read_events(table)
+            time_order = table['time_order'][:]
+            sorted_times = table['time'][:][time_order]
+            lo = np.searchsorted(sorted_times, -np.inf if t_start is None else t_start, side='left')
+            hi = np.searchsorted(sorted_times, np.inf if t_end is None else t_end, side='right')
+            # h5py needs increasing indices, the result is still sorted by ROI and time
+            return self._read_events(table, np.sort(time_order[lo:hi]))
+
+    def get_event_counts(self, data_set_type, data_set_name, event_type):
+        # Number of events per ROI (straight from the ROI index, no events have to be read)
+        with h5py.File(self.temp_file_name, 'r') as f:
+            table = self._get_event_table(f, data_set_type, data_set_name, event_type)
+            if table is None:
+                return None
+            return np.diff(table['roi_ptr'][:])
+
+    def get_event_raster(self, data_set_type, data_set_name, event_type, t_start=None, t_end=None):
+        # Event times of every ROI as a list of arrays (e.g. for raster plots or peri-event analyses)
+        events = self.get_events(data_set_type, data_set_name, event_type, t_start=t_start, t_end=t_end)
+        if events is None:
+            return None
+        n_rois = self.get_data_set_layout(data_set_type, data_set_name)[0][1]
+        roi_ptr = np.searchsorted(events['roi'], np.arange(n_rois + 1), side='left')
+        return np.split(events['time'], roi_ptr[1:-1])
+
+    def _delete_events_of_roi(self, f, data_set_type, data_set_name, roi_idx):
+        # Remove the events of a deleted ROI (column) and shift the ROI numbers of the following ROIs
+        if 'events' not in f or data_set_type not in f['events'] or data_set_name not in f['events'][data_set_type]:
+            return
+        group = f['events'][data_set_type][data_set_name]
+        n_rois = f[data_set_type][data_set_name].shape[1]
+        for event_type in list(group.keys()):
+            parameters = dict(group[event_type].attrs)
+            events = self._read_events(group[event_type])
+            events = events[events['roi'] != roi_idx]
+            events['roi'][events['roi'] > roi_idx] -= 1
+            self._write_events(group, event_type, events, n_rois, parameters)
+
     def save_file(self, file_dir):
         shutil.copyfile(self.temp_file_name, file_dir)
 
     def open_file(self, file_dir):
         shutil.copyfile(file_dir, self.temp_file_name)
+        self.y_range_cache = dict()
 
     def new_file(self):
         self.create_new_temp_hdf5_file()
@@ -245,6 +521,39 @@ class DataHandler(QObject):
                 return None
 
 
+class TraceProvider:
+    """ Lazy access to single traces (columns) of a data set
+
+    Only the requested trace is read from the hdf5 file and the y offset is only applied to this trace.
+    That's how you get a trace:
+        provider = TraceProvider(data_handler, 'data_sets', 'set_01')
+        trace = provider.get_trace(roi_idx=0)
+    """
+    def __init__(self, data_handler, data_set_type, data_set_name, apply_y_offset=True):
+        self.data_handler = data_handler
+        self.data_set_type = data_set_type
+        self.data_set_name = data_set_name
+        meta_data = data_handler.get_data_set_meta_data(data_set_type, data_set_name)
+        (self.n_samples, self.n_traces), _ = data_handler.get_data_set_layout(data_set_type, data_set_name)
+        self.fr = meta_data['sampling_rate']
+        self.y_offset = meta_data['y_offset'] if apply_y_offset else 0
+
+    def get_trace(self, roi_idx):
+        # Global data sets might have less columns than there are ROIs
+        roi_idx = roi_idx % self.n_traces
+        trace = self.data_handler.get_roi_block(self.data_set_type, self.data_set_name, roi_idx, roi_idx + 1)
+        return trace[:, 0] + self.y_offset
+
+    def get_trace_slice(self, roi_idx, start_idx, end_idx):
+        # Only the samples start_idx:end_idx of one trace
+        roi_idx = roi_idx % self.n_traces
+        for _, chunk in self.data_handler.iter_chunks(
+                self.data_set_type, self.data_set_name, start_idx, end_idx, cols=[roi_idx],
+                rows_per_chunk=max(end_idx - start_idx, 1)):
+            return chunk[:, 0] + self.y_offset
+        return np.empty(0)
+
+
 class TransformData(QObject):
     signal_data_transformed = pyqtSignal()
 
@@ -1,3 +1,4 @@
+import numpy as np
 import pyqtgraph as pg
 # from IPython import embed
 
@@ -14,9 +15,97 @@ class PyqtgraphSettings:
     pg.setConfigOption('imageAxisOrder', 'row-major')
 
 
+class LodPyramid:
+    """ Level of detail (LOD) pyramid for a block of traces
+
+    Level k holds the min and the max of consecutive bins of 2**k samples for every trace. Plotting the min and max
+    values of a bin alternately keeps every peak visible while only a few points per screen pixel have to be drawn.
+    The time axis is the same as in TransformData.compute_time_axis().
+
+    :param data: numpy array (columns: traces, rows: data points over time)
+    :param fr: sampling rate in Hz
+    :param time_offset: time offset in seconds
+    :param min_bins: the coarsest level still has at least this many bins
+    """
+    def __init__(self, data, fr, time_offset=0, min_bins=512):
+        self.data = data
+        self.fr = fr
+        self.time_offset = time_offset
+        self.n_samples = data.shape[0]
+        self.n_traces = data.shape[1]
+        # Time step between two samples (same as np.linspace(0, n/fr, n))
+        if self.n_samples > 1:
+            self.dt = (self.n_samples / fr) / (self.n_samples - 1)
+        else:
+            self.dt = 1 / fr
+
+        # Each level: (bin_size, bin_min, bin_max)
+        self.levels = []
+        bin_min, bin_max = data, data
+        bin_size = 1
+        while bin_min.shape[0] // 2 >= min_bins:
+            if bin_min.shape[0] % 2 == 1:
+                # Repeat the last bin so that it can be paired
+                bin_min = np.concatenate([bin_min, bin_min[-1:]], axis=0)
+                bin_max = np.concatenate([bin_max, bin_max[-1:]], axis=0)
+            bin_min = np.minimum(bin_min[0::2], bin_min[1::2])
+            bin_max = np.maximum(bin_max[0::2], bin_max[1::2])
+            bin_size *= 2
+            self.levels.append((bin_size, bin_min, bin_max))
+
+    def get_time_range(self):
+        return self.time_offset, self.time_offset + (self.n_samples - 1) * self.dt
+
+    def get_spacing(self):
+        # Vertical distance between stacked traces: median peak to peak amplitude of all traces
+        if len(self.levels) > 0:
+            _, bin_min, bin_max = self.levels[-1]
+        else:
+            bin_min, bin_max = self.data, self.data
+        ptp = np.nanmax(bin_max, axis=0) - np.nanmin(bin_min, axis=0)
+        spacing = np.nanmedian(ptp)
+        if not np.isfinite(spacing) or spacing <= 0:
+            spacing = 1
+        return spacing * 1.1
+
+    def get_window(self, t_start, t_end, n_pixels):
+        # Returns the time axis and the traces inside the time window [t_start, t_end] using the coarsest level that
+        # still has at least one bin per pixel
+        i_start = int(np.floor((t_start - self.time_offset) / self.dt))
+        i_end = int(np.ceil((t_end - self.time_offset) / self.dt)) + 1
+        i_start = min(max(i_start, 0), self.n_samples)
+        i_end = min(max(i_end, 0), self.n_samples)
+        if i_end - i_start < 2:
+            return None, None
+
+        bin_size, bin_min, bin_max = 1, None, None
+        for level in self.levels:
+            if (i_end - i_start) / level[0] < n_pixels:
+                break
+            bin_size, bin_min, bin_max = level
+
+        if bin_size == 1:
+            t = np.arange(i_start, i_end) * self.dt + self.time_offset
+            return t, self.data[i_start:i_end]
+
+        b_start = i_start // bin_size
+        b_end = min(-(-i_end // bin_size), bin_min.shape[0])
+        t_bins = np.arange(b_start, b_end) * bin_size * self.dt + self.time_offset
+        # Alternate min and max of each bin
+        t = np.empty(2 * t_bins.shape[0])
+        t[0::2] = t_bins
+        t[1::2] = t_bins + 0.5 * bin_size * self.dt
+        y = np.empty((2 * t_bins.shape[0], self.n_traces), dtype=bin_min.dtype)
+        y[0::2] = bin_min[b_start:b_end]
+        y[1::2] = bin_max[b_start:b_end]
+        return t, y
+
+
 class DataPlotter:
     def __init__(self, master_plot):
         self.master_plot = master_plot
+        self.stacked_item = None
+        self.video_cursor = None
 
     def clear_plot_data(self, name):
         # check if there is already roi data plotted and remove it
@@ -27,15 +116,79 @@ class DataPlotter:
                     self.master_plot.removeItem(item)
 
     def update_video_plot(self, time_point, y_range):
-        self.clear_plot_data(name='video')
-        plot_data_item = pg.PlotDataItem(
-            [time_point, time_point], [y_range[0], y_range[1]],
-            pen=pg.mkPen(color=(255, 0, 255)),
-            name=f'video_time',
+        # The cursor line is only created once, after that the existing item is moved
+        if self.video_cursor is None or self.video_cursor.scene() is None:
+            self.video_cursor = pg.PlotDataItem(
+                [time_point, time_point], [y_range[0], y_range[1]],
+                pen=pg.mkPen(color=(255, 0, 255)),
+                name=f'video_time',
+                skipFiniteCheck=True,
+                tip=None,
+            )
+            # Add plot item to the plot widget
+            self.master_plot.addItem(self.video_cursor)
+        else:
+            self.video_cursor.setData([time_point, time_point], [y_range[0], y_range[1]])
+
+    def clear_video_plot(self):
+        if self.video_cursor is not None:
+            self.master_plot.removeItem(self.video_cursor)
+            self.video_cursor = None
+
+    def update_stacked(self, pyramid, spacing, color='#000000', lw=1, reset_range=False):
+        # Draw all traces of the LOD pyramid stacked with a vertical offset as one single path (one graphics item).
+        # Only the visible time window is drawn, so this has to be called again when the view range changes.
+        if reset_range:
+            t_start, t_end = pyramid.get_time_range()
+        else:
+            t_start, t_end = self.master_plot.vb.viewRange()[0]
+        n_pixels = max(int(self.master_plot.vb.width()), 100)
+        t, y = pyramid.get_window(t_start, t_end, n_pixels)
+        if t is None:
+            return
+
+        n_points, n_traces = y.shape
+        # First trace on top
+        offsets = (n_traces - 1 - np.arange(n_traces)) * spacing
+        x = np.tile(t, n_traces)
+        y = (y + offsets).T.ravel()
+        # Do not connect the last point of a trace with the first point of the next trace
+        connect = np.ones(x.shape[0], dtype=bool)
+        connect[n_points - 1::n_points] = False
+
+        if self.stacked_item is None or self.stacked_item.scene() is None:
+            self.clear_plot_data(name='data')
+            self.stacked_item = pg.PlotDataItem(
+                x, y,
+                pen=pg.mkPen(color=color, width=lw),
+                name='data_stacked',
+                connect=connect,
+                skipFiniteCheck=True,
+                tip=None,
+            )
+            self.master_plot.addItem(self.stacked_item)
+        else:
+            self.stacked_item.setPen(pg.mkPen(color=color, width=lw))
+            self.stacked_item.setData(x, y, connect=connect)
+
+        if reset_range:
+            self.master_plot.vb.setXRange(t_start, t_end, padding=0)
+
+    def update_events(self, times, values):
+        # Draw the stored events of all selected data sets as one scatter item
+        self.clear_plot_data(name='stored_events')
+        if len(times) == 0:
+            return
+        plot_data_item = pg.ScatterPlotItem(
+            np.concatenate(times), np.concatenate(values),
+            pen=pg.mkPen(color=(255, 128, 0)),
+            brush=pg.mkBrush(color=(255, 128, 0)),
+            size=15,
+            symbol='t',
+            name='stored_events',
             skipFiniteCheck=True,
             tip=None,
         )
-        # Add plot item to the plot widget
         self.master_plot.addItem(plot_data_item)
 
     def update(self, time_axis, data, meta_data=None):
@@ -189,8 +189,17 @@ class MainWindow(QMainWindow):
         self.tools_menu_convert_ventral_root = self.tools_menu.addAction('Convert Ventral Root Files')
         self.tools_menu_create_stimulus = self.tools_menu.addAction('Create Stimulus From File')
         self.tools_menu_detect_vr = self.tools_menu.addAction('Ventral Root Event Detection')
+        self.tools_menu_detect_vr_batch = self.tools_menu.addAction('Batch Ventral Root Event Detection')
         self.tools_menu_detect_peaks = self.tools_menu.addAction('Peak Detection')
 
+        # View Menu
+        self.view_menu = self.menu.addMenu('View')
+        self.view_menu_stacked = self.view_menu.addAction('Stacked ROIs')
+        self.view_menu_stacked.setCheckable(True)
+        self.view_menu_events = self.view_menu.addAction('Stored Events')
+        self.view_menu_events.setCheckable(True)
+        self.view_menu_refresh_stats = self.view_menu.addAction('Plot Refresh Statistics')
+
     def show_context_menu(self, pos):
         # Show context menu at the position of the mouse cursor
         self.data_sets_list_context_menu.exec(self.data_sets_list.mapToGlobal(pos))
@@ -261,12 +270,14 @@ class InputDialog(QDialog):
             self._set_gui_stimulus_dialog()
         elif self.dialog_type == 'ds':
             self._set_gui_ds_dialog()
+        elif self.dialog_type == 'cut_selection':
+            self._set_gui_cut_selection_dialog()
 
     def get_input(self):
         # Return the entered settings
         output = dict()
         for k in self.fields:
-            if k == 'is_global':
+            if isinstance(self.fields[k], QCheckBox):
                 output[k] = self.fields[k].isChecked()
             else:
                 output[k] = self.fields[k].text()
@@ -286,6 +297,23 @@ class InputDialog(QDialog):
         self.add_ok_cancel_buttons(layout)
         self.setLayout(layout)
 
+    def _set_gui_cut_selection_dialog(self):
+        self.setWindowTitle("Save Selection")
+        layout = QVBoxLayout()
+        # Create input fields
+        self.fields['tag'] = QLineEdit()
+        self.fields['all_rois'] = QCheckBox()
+
+        # Add labels
+        layout.addWidget(QLabel("Tag:"))
+        layout.addWidget(self.fields['tag'])
+        layout.addWidget(QLabel("Export all ROIs:"))
+        layout.addWidget(self.fields['all_rois'])
+
+        # Add OK and Cancel buttons
+        self.add_ok_cancel_buttons(layout)
+        self.setLayout(layout)
+
     def _set_gui_moving_average_dialog(self):
         self.setWindowTitle("Settings")
 
@@ -2,9 +2,9 @@ import pyqtgraph as pg
 import numpy as np
 from PyQt6.QtCore import pyqtSignal, QObject, Qt
 from PyQt6.QtWidgets import QVBoxLayout, QSlider, QLabel, QWidget, QSpacerItem, QSizePolicy, QMessageBox, QDialog, QPushButton
-from scipy import signal
 # from IPython import embed
 from roibaview.gui import BrowseFileDialog
+from roibaview.peak_tables import batch_find_peaks, PeakCandidates
 import pandas as pd
 
 
@@ -14,13 +14,18 @@ class PeakDetection(QDialog):
     signal_roi_changed = pyqtSignal(int)
     main_window_closing = pyqtSignal()
 
-    def __init__(self, data, fr, master_plot, roi, parent=None):
+    def __init__(self, trace_provider, master_plot, roi, scheduler=None, parent=None):
         # QWidget.__init__(self)
         super().__init__(parent)
+        # Optional RefreshScheduler to merge fast slider changes into one redraw per frame
+        self.scheduler = scheduler
         self.roi_idx = roi
-        self.data = data  # this is the data set
-        self.data_trace = self.data[:, self.roi_idx]  # this is the roi trace
-        self.fr = fr
+        # The trace provider only loads the trace of the current ROI (not the entire data set)
+        self.trace_provider = trace_provider
+        self.data_trace = self.trace_provider.get_trace(self.roi_idx)  # this is the roi trace
+        # All local maxima of the trace with their properties (computed only once per trace)
+        self.candidates = PeakCandidates(self.data_trace)
+        self.fr = self.trace_provider.fr
         self.time_axis = self.compute_time_axis(self.data_trace.shape[0], self.fr)
         self.master_plot = master_plot
         self.parameters = dict()
@@ -46,6 +51,23 @@ class PeakDetection(QDialog):
                 result[k] = self.peaks['props'][k]
             result.to_csv(file_dir)
 
+    def batch_detection(self):
+        # Run the current parameter set over every ROI of the data set and store the peak table in the session file
+        provider = self.trace_provider
+        print('Peak Detection: Detecting peaks in all ROIs ...')
+        peak_table = batch_find_peaks(provider.data_handler, provider.data_set_type, provider.data_set_name, self.parameters)
+        if peak_table is None:
+            return
+        provider.data_handler.add_events(
+            provider.data_set_type, provider.data_set_name, 'peaks', peak_table, parameters=self.parameters)
+        print(f'Peak Detection: Found {peak_table.shape[0]} peaks (stored in session file)')
+
+        # Optionally export it as csv file
+        file_browser = BrowseFileDialog(self)
+        file_dir = file_browser.save_file_name('csv file, (*.csv)')
+        if file_dir:
+            pd.DataFrame(peak_table).to_csv(file_dir, index=False)
+
     @staticmethod
     def compute_time_axis(data_size, fr):
         max_time = data_size / fr
@@ -58,7 +80,8 @@ class PeakDetection(QDialog):
     def roi_changed(self, new_roi_idx):
         print('ROI CHANGED')
         self.roi_idx = new_roi_idx
-        self.data_trace = self.data[:, self.roi_idx]
+        self.data_trace = self.trace_provider.get_trace(self.roi_idx)
+        self.candidates = PeakCandidates(self.data_trace)
         self.peaks['times'], self.peaks['idx'], self.peaks['props'] = self.find_peaks(parameters=self.parameters)
         self.update_plot()
 
@@ -91,6 +114,10 @@ class PeakDetection(QDialog):
         self.export_button.clicked.connect(self.export_peaks)
         layout.addWidget(self.export_button)
 
+        self.batch_button = QPushButton('Detect in all ROIs...')
+        self.batch_button.clicked.connect(self.batch_detection)
+        layout.addWidget(self.batch_button)
+
         self.setLayout(layout)
         self.setWindowTitle("Peak Detection Parameters")
         # self.show()
@@ -105,11 +132,11 @@ class PeakDetection(QDialog):
         parameters = self.parameters
         if value is not None:
             if param_name == 'height':
-                parameters[param_name] = self.map_range(value, self.min_range, self.max_range, 0, np.max(self.data_trace))
+                parameters[param_name] = self.map_range(value, self.min_range, self.max_range, 0, self.candidates.max)
             if param_name == 'threshold':
-                parameters[param_name] = self.map_range(value, self.min_range, self.max_range, 0, np.max(self.data_trace)*0.1)
+                parameters[param_name] = self.map_range(value, self.min_range, self.max_range, 0, self.candidates.max*0.1)
             if param_name == 'prominence':
-                parameters[param_name] = self.map_range(value, self.min_range, self.max_range, 0, np.max(self.data_trace)*0.25)
+                parameters[param_name] = self.map_range(value, self.min_range, self.max_range, 0, self.candidates.max*0.25)
             if param_name == 'distance':
                 parameters[param_name] = self.map_range(value, self.min_range, self.max_range, 1, self.data_trace.shape[0]*0.5)
             if param_name == 'width':
@@ -120,10 +147,14 @@ class PeakDetection(QDialog):
         # Update Value Label
         self.parameters_labels[param_name].setText(f'{parameters[param_name]:.2f}')
 
-        # Update find peaks
-        self.peaks['times'], self.peaks['idx'], self.peaks['props'] = self.find_peaks(parameters)
+        # Update find peaks and plot (only once per frame while the slider is dragged)
+        if self.scheduler is not None:
+            self.scheduler.request('peak_detection', self.update_peaks)
+        else:
+            self.update_peaks()
 
-        # Update Plot
+    def update_peaks(self):
+        self.peaks['times'], self.peaks['idx'], self.peaks['props'] = self.find_peaks(self.parameters)
         self.update_plot()
 
     def clear_plot(self):
@@ -176,7 +207,8 @@ class PeakDetection(QDialog):
         return mapped_value
 
     def find_peaks(self, parameters):
-        peaks, props = signal.find_peaks(self.data_trace, **parameters)
+        # Select the peaks from the precomputed candidates (same result as signal.find_peaks(self.data_trace, ...))
+        peaks, props = self.candidates.select(**parameters)
         peaks_time = peaks / self.fr
         return peaks_time, peaks, props
 
@@ -190,6 +222,8 @@ class PeakDetection(QDialog):
 
             if reply == QMessageBox.StandardButton.Yes:
                 # Here you can perform actions before closing the window
+                if self.scheduler is not None:
+                    self.scheduler.cancel('peak_detection')
                 self.clear_plot()
                 self.done(QDialog.DialogCode.Accepted)
                 event.accept()
@@ -0,0 +1,255 @@
+import numpy as np
+from scipy import signal
+
+# One row per detected peak
+PEAK_TABLE_DTYPE = np.dtype([
+    ('roi', 'i4'),
+    ('idx', 'i8'),
+    ('time', 'f8'),
+    ('height', 'f8'),
+    ('prominence', 'f8'),
+    ('left_base', 'i8'),
+    ('right_base', 'i8'),
+    ('width', 'f8'),
+    ('left_ip', 'f8'),
+    ('right_ip', 'f8'),
+])
+
+# One row per ventral root event (idx and time refer to the onset)
+VR_EVENT_DTYPE = np.dtype([
+    ('roi', 'i4'),
+    ('idx', 'i8'),
+    ('time', 'f8'),
+    ('offset_idx', 'i8'),
+    ('offset_time', 'f8'),
+    ('duration', 'f8'),
+])
+
+
+def vr_event_table(vr_events, roi):
+    """ Convert the ventral root events of one ROI (dict of VentralRootDetection) into an event table
+
+    :return: event table (numpy structured array, see VR_EVENT_DTYPE)
+    """
+    table = np.empty(len(vr_events['onset_idx']), dtype=VR_EVENT_DTYPE)
+    table['roi'] = roi
+    table['idx'] = vr_events['onset_idx']
+    table['time'] = vr_events['onset_times']
+    table['offset_idx'] = vr_events['offset_idx']
+    table['offset_time'] = vr_events['offset_times']
+    table['duration'] = table['offset_time'] - table['time']
+    return table
+
+
+def find_vr_event_edges(binary):
+    """ Onset and offset indices of all active (non-zero) stretches of a binary trace
+
+    Onsets are the samples before the trace becomes active, offsets are the last active samples (same as
+    np.diff(binary, append=0)). A trace that is already active at the first sample gets an onset at index 0 and a trace
+    that is still active at the end gets an offset at the last sample, so there is always one offset per onset.
+    """
+    binary = np.asarray(binary) > 0
+    edges = np.diff(binary.astype(np.int8), append=0)
+    onset_idx = np.flatnonzero(edges > 0)
+    offset_idx = np.flatnonzero(edges < 0)
+    if binary.shape[0] > 0 and binary[0]:
+        onset_idx = np.concatenate([[0], onset_idx])
+    return onset_idx, offset_idx
+
+
+def merge_vr_events(onset_idx, offset_idx, dt, duration_th_secs, minimal_event_distance):
+    """ Remove too long events and merge events that are close to each other
+
+    :param onset_idx: onset indices (sorted, one offset per onset)
+    :param offset_idx: offset indices
+    :param dt: time between two samples in secs
+    :param duration_th_secs: events longer than this (in secs) are removed
+    :param minimal_event_distance: events with a gap of less than or equal to this (in secs) to the previous event
+        are merged
+    :return: merged onset indices, merged offset indices
+    """
+    onset_idx = np.asarray(onset_idx, dtype=np.int64)
+    offset_idx = np.asarray(offset_idx, dtype=np.int64)
+    if onset_idx.shape[0] != offset_idx.shape[0]:
+        print('WARNING: Number of onset times and offset times do not match!')
+        n = min(onset_idx.shape[0], offset_idx.shape[0])
+        onset_idx, offset_idx = onset_idx[:n], offset_idx[:n]
+
+    # Check for motor activity that is too long (artifacts due to concatenating recordings) and remove it
+    keep = (offset_idx - onset_idx) * dt <= duration_th_secs
+    onset_idx = onset_idx[keep]
+    offset_idx = offset_idx[keep]
+    if onset_idx.shape[0] == 0:
+        return onset_idx, offset_idx
+
+    # A new group starts at every event whose gap to the previous event is larger than the minimal distance
+    gaps = (onset_idx[1:] - offset_idx[:-1]) * dt
+    group_starts = np.flatnonzero(np.concatenate([[True], gaps > minimal_event_distance]))
+    merged_onset_idx = onset_idx[group_starts]
+    merged_offset_idx = np.maximum.reduceat(offset_idx, group_starts)
+    return merged_onset_idx, merged_offset_idx
+
+
+def find_peaks_block(block, fr, parameters, first_roi=0, y_offset=0):
+    """ Run scipy.signal.find_peaks with the same parameters on every column (ROI) of a block
+
+    :param block: numpy array (columns: ROIs, rows: data points over time)
+    :param fr: sampling rate in Hz
+    :param parameters: find_peaks parameters (height, threshold, distance, prominence, width), None means not used
+    :param first_roi: ROI index of the first column of the block
+    :param y_offset: added to the data before detecting peaks (same as in the plot)
+    :return: peak table (numpy structured array, see PEAK_TABLE_DTYPE)
+    """
+    params = dict(parameters)
+    # Prominences and widths are always computed. A minimum of 0 does not remove any peak.
+    if params.get('prominence') is None:
+        params['prominence'] = 0
+    if params.get('width') is None:
+        params['width'] = 0
+
+    tables = []
+    for k in range(block.shape[1]):
+        trace = block[:, k] + y_offset
+        peaks, props = signal.find_peaks(trace, **params)
+        table = np.empty(peaks.shape[0], dtype=PEAK_TABLE_DTYPE)
+        table['roi'] = first_roi + k
+        table['idx'] = peaks
+        table['time'] = peaks / fr
+        table['height'] = trace[peaks]
+        table['prominence'] = props['prominences']
+        table['left_base'] = props['left_bases']
+        table['right_base'] = props['right_bases']
+        table['width'] = props['widths']
+        table['left_ip'] = props['left_ips']
+        table['right_ip'] = props['right_ips']
+        tables.append(table)
+
+    if len(tables) == 0:
+        return np.empty(0, dtype=PEAK_TABLE_DTYPE)
+    return np.concatenate(tables)
+
+
+def batch_find_peaks(data_handler, data_set_type, data_set_name, parameters, block_size=32, n_jobs=-2):
+    """ Detect peaks in all ROIs of a data set with the same parameter set
+
+    The data set is read block by block (block_size ROIs at a time) and the blocks are processed in parallel.
+    Only as many blocks as there are workers are kept in memory at the same time.
+    Note: Parameters are used as absolute values (e.g. the height is not rescaled for every ROI).
+
+    :return: peak table of all ROIs (numpy structured array, see PEAK_TABLE_DTYPE)
+    """
+    from joblib import Parallel, delayed, effective_n_jobs
+    meta_data = data_handler.get_data_set_meta_data(data_set_type, data_set_name)
+    layout = data_handler.get_data_set_layout(data_set_type, data_set_name)
+    if meta_data is None or layout is None:
+        return None
+    n_rois = layout[0][1]
+    fr = meta_data['sampling_rate']
+    y_offset = meta_data['y_offset']
+    block_starts = list(range(0, n_rois, block_size))
+    n_workers = max(effective_n_jobs(n_jobs), 1)
+
+    tables = []
+    with Parallel(n_jobs=n_jobs) as parallel:
+        for k in range(0, len(block_starts), n_workers):
+            starts = block_starts[k:k + n_workers]
+            blocks = [data_handler.get_roi_block(data_set_type, data_set_name, s, s + block_size) for s in starts]
+            tables.extend(parallel(
+                delayed(find_peaks_block)(b, fr, parameters, first_roi=s, y_offset=y_offset)
+                for s, b in zip(starts, blocks)
+            ))
+            print(f'Peak Detection: {min(starts[-1] + block_size, n_rois)} / {n_rois} ROIs')
+
+    if len(tables) == 0:
+        return np.empty(0, dtype=PEAK_TABLE_DTYPE)
+    return np.concatenate(tables)
+
+
+class PeakCandidates:
+    """ Candidate index of all local maxima of one trace
+
+    Heights, thresholds, prominences and widths of all local maxima are computed once. After that, selecting the peaks
+    for a set of find_peaks parameters is only a few numpy masks (same results as scipy.signal.find_peaks with scalar
+    minimum values). The distance criterion keeps the highest peaks first, ties in the same order as find_peaks.
+
+    :param trace: 1D numpy array
+    """
+    def __init__(self, trace):
+        self.trace = trace
+        self.max = np.max(trace)
+        self.peaks, _ = signal.find_peaks(trace)
+        self.heights = trace[self.peaks]
+
+        if self.peaks.shape[0] > 0:
+            # Vertical distance to the direct neighbours (the "threshold" of find_peaks)
+            self.left_thresholds = self.heights - trace[self.peaks - 1]
+            self.right_thresholds = self.heights - trace[self.peaks + 1]
+            self.prominences, self.left_bases, self.right_bases = signal.peak_prominences(trace, self.peaks)
+            self.widths, self.width_heights, self.left_ips, self.right_ips = signal.peak_widths(
+                trace, self.peaks, rel_height=0.5,
+                prominence_data=(self.prominences, self.left_bases, self.right_bases)
+            )
+        else:
+            self.left_thresholds = self.right_thresholds = np.empty(0)
+            self.prominences = self.width_heights = self.widths = self.left_ips = self.right_ips = np.empty(0)
+            self.left_bases = self.right_bases = np.empty(0, dtype=int)
+        self.min_thresholds = np.minimum(self.left_thresholds, self.right_thresholds)
+        self._distance_cache = (None, None)
+
+    def _select_by_distance(self, keep, distance):
+        # Remove peaks that are closer than "distance" samples to a higher peak (greedy, highest peaks first)
+        key = (distance, keep.tobytes())
+        if self._distance_cache[0] == key:
+            return self._distance_cache[1].copy()
+
+        distance = np.ceil(distance)
+        candidates = np.flatnonzero(keep)
+        pos = self.peaks[candidates]
+        # Highest peaks first. Same sort as scipy (_select_by_peak_distance: np.argsort of the heights of the remaining
+        # peaks as float64, walked backwards), so peaks with the same height are taken in the same order
+        order = np.argsort(self.heights[candidates].astype(np.float64))[::-1]
+        selected = np.ones(candidates.shape[0], dtype=bool)
+        for j in order:
+            if not selected[j]:
+                continue
+            lo = np.searchsorted(pos, pos[j] - distance, side='right')
+            hi = np.searchsorted(pos, pos[j] + distance, side='left')
+            selected[lo:j] = False
+            selected[j + 1:hi] = False
+
+        result = np.zeros_like(keep)
+        result[candidates[selected]] = True
+        self._distance_cache = (key, result)
+        return result.copy()
+
+    def select(self, height=None, threshold=None, distance=None, prominence=None, width=None):
+        # Returns the peak indices and their properties (same keys as scipy.signal.find_peaks)
+        keep = np.ones(self.peaks.shape[0], dtype=bool)
+        if height is not None:
+            keep &= self.heights >= height
+        if threshold is not None:
+            keep &= self.min_thresholds >= threshold
+        if distance is not None:
+            keep = self._select_by_distance(keep, distance)
+        if prominence is not None:
+            keep &= self.prominences >= prominence
+        if width is not None:
+            keep &= self.widths >= width
+
+        idx = np.flatnonzero(keep)
+        props = dict()
+        if height is not None:
+            props['peak_heights'] = self.heights[idx]
+        if threshold is not None:
+            props['left_thresholds'] = self.left_thresholds[idx]
+            props['right_thresholds'] = self.right_thresholds[idx]
+        if prominence is not None or width is not None:
+            props['prominences'] = self.prominences[idx]
+            props['left_bases'] = self.left_bases[idx]
+            props['right_bases'] = self.right_bases[idx]
+        if width is not None:
+            props['widths'] = self.widths[idx]
+            props['width_heights'] = self.width_heights[idx]
+            props['left_ips'] = self.left_ips[idx]
+            props['right_ips'] = self.right_ips[idx]
+        return self.peaks[idx], props
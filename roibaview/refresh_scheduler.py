@@ -0,0 +1,74 @@
+import time
+import traceback
+import numpy as np
+from PyQt6.QtCore import QObject, QTimer
+
+
+class RefreshScheduler(QObject):
+    """ Merges plot refresh requests into at most one redraw per display frame
+
+    Every request has a key (e.g. 'roi', 'video', 'mouse'). If the same key is requested again before the next frame
+    is drawn, only the latest request is kept (latest state wins). All pending requests are then executed together.
+    The time needed for each redraw is collected in a histogram.
+
+    That's how you use it:
+        scheduler = RefreshScheduler(frame_interval_ms=16)
+        scheduler.request('roi', self.update_plots, False)
+    """
+    def __init__(self, frame_interval_ms=16, parent=None):
+        super().__init__(parent)
+        self.frame_interval_ms = frame_interval_ms
+        self.pending = dict()
+        self.last_flush = 0
+
+        # Single shot timer that fires at the next free display frame
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.flush)
+
+        # Histogram of measured frame times (in ms)
+        self.hist_bins = np.array([0, 1, 2, 4, 8, 16, 33, 50, 100, 250, 500, 1000, np.inf])
+        self.hist_counts = np.zeros(len(self.hist_bins) - 1, dtype=int)
+        self.dropped_requests = 0
+
+    def request(self, key, callback, *args):
+        if key in self.pending:
+            # This request replaces an older one that was not drawn yet
+            self.dropped_requests += 1
+        self.pending[key] = (callback, args)
+        if not self.timer.isActive():
+            # Do not redraw more often than once per display frame
+            since_last = (time.perf_counter() - self.last_flush) * 1000
+            self.timer.start(int(max(self.frame_interval_ms - since_last, 0)))
+
+    def flush(self):
+        pending = self.pending
+        self.pending = dict()
+        t0 = time.perf_counter()
+        for callback, args in pending.values():
+            # A failing refresh must not drop the other pending refreshes
+            try:
+                callback(*args)
+            except Exception:
+                print(f'ERROR: Plot refresh {getattr(callback, "__name__", callback)} failed:')
+                traceback.print_exc()
+        self.last_flush = time.perf_counter()
+
+        # Store the frame time
+        frame_time = (self.last_flush - t0) * 1000
+        idx = np.searchsorted(self.hist_bins, frame_time, side='right') - 1
+        self.hist_counts[min(idx, len(self.hist_counts) - 1)] += 1
+
+    def cancel(self, key):
+        self.pending.pop(key, None)
+
+    def frame_time_histogram(self):
+        # Returns the counts and the bin edges (in ms) of the measured frame times
+        return self.hist_counts.copy(), self.hist_bins.copy()
+
+    def frame_time_report(self):
+        counts, bins = self.frame_time_histogram()
+        lines = [f'Frames drawn: {np.sum(counts)}, merged requests: {self.dropped_requests}']
+        for k, c in enumerate(counts):
+            lines.append(f'{bins[k]:>6.0f} - {bins[k + 1]:>6.0f} ms: {c}')
+        return '\n'.join(lines)
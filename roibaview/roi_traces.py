@@ -0,0 +1,130 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+from scipy import sparse
+
+
+def roi_masks(rois, frame_shape):
+    """ Rasterize ImageJ ROIs into one sparse matrix (one row per ROI, one column per pixel)
+
+    Every row contains 1/n_pixels for all pixels of the ROI, so multiplying a frame (flattened) with the matrix gives
+    the mean value of every ROI. ROIs may overlap.
+
+    :param rois: list of roifile.ImagejRoi
+    :param frame_shape: (height, width) of the frames
+    :return: scipy.sparse.csr_matrix (n_rois, height * width)
+    """
+    height, width = frame_shape[:2]
+    rows = []
+    cols = []
+    values = []
+    for k, roi in enumerate(rois):
+        coordinates = np.array(roi.coordinates())
+        if len(coordinates) == 0:
+            continue
+        # Only rasterize the bounding box of the ROI
+        x_min, y_min = np.maximum(np.floor(coordinates.min(axis=0)).astype(int), 0)
+        x_max, y_max = np.minimum(np.ceil(coordinates.max(axis=0)).astype(int), [width - 1, height - 1])
+        if x_max < x_min or y_max < y_min:
+            continue
+        box = np.zeros((y_max - y_min + 1, x_max - x_min + 1), dtype=np.uint8)
+        points = np.round(coordinates - [x_min, y_min]).astype(np.int32)
+        cv2.fillPoly(box, [points], 1)
+        y, x = np.nonzero(box)
+        if y.shape[0] == 0:
+            continue
+        rows.append(np.full(y.shape[0], k))
+        cols.append((y + y_min) * width + (x + x_min))
+        values.append(np.full(y.shape[0], 1 / y.shape[0], dtype=np.float32))
+
+    if len(rows) == 0:
+        return sparse.csr_matrix((len(rois), height * width), dtype=np.float32)
+    return sparse.csr_matrix(
+        (np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(len(rois), height * width))
+
+
+def roi_label_grid(rois, frame_shape):
+    # Image of ROI numbers (ROI index + 1, 0: no ROI) to look up the ROI under the mouse. Overlapping ROIs: last one wins
+    height, width = frame_shape[:2]
+    grid = np.zeros((height, width), dtype=np.int32)
+    for k, roi in enumerate(rois):
+        coordinates = np.array(roi.coordinates())
+        if len(coordinates) == 0:
+            continue
+        cv2.fillPoly(grid, [np.round(coordinates).astype(np.int32)], k + 1)
+    return grid
+
+
+def roi_outline_path(rois):
+    # All ROI outlines as one line (x, y, connect): every outline is closed and not connected to the next one
+    outlines = [np.array(roi.coordinates()) for roi in rois]
+    outlines = [np.vstack([c, c[:1]]) for c in outlines if len(c) > 0]
+    if len(outlines) == 0:
+        return np.zeros(0), np.zeros(0), np.zeros(0, dtype=bool)
+    points = np.vstack(outlines)
+    connect = np.ones(points.shape[0], dtype=bool)
+    connect[np.cumsum([c.shape[0] for c in outlines]) - 1] = False
+    return points[:, 0], points[:, 1], connect
+
+
+def roi_centroids(rois):
+    # Median of the ROI coordinates (nan for empty ROIs)
+    centroids = np.full((len(rois), 2), np.nan)
+    for k, roi in enumerate(rois):
+        coordinates = np.array(roi.coordinates())
+        if len(coordinates) > 0:
+            centroids[k] = np.median(coordinates, axis=0)
+    return centroids
+
+
+def roi_names(rois):
+    # Names stored in the ROI file, or the ROI number if there is no name
+    return [roi.name if roi.name else str(k + 1) for k, roi in enumerate(rois)]
+
+
+def _block_means(frames, masks):
+    # frames: (n_frames, height, width) or (n_frames, height, width, colors) --> mean of every ROI (n_frames, n_rois)
+    frames = np.asarray(frames, dtype=np.float32)
+    if frames.ndim == 4:
+        # Color video: use the mean of all color channels
+        frames = frames.mean(axis=3)
+    return np.asarray(masks @ frames.reshape(frames.shape[0], -1).T).T
+
+
+def extract_roi_traces(get_frame, n_frames, masks, block_size=256, n_workers=None):
+    """ Mean value of every ROI in every frame
+
+    The frames are read block by block (in order, so videos are decoded sequentially) and every block is reduced with
+    one sparse matrix multiplication. The multiplications run in a thread pool while the next blocks are read.
+    Only a few blocks are in memory at the same time.
+
+    :param get_frame: function(frame index) that returns the frame (e.g. VideoFrameReader.get_frame)
+    :param n_frames: number of frames
+    :param masks: ROI masks (see roi_masks)
+    :return: traces, numpy array (n_frames, n_rois)
+    """
+    n_workers = n_workers or max((os.cpu_count() or 1) - 1, 1)
+    traces = np.zeros((n_frames, masks.shape[0]), dtype=np.float32)
+    pending = []
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        for start in range(0, n_frames, block_size):
+            end = min(start + block_size, n_frames)
+            frames = [get_frame(k) for k in range(start, end)]
+            if any(f is None for f in frames):
+                print(f'WARNING: Could not read all frames between {start} and {end}')
+                frames = [f for f in frames if f is not None]
+                end = start + len(frames)
+                if len(frames) == 0:
+                    break
+            pending.append((start, end, executor.submit(_block_means, np.stack(frames), masks)))
+            # Limit the number of blocks in memory
+            while len(pending) > 2 * n_workers:
+                s, e, future = pending.pop(0)
+                traces[s:e] = future.result()
+            print(f'ROI Traces: {end} / {n_frames} frames', end='\r')
+        for s, e, future in pending:
+            traces[s:e] = future.result()
+    print('')
+    return traces
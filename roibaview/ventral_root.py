@@ -1,7 +1,13 @@
 import os
+import json
+import time
+import hashlib
+import h5py
 import numpy as np
 import pandas as pd
 import pickle
+import scipy.signal as sig
+from roibaview.peak_tables import merge_vr_events
 
 
 def pickle_stuff(file_name, data=None):
@@ -20,8 +26,10 @@ def pickle_stuff(file_name, data=None):
 
 def convert_time_stamps_to_secs(data, method=0):
     if method == 0:
-        # INPUT: hhmmss.ms (163417.4532)
-        s = str(data)
+        # INPUT: hhmmss.ms (163417.4532), hours before 10 may have no leading zero (93417.4532)
+        s = str(data).strip()
+        hhmmss, dot, ms = s.partition('.')
+        s = hhmmss.zfill(6) + dot + ms
         in_secs = int(s[:2]) * 3600 + int(s[2:4]) * 60 + float(s[4:])
     elif method == 1:
         # INPUT: hh:mm:ss
@@ -32,67 +40,190 @@ def convert_time_stamps_to_secs(data, method=0):
     return in_secs
 
 
-def transform_ventral_root_recording(vr_files, vr_fr, first_file_missing=0):
-    # vr_files is a list of ventral root recording text files of one sweep
-    vr_files = list(np.sort(vr_files))
+def time_stamps_to_secs(time_stamps, method=0):
+    # Vectorized version of convert_time_stamps_to_secs for entire time stamp columns
+    if method == 0:
+        # INPUT: hhmmss.ms (163417.4532) as numbers
+        t = np.asarray(time_stamps, dtype=np.float64)
+        hours = t // 10000
+        minutes = (t // 100) % 100
+        secs = t - hours * 10000 - minutes * 100
+        return hours * 3600 + minutes * 60 + secs
+    elif method == 1:
+        # INPUT: hh:mm:ss strings
+        s = pd.Series(time_stamps, dtype=str)
+        return (s.str[:2].astype(int) * 3600 + s.str[3:5].astype(int) * 60 + s.str[6:].astype(float)).to_numpy()
+    else:
+        return None
+
+
+def timing_diagnostics(time_secs, vr_fr, gap_factor=1.5):
+    """ Timing check of one ventral root recording file
 
-    # Get First Recording Text File
-    f_name_01 = vr_files[0]
+    :param time_secs: time stamp of every sample in secs (see time_stamps_to_secs)
+    :param vr_fr: sampling rate in Hz
+    :param gap_factor: a step between two time stamps larger than gap_factor / vr_fr counts as dropped samples
+    :return: dict with n_samples, t_start, t_end, duration, expected_duration, n_gaps, n_dropped_samples,
+        max_jitter_ms (largest deviation from an ideal sample clock) and dt_std_ms
+    """
+    n = time_secs.shape[0]
+    result = dict(n_samples=n, t_start=np.nan, t_end=np.nan, duration=np.nan, expected_duration=n / vr_fr,
+                  n_gaps=0, n_dropped_samples=0, max_jitter_ms=np.nan, dt_std_ms=np.nan)
+    if n == 0:
+        return result
+    dt = np.diff(time_secs)
+    gaps = dt > gap_factor / vr_fr
+    ideal_clock = time_secs[0] + np.arange(n) / vr_fr
+    result['t_start'] = time_secs[0]
+    result['t_end'] = time_secs[-1]
+    result['duration'] = time_secs[-1] - time_secs[0] + 1 / vr_fr
+    result['n_gaps'] = int(np.sum(gaps))
+    result['n_dropped_samples'] = int(np.sum(np.round(dt[gaps] * vr_fr) - 1))
+    result['max_jitter_ms'] = np.max(np.abs(time_secs - ideal_clock)) * 1000
+    result['dt_std_ms'] = np.std(dt) * 1000 if n > 1 else 0
+    return result
 
-    # Load Text File
-    dummy_01 = pd.read_csv(f_name_01, sep='\t', header=None)
 
-    # Get the Voltage values
-    vr_values = dummy_01.iloc[:, 0].to_numpy()
+def scan_ventral_root_file(file_dir, vr_fr=None, chunk_size=2**20):
+    # Number of samples (lines) and the first and last time stamp (secs) of a ventral root text file.
+    # The time stamps come from the first and the last line only (seek to the end of the file). If all lines have the
+    # same length (fixed width records), the number of lines is file size / line length. This is only used if it also
+    # matches the time stamps (vr_fr: no dropped samples), otherwise the lines are counted (the whole file is read).
+    with open(file_dir, 'rb') as f:
+        first_line = f.readline()
+        # Read only the end of the file to get the last line
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(size - 4096, 0))
+        last_line = [line for line in f.read().splitlines(keepends=True) if line.strip()][-1]
+        # Same conversion as the old concatenation (text of the time stamp), so the gaps between the files get exactly
+        # the same number of samples
+        t_first = convert_time_stamps_to_secs(first_line.split(b'\t')[3].decode(), method=0)
+        t_last = convert_time_stamps_to_secs(last_line.split(b'\t')[3].decode(), method=0)
 
-    # Get end time point for finding the gap to the next recording file
-    t_last = convert_time_stamps_to_secs(dummy_01.iloc[-1, 3], method=0)
+        record_size = len(first_line)
+        if vr_fr is not None and len(last_line) == record_size and last_line.endswith(b'\n') \
+                and size % record_size == 0 and size // record_size == int(round((t_last - t_first) * vr_fr)) + 1:
+            return size // record_size, t_first, t_last
 
-    # Loop over the rest of the vr recording text files
-    for f_name in vr_files[1:]:
+        n_lines = 0
+        last_byte = b'\n'
+        f.seek(0)
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            n_lines += chunk.count(b'\n')
+            last_byte = chunk[-1:]
+        if last_byte != b'\n':
+            # No line break after the last line
+            n_lines += 1
+    return n_lines, t_first, t_last
+
+
+def read_ventral_root_file(file_dir, dtype=np.float64, time_stamps=False):
+    # Parse only the voltage column (and the time stamp column) of a ventral root text file straight into numpy arrays
+    # (C parser, fixed dtypes, no NaN string matching). Returns the values and the time stamps (or None).
+    columns = [0, 3] if time_stamps else [0]
+    dummy = pd.read_csv(
+        file_dir, sep='\t', header=None, usecols=columns, dtype={0: dtype, 3: np.float64},
+        engine='c', na_filter=False, low_memory=False,
+    )
+    values = dummy[0].to_numpy()
+    if time_stamps:
+        return values, dummy[3].to_numpy()
+    return values, None
+
+
+def layout_ventral_root_recording(vr_files, vr_fr, first_file_missing=0):
+    # Pass 1: scan the length and first/last time stamp of every file and compute where each file starts
+    # If the first recording file is missing, it is filled with zeros (one recording is always 60 seconds long)
+    # Returns a list of (file, start index, samples, gap to the previous file in secs) and the total number of samples
+    vr_files = list(np.sort(vr_files))
+    position = int(vr_fr * first_file_missing)
+    layout = []
+    t_last = None
+    for k, f_name in enumerate(vr_files):
         # check file size
-        if os.path.getsize(f_name) <= 10:
+        if k > 0 and os.path.getsize(f_name) <= 10:
             print('')
             print('WARNING')
             print(f'{f_name}: File Size is too small. Something is wrong with this file. Please check!')
             print('Will skip this file and set all values to zero')
             print('')
             continue
+        n_samples, t_first, t_end = scan_ventral_root_file(f_name, vr_fr)
+        if t_last is not None:
+            # Fill the Gap between Recordings with zeros
+            # (time distance between the end of the last vr recording and the start of this one in seconds)
+            # (truncated like the old concatenation: a gap that is 5000.99999 samples because of the float error of the
+            # time stamps gets 5000 zeros)
+            n_zeros = int(vr_fr * (t_first - t_last))
+            if n_zeros < 0:
+                print(f'WARNING: {f_name} starts before the previous file ends. Gap is ignored!')
+                n_zeros = 0
+            position += n_zeros
+        layout.append((f_name, position, n_samples, 0 if t_last is None else t_first - t_last))
+        position += n_samples
+        # store last time point of this recording for the next round
+        t_last = t_end
+    return layout, position
 
-        # Load ventral root text file
-        dummy = pd.read_csv(f_name, sep='\t', header=None)
-
-        # Compute time distance between the end of the last vr recording and the start of this one (in seconds)
-        t_rel_distance = convert_time_stamps_to_secs(dummy.iloc[0, 3], method=0) - t_last
 
-        # Fill the Gap between Recordings with zeros
-        n_zeros = np.zeros(int(vr_fr * t_rel_distance))
-        values = dummy.iloc[:, 0].to_numpy()
-        vr_values = np.append(vr_values, n_zeros)
-        vr_values = np.append(vr_values, values)
+def fill_ventral_root_recording(layout, out, vr_fr, check_timing=False):
+    # Pass 2: write the values of each file into the preallocated output (numpy array, memory map or hdf5 data set
+    # with one column). The gaps between the files are not written (must be zero already).
+    # check_timing: the time stamps of every sample are checked for dropped samples and jitter
+    # Returns the diagnostic table (one row per file) or None
+    timing = []
+    for f_name, start, n_samples, gap in layout:
+        # Get the Voltage values (and the time stamps)
+        values, time_stamps = read_ventral_root_file(f_name, dtype=out.dtype, time_stamps=check_timing)
+        if values.shape[0] != n_samples:
+            print(f'WARNING: {f_name}: {values.shape[0]} samples found, {n_samples} expected. Values are cut or padded!')
+        values = values[:n_samples]
+        out[start:start + values.shape[0]] = values.reshape((-1,) + tuple(out.shape[1:]))
+        if check_timing:
+            file_timing = timing_diagnostics(time_stamps_to_secs(time_stamps), vr_fr)
+            timing.append(dict(file=os.path.split(f_name)[1], gap_to_previous_secs=gap, **file_timing))
+    if check_timing:
+        return pd.DataFrame(timing)
+    return None
 
-        # store last time point of this recording for the next round
-        t_last = convert_time_stamps_to_secs(dummy.iloc[-1, 3], method=0)
 
-    # If the first recording file is missing, correct for it now
-    if first_file_missing > 0:
-        # We know one recording is always 60 seconds long
-        # Reset time so that it starts at 60 seconds since the first recording is missing
-        n_zeros = np.zeros(int(vr_fr * first_file_missing))
-        vr_values = np.append(n_zeros, vr_values)
+def transform_ventral_root_recording(vr_files, vr_fr, first_file_missing=0, out_file=None, check_timing=False,
+                                     dtype=np.float64):
+    # vr_files is a list of ventral root recording text files of one sweep
+    # Two passes: 1. scan the length and first/last time stamp of every file and compute where each file starts,
+    # 2. write the values of each file into one preallocated array (the gaps between the files stay zero).
+    # out_file (.npy): the values are written into a memory mapped file instead of RAM
+    # check_timing: the diagnostic table (one row per file) is stored in the attrs of the result:
+    # vr_trace.attrs['timing']
+    # dtype: np.float32 halves the memory of the values
+    layout, n_samples = layout_ventral_root_recording(vr_files, vr_fr, first_file_missing)
+    if out_file is not None:
+        vr_values = np.lib.format.open_memmap(out_file, mode='w+', dtype=dtype, shape=(n_samples,))
+        vr_values[:] = 0
+    else:
+        vr_values = np.zeros(n_samples, dtype=dtype)
+    timing = fill_ventral_root_recording(layout, vr_values, vr_fr, check_timing)
+    if out_file is not None:
+        vr_values.flush()
 
     # Put all in one Data Frame
-    t_max = vr_values.shape[0] / vr_fr
-    vr_time = np.arange(0, t_max, 1/vr_fr)
+    vr_time = np.arange(vr_values.shape[0]) / vr_fr
     vr_trace_export = pd.DataFrame(columns=['Time', 'Volt'])
     # Add the time in secs (not the timestamps)
     vr_trace_export['Time'] = vr_time
     vr_trace_export['Volt'] = vr_values
+    if check_timing:
+        vr_trace_export.attrs['timing'] = timing
 
     return vr_trace_export
 
 
-def transform_ventral_root_parallel(save_dir, base_dir, rec_dur, vr_fr, sw):
+def transform_ventral_root_parallel(save_dir, base_dir, rec_dur, vr_fr, sw, check_timing=True, out_format='hdf5'):
+    # out_format: 'hdf5' (one hdf5 file per sweep, returns its file name) or 'csv' (returns the trace)
     # get file lise
     f_names = os.listdir(f'{base_dir}/{sw}')
     f_names = list(np.sort(f_names))
@@ -112,14 +243,388 @@ def transform_ventral_root_parallel(save_dir, base_dir, rec_dur, vr_fr, sw):
         print(f'Will correct for that, assuming that each recording has a duration of 60 seconds!')
 
     print(f'START PROCESSING: {sw}')
-    vr_trace = transform_ventral_root_recording(f_path, vr_fr=vr_fr, first_file_missing=firs_rec_missing)
+    if out_format == 'hdf5' and save_dir is not None:
+        to_dir = f'{save_dir}/{sw}_ventral_root.h5'
+        timing = convert_sweep_to_hdf5(
+            f_path, vr_fr, to_dir, sw, first_file_missing=firs_rec_missing, check_timing=check_timing)
+        result = {sw: to_dir}
+    else:
+        vr_trace = transform_ventral_root_recording(
+            f_path, vr_fr=vr_fr, first_file_missing=firs_rec_missing, check_timing=check_timing)
+        timing = vr_trace.attrs.get('timing')
+        if save_dir is not None:
+            to_dir = f'{save_dir}/{sw}_ventral_root.csv'
+            vr_trace['Volt'].to_csv(to_dir, index=False)  # exclude the time axis
+            # vr_trace.to_csv(to_dir, index=False)
+        # vr_envelope = compute_envelope_of_ventral_root(vr_trace)
+        result = {sw: vr_trace}
+
+    if timing is not None:
+        if timing['n_dropped_samples'].sum() > 0:
+            print(f'WARNING: {sw}: {timing["n_dropped_samples"].sum()} dropped samples (see timing table)')
+        if save_dir is not None:
+            # One row per recording file: gaps, dropped samples and jitter
+            timing.to_csv(f'{save_dir}/{sw}_timing.csv', index=False)
     if save_dir is not None:
-        to_dir = f'{save_dir}/{sw}_ventral_root.csv'
-        vr_trace['Volt'].to_csv(to_dir, index=False)  # exclude the time axis
-        # vr_trace.to_csv(to_dir, index=False)
         print(f'Ventral Root of Sweep: {sw} stored to HDD')
-    # vr_envelope = compute_envelope_of_ventral_root(vr_trace)
-    result = {sw: vr_trace}
     return result
 
 
+# -------------------- hdf5 output: one file per sweep, joined with virtual data sets --------------------
+
+def convert_sweep_to_hdf5(vr_files, vr_fr, out_file, sweep_name, first_file_missing=0, check_timing=False,
+                          dtype=np.float64):
+    # Write one sweep straight into a hdf5 file (same layout and meta data as a global data set of the viewer file:
+    # global_data_sets/<sweep_name>, shape: (samples, 1)). Only one recording file is in memory at a time.
+    # Returns the timing diagnostic table or None
+    layout, n_samples = layout_ventral_root_recording(vr_files, vr_fr, first_file_missing)
+    with h5py.File(out_file, 'w') as f:
+        # Gaps are never written and keep the fill value (0)
+        data_set = f.create_group('global_data_sets').create_dataset(
+            sweep_name, shape=(n_samples, 1), dtype=dtype, fillvalue=0,
+            chunks=(min(n_samples, 2**16), 1) if n_samples > 0 else None)
+        set_vr_meta_data(data_set, sweep_name, vr_fr)
+        timing = fill_ventral_root_recording(layout, data_set, vr_fr, check_timing)
+    return timing
+
+
+def set_vr_meta_data(data_set, sweep_name, vr_fr):
+    # Same attributes as DataHandler.add_new_data_set
+    data_set.attrs['header_names'] = [sweep_name]
+    data_set.attrs['sampling_rate'] = float(vr_fr)
+    data_set.attrs['time_offset'] = 0
+    data_set.attrs['y_offset'] = 0
+    data_set.attrs['color'] = '#000000'
+    data_set.attrs['lw'] = 1
+    data_set.attrs['name'] = sweep_name
+    data_set.attrs['data_type'] = 'global_data_sets'
+
+
+def join_sweeps_virtual(sweep_files, out_file):
+    # Combine the hdf5 files of all sweeps (see convert_sweep_to_hdf5) into one file without copying any data:
+    # every sweep becomes a virtual data set (global_data_sets/<sweep>) that points to the sweep file
+    with h5py.File(out_file, 'w') as f:
+        group = f.create_group('global_data_sets')
+        for sweep_file in sweep_files:
+            with h5py.File(sweep_file, 'r') as sf:
+                for sweep_name in sf['global_data_sets']:
+                    source = sf['global_data_sets'][sweep_name]
+                    v_layout = h5py.VirtualLayout(shape=source.shape, dtype=source.dtype)
+                    v_layout[:] = h5py.VirtualSource(
+                        os.path.abspath(sweep_file), f'global_data_sets/{sweep_name}', shape=source.shape)
+                    entry = group.create_virtual_dataset(sweep_name, v_layout, fillvalue=0)
+                    for k in source.attrs:
+                        entry.attrs[k] = source.attrs[k]
+
+
+# -------------------- Incremental conversion: manifest of the converted sweeps --------------------
+
+MANIFEST_NAME = 'ventral_root_manifest.json'
+
+
+def sweep_signature(sweep_dir):
+    # Name, size and modification time of every recording file of a sweep (cheap, no file is read)
+    signature = []
+    for f_name in sorted(os.listdir(sweep_dir)):
+        stat = os.stat(f'{sweep_dir}/{f_name}')
+        signature.append([f_name, stat.st_size, stat.st_mtime_ns])
+    return signature
+
+
+def file_hash(file_dir, chunk_size=2**20):
+    h = hashlib.sha256()
+    with open(file_dir, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def load_manifest(save_dir):
+    manifest_file = f'{save_dir}/{MANIFEST_NAME}'
+    if os.path.exists(manifest_file):
+        with open(manifest_file, 'r') as f:
+            return json.load(f)
+    return dict()
+
+
+def save_manifest(save_dir, manifest):
+    # Write to a temp file first, so that an interrupted run never leaves a broken manifest
+    manifest_file = f'{save_dir}/{MANIFEST_NAME}'
+    with open(manifest_file + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_file + '.tmp', manifest_file)
+
+
+def sweep_is_up_to_date(entry, signature, verify_hash=False):
+    # A sweep is skipped if it was converted before, its files did not change and its output is still there
+    if entry is None or entry.get('status') != 'done' or entry.get('files') != signature:
+        return False
+    out_file = entry.get('output')
+    if out_file is None or not os.path.exists(out_file):
+        return False
+    stat = os.stat(out_file)
+    if stat.st_size != entry.get('output_size') or stat.st_mtime_ns != entry.get('output_mtime'):
+        return False
+    if verify_hash:
+        return file_hash(out_file) == entry.get('output_hash')
+    return True
+
+
+# -------------------- Parallel conversion: number of workers under a RAM budget --------------------
+
+# Memory needed to parse one text file with pandas (bytes per byte of text) and fixed overhead per worker
+PARSE_MEMORY_FACTOR = 3
+WORKER_MEMORY_OVERHEAD = 200 * 2**20
+
+
+def estimate_sweep_memory(sweep_dir, out_format='hdf5'):
+    # Peak memory (bytes) of one worker converting this sweep, estimated from the file sizes only.
+    # hdf5: only one recording file is parsed at a time, csv: the whole sweep is kept in memory (time + values)
+    files = [f'{sweep_dir}/{f}' for f in os.listdir(sweep_dir)]
+    sizes = [os.path.getsize(f) for f in files]
+    if len(sizes) == 0:
+        return WORKER_MEMORY_OVERHEAD
+    memory = max(sizes) * PARSE_MEMORY_FACTOR + WORKER_MEMORY_OVERHEAD
+    if out_format == 'csv':
+        with open(files[int(np.argmax(sizes))], 'rb') as f:
+            bytes_per_line = max(len(f.readline()), 1)
+        memory += sum(sizes) // bytes_per_line * 8 * 3
+    return memory
+
+
+def default_ram_budget():
+    # Half of the physical memory (4 GB if it can not be found out)
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 2
+    except (ValueError, OSError, AttributeError):
+        return 4 * 2**30
+
+
+def probe_bottleneck(sweep_dir, n_cpus=None):
+    # Measure how fast the disk delivers a recording file and how fast one worker parses it, then choose the number
+    # of workers: if the disk is the bottleneck, more workers than disk_rate / parse_rate only wait for the disk.
+    # Returns the number of workers, the disk rate and the parse rate (MB/s)
+    n_cpus = n_cpus or max((os.cpu_count() or 1) - 1, 1)
+    files = [f'{sweep_dir}/{f}' for f in os.listdir(sweep_dir)]
+    if len(files) == 0:
+        return n_cpus, np.nan, np.nan
+    file_dir = max(files, key=os.path.getsize)
+    size_mb = os.path.getsize(file_dir) / 2**20
+    t0 = time.perf_counter()
+    with open(file_dir, 'rb') as f:
+        while f.read(2**24):
+            pass
+    disk_rate = size_mb / max(time.perf_counter() - t0, 1e-6)
+    # The file is in the OS cache now, so this is the pure parse time
+    t0 = time.perf_counter()
+    read_ventral_root_file(file_dir)
+    parse_rate = size_mb / max(time.perf_counter() - t0, 1e-6)
+    n_workers = int(min(n_cpus, max(np.ceil(disk_rate / parse_rate), 1)))
+    bottleneck = 'CPU' if n_workers == n_cpus else 'disk'
+    print(f'Ventral Root: disk {disk_rate:.0f} MB/s, parsing {parse_rate:.0f} MB/s per worker '
+          f'({bottleneck} bound) --> {n_workers} workers')
+    return n_workers, disk_rate, parse_rate
+
+
+def convert_ventral_root_sweeps(base_dir, save_dir, rec_dur=60, vr_fr=10000, n_jobs=None, ram_budget=None,
+                                verify_hash=False):
+    """ Convert all sweep folders of base_dir (see transform_ventral_root_parallel), incremental and resumable
+
+    The manifest (ventral_root_manifest.json in save_dir) stores the file list (names, sizes, mtimes) of every sweep
+    together with its output file and the hash of the output. Only new, changed or failed sweeps are converted again.
+    The manifest is updated as soon as a sweep is finished, so an interrupted run continues where it stopped.
+
+    A new sweep is only started if the estimated memory of all running sweeps stays below the RAM budget (at least one
+    sweep is always running).
+
+    :param n_jobs: max. number of worker processes (None: chosen by probe_bottleneck, negative: like joblib)
+    :param ram_budget: memory (bytes) that all workers together may use (None: half of the physical memory)
+    :param verify_hash: also compare the hash of existing outputs (reads all output files)
+    :return: {sweep name: hdf5 file} of all converted sweeps and a list of the failed sweep folders
+    """
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+    manifest = load_manifest(save_dir)
+    sweep_folders = sorted([d for d in os.listdir(base_dir) if os.path.isdir(f'{base_dir}/{d}')])
+    signatures = {sw: sweep_signature(f'{base_dir}/{sw}') for sw in sweep_folders}
+    todo = [sw for sw in sweep_folders if not sweep_is_up_to_date(manifest.get(sw), signatures[sw], verify_hash)]
+    print(f'Ventral Root: {len(sweep_folders)} sweeps, {len(sweep_folders) - len(todo)} up to date, '
+          f'{len(todo)} to convert')
+
+    failed = []
+    if len(todo) > 0:
+        if n_jobs is None:
+            n_jobs, _, _ = probe_bottleneck(f'{base_dir}/{todo[0]}')
+        elif n_jobs < 0:
+            n_jobs = max((os.cpu_count() or 1) + 1 + n_jobs, 1)
+        ram_budget = ram_budget or default_ram_budget()
+        memory = {sw: estimate_sweep_memory(f'{base_dir}/{sw}') for sw in todo}
+        input_size = {sw: sum(s[1] for s in signatures[sw]) for sw in todo}
+        print(f'Ventral Root: RAM budget {ram_budget / 2**30:.1f} GB, '
+              f'largest sweep needs about {max(memory.values()) / 2**30:.2f} GB')
+
+        # Biggest sweeps first, so that small sweeps fill up the remaining memory at the end
+        queue = sorted(todo, key=lambda k: memory[k], reverse=True)
+        running = dict()
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            while len(queue) > 0 or len(running) > 0:
+                # Start as many sweeps as fit into the budget
+                used = sum(memory[running[k][0]] for k in running)
+                for sw in list(queue):
+                    if len(running) >= n_jobs:
+                        break
+                    if len(running) == 0 or used + memory[sw] <= ram_budget:
+                        future = executor.submit(transform_ventral_root_parallel, save_dir, base_dir, rec_dur, vr_fr, sw)
+                        running[future] = (sw, time.perf_counter())
+                        used += memory[sw]
+                        queue.remove(sw)
+
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    sw, t_start = running.pop(future)
+                    duration = time.perf_counter() - t_start
+                    try:
+                        name, out_file = list(future.result().items())[0]
+                        stat = os.stat(out_file)
+                        manifest[sw] = dict(
+                            status='done', name=name, files=signatures[sw], output=out_file,
+                            output_size=stat.st_size, output_mtime=stat.st_mtime_ns, output_hash=file_hash(out_file),
+                            converted=time.strftime('%Y-%m-%d %H:%M:%S'), duration_secs=duration)
+                        print(f'Ventral Root: {sw} done in {duration:.1f} s '
+                              f'({input_size[sw] / 2**20 / max(duration, 1e-6):.1f} MB/s)')
+                    except Exception as e:
+                        print(f'ERROR: Sweep {sw} failed: {e}')
+                        manifest[sw] = dict(status='failed', files=signatures[sw], error=str(e))
+                        failed.append(sw)
+                    save_manifest(save_dir, manifest)
+
+    sweep_files = {
+        manifest[sw]['name']: manifest[sw]['output'] for sw in sweep_folders if manifest[sw]['status'] == 'done'
+    }
+    join_sweeps_virtual(list(sweep_files.values()), f'{save_dir}/ventral_root_sweeps.h5')
+    return sweep_files, failed
+
+
+# -------------------- Event detection on long recordings (block by block) --------------------
+
+def vr_envelope(data, rate, freq):
+    # Same as VentralRootDetection.envelope (zero-phase low pass filter of the absolute values)
+    sos = sig.butter(2, freq, 'lowpass', fs=rate, output='sos')
+    return (np.sqrt(2) * sig.sosfiltfilt(sos, np.abs(data))) ** 2
+
+
+def combine_stats(stats, block):
+    # Combine running statistics (n, mean, M2) with the values of a new block (Chan et al. parallel Welford update)
+    n_a, mean_a, m2_a = stats
+    n_b = block.shape[0]
+    if n_b == 0:
+        return stats
+    mean_b = np.mean(block)
+    m2_b = np.sum((block - mean_b) ** 2)
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    mean = mean_a + delta * n_b / n
+    m2 = m2_a + m2_b + delta ** 2 * n_a * n_b / n
+    return n, mean, m2
+
+
+class StreamingVentralRootDetector:
+    """ Ventral root event detection over arbitrarily long recordings with bounded memory
+
+    Gives the same events as VentralRootDetection.find_vr_events, but the trace is never loaded at once. It is read in
+    blocks that overlap by a margin (so the envelope filter and the moving average are not affected by the block
+    borders). Two passes over the data:
+        1. running mean/std of the raw trace (detection threshold) and of the filtered envelope (z-transform)
+        2. envelope again, thresholding and onset/offset detection, events are emitted block by block
+
+    That's how you use it:
+        detector = StreamingVentralRootDetector(read_block, n_samples, fr, parameters)
+        vr_events = detector.detect()
+
+    :param read_block: function(start_idx, end_idx) that returns the samples of this range as 1D numpy array
+    :param n_samples: length of the recording (samples)
+    :param fr: sampling rate in Hz
+    :param parameters: threshold, vr_cutoff, movingaverage_window, duration_th_secs, minimal_event_distance
+    :param block_size: samples per block (without margins)
+    """
+    def __init__(self, read_block, n_samples, fr, parameters, block_size=2**20):
+        self.read_block = read_block
+        self.n_samples = n_samples
+        self.fr = fr
+        self.parameters = parameters
+        self.block_size = block_size
+        # Time axis as in VentralRootDetection (np.linspace(0, n/fr, n))
+        self.dt = (n_samples / fr) / (n_samples - 1) if n_samples > 1 else 1 / fr
+        # The filter response has decayed after a few periods of the cut off frequency
+        self.margin = int(10 * fr / parameters['vr_cutoff']) + int(parameters['movingaverage_window'])
+        self.threshold = None
+        self.env_mean = None
+        self.env_std = None
+
+    @classmethod
+    def from_array(cls, data, fr, parameters, block_size=2**20):
+        return cls(lambda start, end: data[start:end], data.shape[0], fr, parameters, block_size)
+
+    def iter_envelope(self):
+        # Yields (block start index, filtered envelope of the block, raw data of the block) for every block
+        window = int(self.parameters['movingaverage_window'])
+        for start in range(0, self.n_samples, self.block_size):
+            end = min(start + self.block_size, self.n_samples)
+            read_start = max(start - self.margin, 0)
+            read_end = min(end + self.margin, self.n_samples)
+            data = np.asarray(self.read_block(read_start, read_end), dtype=float)
+            env = vr_envelope(data, rate=self.fr, freq=self.parameters['vr_cutoff'])
+            env_fil = np.convolve(env, np.ones(window) / window, mode='same')
+            core = slice(start - read_start, end - read_start)
+            yield start, env_fil[core], data[core]
+
+    def compute_statistics(self):
+        # Pass 1: global mean/std of the raw trace and of the filtered envelope
+        raw_stats = (0, 0.0, 0.0)
+        env_stats = (0, 0.0, 0.0)
+        for _, env_fil, data in self.iter_envelope():
+            raw_stats = combine_stats(raw_stats, data)
+            env_stats = combine_stats(env_stats, env_fil)
+        factor = 5 if self.parameters['threshold'] is None else self.parameters['threshold']
+        self.threshold = np.sqrt(raw_stats[2] / raw_stats[0]) * factor
+        self.env_mean = env_stats[1]
+        self.env_std = np.sqrt(env_stats[2] / env_stats[0])
+
+    def iter_event_edges(self):
+        # Pass 2: yields the onset and offset indices (same as find_vr_event_edges) of every block
+        if self.threshold is None:
+            self.compute_statistics()
+        previous = False
+        for start, env_fil, _ in self.iter_envelope():
+            binary = (env_fil - self.env_mean) / self.env_std > self.threshold
+            # Include the last value of the previous block, so that edges at the block border are found
+            edges = np.diff(np.concatenate([[previous], binary]).astype(np.int8))
+            onset_idx = np.maximum(np.flatnonzero(edges > 0) + start - 1, 0)
+            offset_idx = np.flatnonzero(edges < 0) + start - 1
+            previous = binary[-1]
+            if start + binary.shape[0] >= self.n_samples and previous:
+                # Still active at the end of the recording
+                offset_idx = np.append(offset_idx, self.n_samples - 1)
+            yield onset_idx, offset_idx
+
+    def detect(self):
+        onsets = []
+        offsets = []
+        for onset_idx, offset_idx in self.iter_event_edges():
+            onsets.append(onset_idx)
+            offsets.append(offset_idx)
+        if len(onsets) == 0:
+            onsets, offsets = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)]
+        onset_idx, offset_idx = merge_vr_events(
+            np.concatenate(onsets), np.concatenate(offsets), self.dt,
+            duration_th_secs=self.parameters['duration_th_secs'],
+            minimal_event_distance=self.parameters['minimal_event_distance']
+        )
+        return {
+            'onset_idx': onset_idx,
+            'offset_idx': offset_idx,
+            'onset_times': onset_idx * self.dt,
+            'offset_times': offset_idx * self.dt,
+        }
@@ -0,0 +1,118 @@
+"""
+Headless batch ventral root event detection
+Applies one saved parameter set (see VentralRootDetection "Save Parameters...") to every sweep file created by
+"Convert Ventral Root Files" ({sweep}_ventral_root.h5 or {sweep}_ventral_root.csv) and writes one combined event table.
+
+Usage (from the repo directory):
+    python -m roibaview.ventral_root_batch parameters.json sweep_dir events.csv
+"""
+import os
+import sys
+import json
+import tempfile
+import numpy as np
+import h5py
+import pandas as pd
+from roibaview.ventral_root import StreamingVentralRootDetector
+
+VR_PARAMETER_NAMES = ['threshold', 'vr_cutoff', 'movingaverage_window', 'duration_th_secs', 'minimal_event_distance']
+SWEEP_FILE_SUFFIXES = ['_ventral_root.h5', '_ventral_root.csv']
+
+
+def save_vr_parameters(file_dir, parameters, sampling_rate):
+    result = {k: parameters[k] for k in VR_PARAMETER_NAMES}
+    result['sampling_rate'] = sampling_rate
+    with open(file_dir, 'w') as f:
+        json.dump(result, f, indent=4)
+
+
+def load_vr_parameters(file_dir):
+    # Returns the detection parameters and the sampling rate
+    with open(file_dir, 'r') as f:
+        parameters = json.load(f)
+    missing = [k for k in VR_PARAMETER_NAMES if k not in parameters]
+    if len(missing) > 0:
+        print(f'ERROR: Parameter file is missing: {missing}')
+        return None, None
+    sampling_rate = parameters.pop('sampling_rate', 10000)
+    return parameters, sampling_rate
+
+
+def find_sweep_files(sweep_dir):
+    # hdf5 files are used if there are both (csv files from older conversions)
+    files = dict()
+    for suffix in SWEEP_FILE_SUFFIXES[::-1]:
+        for f in os.listdir(sweep_dir):
+            if f.endswith(suffix):
+                files[f[:-len(suffix)]] = f'{sweep_dir}/{f}'
+    return [files[k] for k in sorted(files)]
+
+
+def csv_column_to_memmap(file_dir, tmp_file, chunk_size=2**20):
+    # First column of a csv file as memory mapped numpy array (float64), never more than one chunk is in memory
+    n_samples = 0
+    with open(tmp_file, 'wb') as f:
+        for chunk in pd.read_csv(file_dir, usecols=[0], chunksize=chunk_size):
+            values = chunk.iloc[:, 0].to_numpy(dtype=np.float64)
+            f.write(values.tobytes())
+            n_samples += values.shape[0]
+    if n_samples == 0:
+        return np.zeros(0)
+    return np.memmap(tmp_file, dtype=np.float64, mode='r', shape=(n_samples,))
+
+
+def detect_sweep_events(file_dir, fr, parameters):
+    # Detect the ventral root events of one sweep file (hdf5: read block by block, csv: one column of voltage values)
+    suffix = [s for s in SWEEP_FILE_SUFFIXES if file_dir.endswith(s)][0]
+    sweep = os.path.split(file_dir)[1][:-len(suffix)]
+    if file_dir.endswith('.h5'):
+        with h5py.File(file_dir, 'r') as f:
+            data_set = f['global_data_sets'][sweep]
+            fr = data_set.attrs['sampling_rate']
+            vr_events = StreamingVentralRootDetector(
+                lambda start, end: data_set[start:end, 0], data_set.shape[0], fr, parameters).detect()
+    else:
+        # The csv file is copied chunk by chunk into a temporary binary file, so the detector can read it block by block
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            data = csv_column_to_memmap(file_dir, f'{tmp_dir}/{sweep}.dat')
+            vr_events = StreamingVentralRootDetector.from_array(data, fr, parameters).detect()
+            del data
+    result = pd.DataFrame()
+    result['onset_time'] = vr_events['onset_times']
+    result['offset_time'] = vr_events['offset_times']
+    result['onset_idx'] = vr_events['onset_idx']
+    result['offset_idx'] = vr_events['offset_idx']
+    result['duration'] = result['offset_time'] - result['onset_time']
+    result.insert(0, 'sweep', sweep)
+    print(f'{sweep}: {result.shape[0]} events')
+    return result
+
+
+def run_vr_batch(parameter_file, sweep_dir, out_file, n_jobs=-1):
+    """ Detect the ventral root events of all sweeps in a process pool (every core by default)
+
+    :return: combined event table (pandas DataFrame), also stored as csv file to out_file
+    """
+    from joblib import Parallel, delayed
+    parameters, fr = load_vr_parameters(parameter_file)
+    if parameters is None:
+        return None
+    sweep_files = find_sweep_files(sweep_dir)
+    if len(sweep_files) == 0:
+        print(f'ERROR: No "*{SWEEP_FILE_SUFFIXES[0]}" or "*{SWEEP_FILE_SUFFIXES[1]}" files found in {sweep_dir}')
+        return None
+
+    print(f'Ventral Root Batch Detection: {len(sweep_files)} sweeps')
+    # One sweep per task, the results come back in the order of the sweeps
+    tables = Parallel(n_jobs=n_jobs)(delayed(detect_sweep_events)(f, fr, parameters) for f in sweep_files)
+    events = pd.concat(tables, ignore_index=True)
+    events.to_csv(out_file, index=False)
+    print(f'Ventral Root Batch Detection: {events.shape[0]} events stored to {out_file}')
+    return events
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 4:
+        print('Usage: python -m roibaview.ventral_root_batch parameters.json sweep_dir events.csv')
+        sys.exit(1)
+    run_vr_batch(sys.argv[1], sys.argv[2], sys.argv[3])
@@ -7,6 +7,9 @@ from PyQt6.QtWidgets import QVBoxLayout, QSlider, QLabel, QWidget, QSpacerItem,
 from scipy import signal
 # from IPython import embed
 from roibaview.gui import BrowseFileDialog
+from roibaview.peak_tables import vr_event_table, find_vr_event_edges, merge_vr_events
+from roibaview.ventral_root import StreamingVentralRootDetector
+from roibaview.ventral_root_batch import save_vr_parameters
 import pandas as pd
 import scipy.signal as sig
 
@@ -16,13 +19,14 @@ class VentralRootDetection(QDialog):
     signal_roi_changed = pyqtSignal(int)
     main_window_closing = pyqtSignal()
 
-    def __init__(self, data, fr, master_plot, roi, parent=None):
+    def __init__(self, trace_provider, master_plot, roi, parent=None):
         # QWidget.__init__(self)
         super().__init__(parent)
         self.roi_idx = roi
-        self.data = data  # this is the data set
-        self.data_trace = self.data[:, self.roi_idx]  # this is the roi trace
-        self.fr = fr
+        # The trace provider only loads the trace of the current ROI (not the entire data set)
+        self.trace_provider = trace_provider
+        self.data_trace = self.trace_provider.get_trace(self.roi_idx)  # this is the roi trace
+        self.fr = self.trace_provider.fr
         self.time_axis = self.compute_time_axis(self.data_trace.shape[0], self.fr)
         self.master_plot = master_plot
         self.parameters = dict()
@@ -52,6 +56,40 @@ class VentralRootDetection(QDialog):
             env_dir = os.path.split(file_dir)[0] + '/envelope_trace.csv'
             env.to_csv(env_dir, index=False, header=False)
 
+    def store_events(self):
+        # Store the events of the current ROI in the session file (events of other ROIs are kept)
+        if 'onset_idx' not in self.vr_events:
+            return
+        provider = self.trace_provider
+        provider.data_handler.add_events(
+            provider.data_set_type, provider.data_set_name, 'vr_events',
+            vr_event_table(self.vr_events, self.roi_idx),
+            parameters=self.parameters, replace_rois=[self.roi_idx])
+        print(f'Ventral Root Detection: Stored {len(self.vr_events["onset_idx"])} events of ROI {self.roi_idx + 1}')
+
+    def save_parameters(self):
+        # The parameter file can be used for the batch detection over many sweeps
+        file_browser = BrowseFileDialog(self)
+        file_dir = file_browser.save_file_name('json file, (*.json)')
+        if file_dir:
+            save_vr_parameters(file_dir, self.parameters, self.fr)
+
+    def batch_detection(self):
+        # Detect the events of every ROI with the current parameters (block by block, the traces are never loaded
+        # at once) and store them in the session file
+        provider = self.trace_provider
+        tables = []
+        for roi in range(provider.n_traces):
+            detector = StreamingVentralRootDetector(
+                lambda start, end, r=roi: provider.get_trace_slice(r, start, end),
+                provider.n_samples, provider.fr, self.parameters)
+            tables.append(vr_event_table(detector.detect(), roi))
+            print(f'Ventral Root Detection: {roi + 1} / {provider.n_traces} ROIs')
+        events = np.concatenate(tables)
+        provider.data_handler.add_events(
+            provider.data_set_type, provider.data_set_name, 'vr_events', events, parameters=self.parameters)
+        print(f'Ventral Root Detection: Found {events.shape[0]} events (stored in session file)')
+
     @staticmethod
     def compute_time_axis(data_size, fr):
         max_time = data_size / fr
@@ -64,7 +102,7 @@ class VentralRootDetection(QDialog):
     def roi_changed(self, new_roi_idx):
         print('ROI CHANGED')
         self.roi_idx = new_roi_idx
-        self.data_trace = self.data[:, self.roi_idx]
+        self.data_trace = self.trace_provider.get_trace(self.roi_idx)
 
         # Update find vr events
         self.find_vr_events(self.parameters)
@@ -107,6 +145,18 @@ class VentralRootDetection(QDialog):
         self.export_button.clicked.connect(self.export_peaks)
         layout.addWidget(self.export_button)
 
+        self.store_button = QPushButton('Store Events of ROI')
+        self.store_button.clicked.connect(self.store_events)
+        layout.addWidget(self.store_button)
+
+        self.save_parameters_button = QPushButton('Save Parameters...')
+        self.save_parameters_button.clicked.connect(self.save_parameters)
+        layout.addWidget(self.save_parameters_button)
+
+        self.batch_button = QPushButton('Detect in all ROIs')
+        self.batch_button.clicked.connect(self.batch_detection)
+        layout.addWidget(self.batch_button)
+
         self.setLayout(layout)
         self.setWindowTitle("Peak Detection Parameters")
         # self.show()
@@ -290,74 +340,23 @@ class VentralRootDetection(QDialog):
         self.env_trace = env_fil.copy()
         env_vr_z = self.z_transform(env_fil)
 
-        # Create Binary
-        binary = np.zeros_like(env_vr_z)
-        binary[env_vr_z > th] = 1
+        # Create Binary and find onsets and offsets of ventral root activity
+        onset_idx, offset_idx = find_vr_event_edges(env_vr_z > th)
 
-        # Find onsets and offsets of ventral root activity
-        onsets_offsets = np.diff(binary, append=0)
+        # Remove too long events and merge events that are too close to each other
         time_axis = self.time_axis
-        onset_idx = np.where(onsets_offsets > 0)[0]
-        offset_idx = np.where(onsets_offsets < 0)[0]
-        onset_times = time_axis[onset_idx]
-        offset_times = time_axis[offset_idx]
-
-        # check for motor activity that is too long (artifacts due to concatenating recordings) and remove it
-        if len(offset_times) == len(onset_times):
-            event_duration = offset_times - onset_times
-            idx_remove = event_duration > parameters['duration_th_secs']
-            onset_times = onset_times[np.invert(idx_remove)]
-            offset_times = offset_times[np.invert(idx_remove)]
-        else:
-            print('WARNING: Number of onset times and offset times do not match!')
-
-        # Merge Events that are to close to each other
-        # Combine event information into a single list of tuples
-        events = list(zip(onset_times, offset_times, onset_idx, offset_idx))
-        # Sort events by their onset time
-        events = sorted(events, key=lambda x: x[0])
-
-        # Initialize lists to store merged events and their indices
-        merged_onset_indices = []
-        merged_offset_indices = []
-        merged_onset_times = []
-        merged_offset_times = []
-
-        # Initialize the first event as the current event to merge
-        current_onset_time, current_offset_time, current_onset_index, current_offset_index = events[0]
-
-        for onset_time, offset_time, onset_index, offset_index in events[1:]:
-            # Check if the current event is close to the previous one
-            if onset_time - current_offset_time <= parameters['minimal_event_distance']:
-                # Merge the events by extending the offset time and updating indices
-                current_offset_time = max(current_offset_time, offset_time)
-                current_offset_index = offset_index
-            else:
-                # If not close, save the current event and start a new one
-                merged_onset_times.append(current_onset_time)
-                merged_offset_times.append(current_offset_time)
-                merged_onset_indices.append(current_onset_index)
-                merged_offset_indices.append(current_offset_index)
-                current_onset_time, current_offset_time = onset_time, offset_time
-                current_onset_index, current_offset_index = onset_index, offset_index
-
-        # Append the last merged event
-        merged_onset_times.append(current_onset_time)
-        merged_offset_times.append(current_offset_time)
-        merged_onset_indices.append(current_onset_index)
-        merged_offset_indices.append(current_offset_index)
-
-        # Convert lists to numpy arrays
-        merged_onset_times = np.array(merged_onset_times)
-        merged_offset_times = np.array(merged_offset_times)
-        merged_onset_indices = np.array(merged_onset_indices)
-        merged_offset_indices = np.array(merged_offset_indices)
+        dt = time_axis[1] - time_axis[0] if time_axis.shape[0] > 1 else 1 / self.fr
+        onset_idx, offset_idx = merge_vr_events(
+            onset_idx, offset_idx, dt,
+            duration_th_secs=parameters['duration_th_secs'],
+            minimal_event_distance=parameters['minimal_event_distance']
+        )
 
         # Collect results
-        self.vr_events['onset_idx'] = merged_onset_indices
-        self.vr_events['offset_idx'] = merged_offset_indices
-        self.vr_events['onset_times'] = merged_onset_times
-        self.vr_events['offset_times'] = merged_offset_times
+        self.vr_events['onset_idx'] = onset_idx
+        self.vr_events['offset_idx'] = offset_idx
+        self.vr_events['onset_times'] = time_axis[onset_idx]
+        self.vr_events['offset_times'] = time_axis[offset_idx]
 
     def closeEvent(self, event):
         if self.main_window_running:
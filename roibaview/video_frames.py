@@ -0,0 +1,411 @@
+import os
+import shutil
+import threading
+import subprocess
+from collections import OrderedDict
+import numpy as np
+import cv2
+import tifffile
+
+
+def find_ffprobe(config=None):
+    # ffprobe is next to ffmpeg (see VideoConverter), otherwise it has to be on the PATH
+    if config is not None and 'FFMPEG' in config and config['FFMPEG'].get('dir', 'NaN') != 'NaN':
+        ffmpeg_dir = config['FFMPEG']['dir']
+        ffprobe = f'{os.path.split(ffmpeg_dir)[0]}/ffprobe' + ('.exe' if ffmpeg_dir.endswith('.exe') else '')
+        if os.path.exists(ffprobe):
+            return ffprobe
+    return shutil.which('ffprobe')
+
+
+def build_frame_index(video_file, ffprobe):
+    """ Time stamps of all frames and the positions of the key frames of a video (read from the packets, no decoding)
+
+    :return: frame_times (secs, display order), key_frames (frame numbers) or None, None
+    """
+    result = subprocess.run(
+        [ffprobe, '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'packet=pts_time,flags',
+         '-of', 'csv=p=0', video_file],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    times = []
+    is_key = []
+    for line in result.stdout.decode('utf-8').splitlines():
+        fields = line.strip().split(',')
+        if len(fields) < 2 or fields[0] in ('', 'N/A'):
+            continue
+        times.append(float(fields[0]))
+        is_key.append('K' in fields[1])
+    if len(times) == 0:
+        return None, None
+    # Packets are in decoding order, frames are shown in the order of their time stamps
+    order = np.argsort(times, kind='stable')
+    frame_times = np.array(times)[order]
+    key_frames = np.flatnonzero(np.array(is_key)[order])
+    return frame_times, key_frames
+
+
+def load_frame_index(video_file, ffprobe=None):
+    """ Frame index of a video, built once and cached next to the video (<video>.frame_index.npz)
+
+    The cache is only used if size and modification time of the video did not change.
+    :return: frame_times, key_frames or None, None (no ffprobe available)
+    """
+    index_file = f'{video_file}.frame_index.npz'
+    stat = os.stat(video_file)
+    if os.path.exists(index_file):
+        try:
+            with np.load(index_file) as index:
+                if index['video_size'] == stat.st_size and index['video_mtime'] == stat.st_mtime_ns:
+                    return index['frame_times'], index['key_frames']
+        except (OSError, KeyError, ValueError):
+            pass
+    if ffprobe is None:
+        return None, None
+    print('Building frame index (only once per video) ...')
+    frame_times, key_frames = build_frame_index(video_file, ffprobe)
+    if frame_times is None:
+        return None, None
+    try:
+        np.savez(index_file, frame_times=frame_times, key_frames=key_frames,
+                 video_size=stat.st_size, video_mtime=stat.st_mtime_ns)
+    except OSError:
+        print('WARNING: Could not store the frame index next to the video')
+    return frame_times, key_frames
+
+
+class FrameCache:
+    """ LRU cache of decoded frames that is limited by the number of bytes (not by the number of frames)
+
+    :param max_bytes: max. size of all cached frames together
+    """
+    def __init__(self, max_bytes=512 * 2**20):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.frames = OrderedDict()
+
+    def __contains__(self, idx):
+        return idx in self.frames
+
+    def get(self, idx):
+        frame = self.frames.get(idx)
+        if frame is not None:
+            # Most recently used frame goes to the end
+            self.frames.move_to_end(idx)
+        return frame
+
+    def put(self, idx, frame):
+        if idx in self.frames:
+            self.frames.move_to_end(idx)
+            return
+        self.frames[idx] = frame
+        self.n_bytes += frame.nbytes
+        # Remove the least recently used frames
+        while self.n_bytes > self.max_bytes and len(self.frames) > 1:
+            _, old_frame = self.frames.popitem(last=False)
+            self.n_bytes -= old_frame.nbytes
+
+    def clear(self):
+        self.frames.clear()
+        self.n_bytes = 0
+
+
+class VideoFrameReader:
+    """ Random access to the frames of a video file with a read-ahead thread
+
+    A background thread decodes the frames after the last requested frame in advance (sequential reads, no seeking),
+    so that playback only takes frames from the cache. Scrubbing to other frames decodes the frame directly and the
+    read ahead continues from there. All decoded frames are kept in a byte bounded LRU cache.
+
+    That's how you use it:
+        reader = VideoFrameReader('video.mp4')
+        frame = reader.get_frame(100)
+        reader.close()
+
+    :param video_file: path to the video file (everything cv2.VideoCapture can open)
+    :param cache_bytes: max. memory of the frame cache
+    :param read_ahead: number of frames that are decoded in advance (limited to the frames that fit into the cache)
+    :param frame_index: (frame_times, key_frames) of load_frame_index. With an index a seek jumps to the time stamp of
+        the key frame before the frame and decodes forward (at most one group of pictures). The decoded position is
+        checked with the time stamps, so frames are exact even if the seek of the container is not.
+    """
+    # Skipping up to this many frames forward is faster by decoding (grab) than by seeking
+    MAX_GRAB_FORWARD = 16
+
+    def __init__(self, video_file, cache_bytes=512 * 2**20, read_ahead=32, frame_index=None):
+        self.video_file = video_file
+        self.read_ahead = read_ahead
+        self.capture = cv2.VideoCapture(video_file)
+        self.frame_times, self.key_frames = frame_index if frame_index is not None else (None, None)
+        if self.frame_times is not None and len(self.key_frames) > 0:
+            self.total_frames = len(self.frame_times)
+        else:
+            self.key_frames = None
+            self.total_frames = int(self.capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.cache = FrameCache(cache_bytes)
+        # Index of the frame that the next capture.read() returns and of the last grabbed frame (retrieve() decodes it)
+        self.next_pos = 0
+        self.grabbed = None
+        self.current = 0
+        self.running = True
+        # capture_lock: only one thread decodes at a time, condition: protects the cache and wakes up the thread
+        self.capture_lock = threading.Lock()
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._read_ahead_loop, daemon=True)
+        self.thread.start()
+
+    def seek(self, idx):
+        # Move the capture so that the next read returns frame idx (or frame idx was the last grabbed frame)
+        if idx == self.next_pos or idx == self.grabbed:
+            return
+        if self.key_frames is not None:
+            # Jump to the key frame before idx (if we are not already behind it) and decode forward
+            k = max(np.searchsorted(self.key_frames, idx, side='right') - 1, 0)
+            if not (self.key_frames[k] <= self.next_pos <= idx):
+                self._seek_key_frame(k, idx)
+            self._grab_forward(idx)
+        elif self.next_pos >= 0 and 0 < idx - self.next_pos <= self.MAX_GRAB_FORWARD:
+            self._grab_forward(idx)
+        else:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, idx)
+            self.next_pos = idx
+            self.grabbed = None
+
+    def _seek_key_frame(self, k, idx):
+        # Seek by the time stamp of key frame k (see frame_index) and find out where the capture really is from the
+        # time stamp of the first decoded frame. If it landed behind idx, the key frame before is tried.
+        while k >= 0:
+            key_frame = self.key_frames[k]
+            self.capture.set(cv2.CAP_PROP_POS_MSEC, (self.frame_times[key_frame] - self.frame_times[0]) * 1000)
+            if not self.capture.grab():
+                break
+            pos = self._decoded_position()
+            if pos <= idx:
+                self.next_pos = pos + 1
+                self.grabbed = pos
+                return
+            k -= 1
+        # Start of the video
+        self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        self.next_pos = 0
+        self.grabbed = None
+
+    def _decoded_position(self):
+        # Frame number of the last decoded frame, from its time stamp (the frame in the index that is closest)
+        t = self.capture.get(cv2.CAP_PROP_POS_MSEC) / 1000 + self.frame_times[0]
+        k = int(np.searchsorted(self.frame_times, t))
+        if k > 0 and (k == len(self.frame_times) or t - self.frame_times[k - 1] < self.frame_times[k] - t):
+            k -= 1
+        return k
+
+    def _grab_forward(self, idx):
+        while self.next_pos < idx:
+            self.capture.grab()
+            self.next_pos += 1
+            self.grabbed = self.next_pos - 1
+
+    def _decode(self, idx, retry=True):
+        # Needs the capture_lock
+        self.seek(idx)
+        if self.grabbed == idx and self.next_pos == idx + 1:
+            ret, frame = self.capture.retrieve()
+        else:
+            ret, frame = self.capture.read()
+        if not ret:
+            # The capture position is unknown now
+            self.next_pos = -1
+            self.grabbed = None
+            return None
+        self.next_pos = idx + 1
+        self.grabbed = idx
+        if self.key_frames is not None:
+            # Check the decoded frame with the index
+            pos = self._decoded_position()
+            if pos != idx:
+                self.next_pos = pos + 1
+                self.grabbed = pos
+                if retry:
+                    return self._decode(idx, retry=False)
+                print(f'WARNING: Frame {idx} could not be decoded exactly, got frame {pos}')
+        return frame
+
+    def _next_missing_frame(self):
+        # First frame after the current frame that is not in the cache yet (None if all are cached)
+        for idx in range(self.current + 1, min(self.current + 1 + self.read_ahead, self.total_frames)):
+            if idx not in self.cache:
+                return idx
+        return None
+
+    def _read_ahead_loop(self):
+        while True:
+            with self.condition:
+                idx = self._next_missing_frame()
+                while self.running and idx is None:
+                    self.condition.wait()
+                    idx = self._next_missing_frame()
+                if not self.running:
+                    return
+            with self.capture_lock:
+                frame = self._decode(idx)
+            with self.condition:
+                if frame is None:
+                    # End of the video (the frame count in the meta data can be wrong)
+                    self.total_frames = min(self.total_frames, idx)
+                else:
+                    self._cache_frame(idx, frame)
+
+    def get_frame(self, idx):
+        with self.condition:
+            self.current = idx
+            frame = self.cache.get(idx)
+            self.condition.notify()
+        if frame is not None:
+            return frame
+
+        # Not decoded yet: decode it now (the read ahead thread waits meanwhile)
+        with self.capture_lock:
+            frame = self._decode(idx)
+        with self.condition:
+            if frame is not None:
+                self._cache_frame(idx, frame)
+            self.condition.notify()
+        return frame
+
+    def _cache_frame(self, idx, frame):
+        # Needs the condition. The current frame and the read ahead window must fit into the cache together, otherwise
+        # every new frame would evict one of the window and the thread would decode (and seek) forever
+        self.read_ahead = min(self.read_ahead, max(self.cache.max_bytes // max(frame.nbytes, 1) - 1, 0))
+        self.cache.put(idx, frame)
+
+    def close(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
+        self.capture.release()
+        self.cache.clear()
+
+
+class TiffFrameReader:
+    """ Random access to the pages (frames) of a tiff stack
+
+    Three ways to get a frame, the fastest one that works for this file is used:
+        1. tifffile.memmap: uncompressed, contiguous stacks are memory mapped as one array
+        2. page offset index: uncompressed pages (not contiguous as a whole) are memory mapped one by one. The offsets
+           are read once and cached next to the file (<tiff>.page_index.npz), so the IFDs are never parsed again.
+        3. compressed stacks: pages are decoded by tifffile and kept in a byte bounded LRU cache
+    Frames of 1. and 2. are zero copy views into the file.
+
+    :param tiff_file: path to the tiff file
+    :param cache_bytes: max. memory of the frame cache (only for compressed stacks)
+    """
+    def __init__(self, tiff_file, cache_bytes=512 * 2**20):
+        self.tiff_file = tiff_file
+        self.stack = None
+        self.file_map = None
+        self.tif = None
+        self.cache = FrameCache(cache_bytes)
+        with tifffile.TiffFile(tiff_file) as tif:
+            n_pages = len(tif.pages)
+            page_shape = tif.pages[0].shape
+        try:
+            stack = tifffile.memmap(tiff_file, mode='r')
+            # tifffile.memmap maps only the first series: use it only if it contains all pages
+            if stack.size != n_pages * int(np.prod(page_shape)):
+                raise ValueError('The memory map does not contain all pages')
+            self.stack = stack.reshape((n_pages,) + tuple(page_shape))
+            self.total_frames = n_pages
+            self.mode = 'memmap'
+        except ValueError:
+            self._open_page_index()
+
+    def _open_page_index(self):
+        index_file = f'{self.tiff_file}.page_index.npz'
+        stat = os.stat(self.tiff_file)
+        index = None
+        if os.path.exists(index_file):
+            try:
+                with np.load(index_file) as cached:
+                    if cached['file_size'] == stat.st_size and cached['file_mtime'] == stat.st_mtime_ns:
+                        index = dict(cached)
+            except (OSError, KeyError, ValueError):
+                index = None
+
+        if index is None:
+            index = self._build_page_index()
+            if index is not None:
+                index['file_size'] = stat.st_size
+                index['file_mtime'] = stat.st_mtime_ns
+                try:
+                    np.savez(index_file, **index)
+                except OSError:
+                    print('WARNING: Could not store the page index next to the tiff file')
+
+        if index is not None:
+            self.offsets = index['offsets']
+            self.page_shape = tuple(index['page_shape'])
+            self.dtype = np.dtype(str(index['dtype']))
+            self.page_bytes = int(np.prod(self.page_shape)) * self.dtype.itemsize
+            self.file_map = np.memmap(self.tiff_file, dtype=np.uint8, mode='r')
+            self.total_frames = self.offsets.shape[0]
+            self.mode = 'page_index'
+        else:
+            # Compressed pages have to be decoded, the parsed pages are kept by tifffile
+            self.tif = tifffile.TiffFile(self.tiff_file)
+            self.tif.pages.cache = True
+            self.total_frames = len(self.tif.pages)
+            self.mode = 'decoder'
+
+    def _build_page_index(self):
+        # Data offset of every page, or None if a page is not stored as one plain (compressed, tiled, packed bits, ...)
+        # image in the byte order of page_shape
+        with tifffile.TiffFile(self.tiff_file) as tif:
+            first = tif.pages[0]
+            page_shape = first.shape
+            dtype = first.dtype.newbyteorder(tif.byteorder)
+            offsets = np.empty(len(tif.pages), dtype=np.int64)
+            for k, page in enumerate(tif.pages):
+                if page.compression != 1 or page.shape != page_shape or page.dtype != first.dtype:
+                    return None
+                if not self._page_is_plain(page):
+                    return None
+                data_offsets = page.dataoffsets
+                byte_counts = page.databytecounts
+                if sum(byte_counts) != int(np.prod(page_shape)) * dtype.itemsize:
+                    return None
+                for j in range(1, len(data_offsets)):
+                    if data_offsets[j] != data_offsets[j - 1] + byte_counts[j - 1]:
+                        return None
+                offsets[k] = data_offsets[0]
+        return dict(offsets=offsets, page_shape=np.array(page_shape), dtype=dtype.str)
+
+    @staticmethod
+    def _page_is_plain(page):
+        # Strips (not tiles), whole bytes per sample and a sample layout that matches page.shape:
+        # one sample: (height, width), contiguous: (height, width, samples), separate planes: (samples, height, width)
+        if page.is_tiled or page.imagedepth != 1 or page.bitspersample != page.dtype.itemsize * 8:
+            return False
+        height, width, samples = page.imagelength, page.imagewidth, page.samplesperpixel
+        if samples == 1:
+            return page.shape == (height, width)
+        if int(page.planarconfig) == 1:
+            return page.shape == (height, width, samples)
+        return page.shape == (samples, height, width)
+
+    def get_frame(self, idx):
+        if self.mode == 'memmap':
+            return self.stack[idx]
+        if self.mode == 'page_index':
+            start = self.offsets[idx]
+            return self.file_map[start:start + self.page_bytes].view(self.dtype).reshape(self.page_shape)
+        frame = self.cache.get(idx)
+        if frame is None:
+            frame = self.tif.pages[idx].asarray()
+            self.cache.put(idx, frame)
+        return frame
+
+    def close(self):
+        self.stack = None
+        self.file_map = None
+        if self.tif is not None:
+            self.tif.close()
+        self.cache.clear()
@@ -1,64 +1,45 @@
-import cv2
+import os
+import time
 import zipfile
-import tifffile
 from PyQt6 import QtGui
-from PyQt6.QtCore import Qt, QTimer, pyqtSignal, QUrl
+from PyQt6.QtCore import Qt, QTimer, pyqtSignal, QUrl, QPointF
 from PyQt6.QtWidgets import QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QLabel, QSlider, QPushButton, QFileDialog, QGraphicsItemGroup
 import pyqtgraph as pg
 from pyqtgraph import ImageView
 from roibaview.gui import SimpleInputDialog
+from roibaview.video_frames import VideoFrameReader, TiffFrameReader, find_ffprobe, load_frame_index
+from roibaview.roi_traces import roi_masks, roi_names, extract_roi_traces, roi_label_grid, roi_outline_path, roi_centroids
 from roifile import ImagejRoi
 from IPython import embed
 import numpy as np
 
 
-class ClickableScatterPlotItem(pg.ScatterPlotItem):
-    HoverEventSignal = pyqtSignal()
-
-    def __init__(self, *args, roi_index=None, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.roi_index = roi_index  # Store the ROI index for identification
-        self.default_brush = self.opts['brush']  # Save the default brush color
-        self.hover_brush = pg.mkBrush(255, 255, 0)  # Yellow for hover
-        self.clicked_brush = pg.mkBrush(255, 0, 0)  # Red for click
-        self.is_hovered = False
-
-    def hoverEvent(self, ev):
-        if ev.isExit():
-            # Restore the default color when the mouse leaves the ROI
-            self.setBrush(self.default_brush)
-            self.is_hovered = False
-        elif ev.isEnter():
-            # Change to hover color when the mouse enters the ROI
-            self.setBrush(self.hover_brush)
-            self.is_hovered = True
-            self.HoverEventSignal.emit()
-
-    def mouseClickEvent(self, ev):
-        if ev.button() == Qt.MouseButton.LeftButton:  # Only handle left button clicks
-            if not self.is_hovered:
-                # Change to clicked color when the ROI is clicked
-                self.setBrush(self.clicked_brush)
-                print(f"Clicked on ROI {self.roi_index + 1}")
-            else:
-                # If it's already hovered, restore the default color
-                self.setBrush(self.default_brush)
-                self.is_hovered = False
-
-
 class VideoViewer(QMainWindow):
 
     FrameChanged = pyqtSignal()
     VideoLoaded = pyqtSignal()
     TimePoint = pyqtSignal(float)
     ConnectToDataTrace = pyqtSignal(bool)
+    # traces (frames, rois), sampling rate, time offset, roi names, data set name
+    TracesExtracted = pyqtSignal(object, float, float, object, str)
 
-    def __init__(self):
+    def __init__(self, config=None):
         super().__init__()
 
+        # Needed to find ffprobe (frame index for fast and exact seeking)
+        self.config = config
         self.video_file = None
         self.current_frame = 0
         self.time_offset = 0
+        # All loaded ROIs (self.rois is only used for the next overlay)
+        self.roi_list = None
+        # ROI overlay: all outlines in one item, centroids in one scatter, one label for the ROI under the mouse
+        self.roi_overlay_items = []
+        self.roi_label_grid = None
+        self.roi_centroids = None
+        self.roi_hover_index = -1
+        self.roi_highlight = None
+        self.roi_hover_label = None
 
         self.setWindowTitle("Video Viewer")
         self.setGeometry(100, 100, 800, 600)
@@ -78,8 +59,9 @@ class VideoViewer(QMainWindow):
 
         self.image_view = ImageView(self)
 
-        # Connect Mouse Click
-        # self.image_view.scene.sigMouseClicked.connect(self.mouse_clicked)
+        # Connect Mouse Click and Hover (ROI lookup)
+        self.image_view.scene.sigMouseClicked.connect(self.mouse_clicked)
+        self.image_view.scene.sigMouseMoved.connect(self.mouse_moved)
 
         # self.layout.addWidget(self.video_label)
         # self.layout.addWidget(self.video_info_label)
@@ -131,6 +113,10 @@ class VideoViewer(QMainWindow):
         self.load_roi_button.clicked.connect(self.open_roi_file_dialog)
         self.control_button_layout.addWidget(self.load_roi_button)
 
+        self.extract_traces_button = QPushButton("Extract Traces", self)
+        self.extract_traces_button.clicked.connect(self.extract_traces)
+        self.control_button_layout.addWidget(self.extract_traces_button)
+
         # Slider
         self.frame_slider = QSlider(Qt.Orientation.Horizontal, self)
         # self.frame_slider.setTickPosition(QSlider.TickPosition.TicksBothSides)
@@ -142,7 +128,7 @@ class VideoViewer(QMainWindow):
         self.current_frame_label = QLabel("Current Frame: 0", self)
         self.control_button_layout.addWidget(self.current_frame_label)
 
-        self.current_speed_label = QLabel(", speed lvl: 3", self)
+        self.current_speed_label = QLabel(", speed: 1x", self)
         self.control_button_layout.addWidget(self.current_speed_label)
 
         self.controls_layout.addWidget(self.frame_slider)
@@ -164,7 +150,37 @@ class VideoViewer(QMainWindow):
             self, "Select ROI File", "", "ROI Files (*.roi *.zip)"
         )
         if roi_file:
-            self.rois = self.load_rois(roi_file)
+            rois = self.load_rois(roi_file)
+            # The label grid and the centroids describe the old ROIs: no lookup until the new overlay is drawn
+            self.clear_roi_lookup()
+            self.roi_list = rois
+            if self.video_frame is not None:
+                self.overlay_rois(roi_color=(0, 255, 0), font_size=16)
+            else:
+                # Drawn with the first frame
+                self.rois = rois
+            self.extract_traces_button.setDisabled(self.captured_video is None)
+
+    def clear_roi_lookup(self):
+        self.roi_label_grid = None
+        self.roi_centroids = None
+        self.clear_roi_hover()
+
+    def clear_roi_hover(self):
+        self.roi_hover_index = -1
+        if self.roi_hover_label is not None:
+            self.roi_highlight.setData([], [])
+            self.roi_hover_label.hide()
+
+    def extract_traces(self):
+        # Mean value of every ROI in every frame, the result is sent to the data sets of the main window
+        if self.captured_video is None or self.roi_list is None:
+            return
+        masks = roi_masks(self.roi_list, self.video_frame.shape)
+        print(f'Extracting traces of {len(self.roi_list)} ROIs from {self.total_frames} frames ...')
+        traces = extract_roi_traces(self.captured_video.get_frame, self.total_frames, masks)
+        data_set_name = os.path.splitext(os.path.split(self.video_file)[1])[0] + '_traces'
+        self.TracesExtracted.emit(traces, self.fps, self.time_offset, roi_names(self.roi_list), data_set_name)
 
     def load_rois(self, roi_zip_path):
         """Load ROIs from an ImageJ ROI zip file."""
@@ -181,41 +197,61 @@ class VideoViewer(QMainWindow):
         return rois
 
     def overlay_rois(self, roi_color, font_size):
-        """Overlay ROIs and their labels on the image."""
-        for index, roi in enumerate(self.rois):
-            # Get ROI coordinates
-            coordinates = np.array(roi.coordinates())
-            if len(coordinates) == 0:
-                continue
-
-            # Draw ROI as a scatter plot and make it clickable and hoverable
-            rois_line_plot = pg.PlotDataItem(coordinates[:, 0], coordinates[:, 1], pen=pg.mkPen(255, 255, 255, width=2))
-            self.image_view.addItem(rois_line_plot)
-
-            scatter = ClickableScatterPlotItem(pos=coordinates, pen=None, brush=pg.mkBrush(roi_color), size=5,
-                                               roi_index=index)
-            self.image_view.addItem(scatter)
-
-
-
-        for index, roi in enumerate(self.rois):
-            # Get ROI coordinates
-            coordinates = np.array(roi.coordinates())
-            if len(coordinates) == 0:
-                continue
-            # Add a label next to the ROI
-            label_text = f"{index + 1}"  # Example: "ROI 1", "ROI 2", etc.
-            label_position = np.median(coordinates, axis=0)
-            text_item = pg.TextItem(text=label_text, color=(255, 255, 255))
-
-            # Set the font size
-            font = QtGui.QFont()
-            font.setPointSize(font_size)
-            text_item.setFont(font)
-
-            # Position the label with a slight offset
-            text_item.setPos(label_position[0] - 5, label_position[1] - 5)
-            self.image_view.addItem(text_item)
+        """Overlay ROIs on the image (drawn once, the items stay when the frame changes)."""
+        for item in self.roi_overlay_items:
+            self.image_view.removeItem(item)
+
+        # All outlines as one line item
+        x, y, connect = roi_outline_path(self.roi_list)
+        outlines = pg.PlotCurveItem(x, y, connect=connect, pen=pg.mkPen(255, 255, 255, width=2))
+        # One scatter with the centre of every ROI
+        self.roi_centroids = roi_centroids(self.roi_list)
+        valid = ~np.isnan(self.roi_centroids[:, 0])
+        centroids = pg.ScatterPlotItem(pos=self.roi_centroids[valid], pen=None, brush=pg.mkBrush(roi_color), size=5)
+        # Outline and label of the ROI under the mouse
+        self.roi_highlight = pg.PlotCurveItem(pen=pg.mkPen(255, 255, 0, width=2))
+        self.roi_hover_label = pg.TextItem(text='', color=(255, 255, 0))
+        font = QtGui.QFont()
+        font.setPointSize(font_size)
+        self.roi_hover_label.setFont(font)
+        self.roi_hover_label.hide()
+
+        self.roi_overlay_items = [outlines, centroids, self.roi_highlight, self.roi_hover_label]
+        for item in self.roi_overlay_items:
+            self.image_view.addItem(item)
+        self.rotate_overlay()
+
+        # Pixel --> ROI lookup for hover and click
+        self.roi_label_grid = roi_label_grid(self.roi_list, self.video_frame.shape)
+        self.roi_hover_index = -1
+
+    def roi_at(self, scene_pos):
+        # Index of the ROI at the scene position (-1: no ROI)
+        if self.roi_label_grid is None:
+            return -1
+        image_pos = self.image_view.getImageItem().mapFromScene(scene_pos)
+        col, row = int(np.floor(image_pos.x())), int(np.floor(image_pos.y()))
+        if 0 <= row < self.roi_label_grid.shape[0] and 0 <= col < self.roi_label_grid.shape[1]:
+            return self.roi_label_grid[row, col] - 1
+        return -1
+
+    def mouse_moved(self, scene_pos):
+        index = self.roi_at(scene_pos)
+        if index == self.roi_hover_index:
+            return
+        self.roi_hover_index = index
+        if index < 0:
+            self.roi_highlight.setData([], [])
+            self.roi_hover_label.hide()
+            return
+        coordinates = np.array(self.roi_list[index].coordinates())
+        coordinates = np.vstack([coordinates, coordinates[:1]])
+        self.roi_highlight.setData(coordinates[:, 0], coordinates[:, 1])
+        self.roi_hover_label.setText(f'{index + 1}')
+        # The label is not rotated, only its position
+        label_position = self.display_transform().map(QPointF(*self.roi_centroids[index]))
+        self.roi_hover_label.setPos(label_position.x() - 5, label_position.y() - 5)
+        self.roi_hover_label.show()
 
     def _reset_video_viewer(self):
         self.image_view.clear()
@@ -231,6 +267,11 @@ class VideoViewer(QMainWindow):
         self.ms_per_frame = [1, 2, 3, 5, 10, 15, 30, 60, 90, 120, 150, 200, 500, 1000]
         self.ms_per_frame_base = 30
         self.ms_per_frame_id = 6
+        # Playback clock (see play_video)
+        self.play_start_time = 0
+        self.play_start_frame = 0
+        self.play_last_frame = 0
+        self.dropped_frames = 0
         self.is_tiff = False
         self.connected_to_data_trace = False
         self.fps = None
@@ -257,12 +298,9 @@ class VideoViewer(QMainWindow):
         key_modifier = event.modifiers()
         # if the click is inside the bounding box of the plot
         if vb.boundingRect().contains(scene_coords):
-            mouse_point = vb.mapSceneToView(scene_coords)
-            mx = mouse_point.x()
-            my = mouse_point.y()
-            print(mx, my)
-            # self.roi_circle = (int(mx), int(my))
-            # self.update_frame()
+            index = self.roi_at(scene_coords)
+            if index >= 0:
+                print(f"Clicked on ROI {index + 1}")
 
     def open_file_dialog(self):
         input_file, _ = QFileDialog.getOpenFileName(
@@ -290,29 +328,31 @@ class VideoViewer(QMainWindow):
         if self.video_file.endswith(('.tif', '.tiff', '.TIF', '.TIFF')):
             # This is a tiff file
 
-            # Open the TIFF file in a memory-mapped mode
-            self.captured_video = tifffile.TiffFile(video_file, mode='r')
+            # Open the TIFF file in a memory-mapped mode (or with cached page decoding if it is compressed)
+            self.captured_video = TiffFrameReader(video_file)
             # Get the number of pages (image stack size)
-            self.total_frames = len(self.captured_video.pages)
+            self.total_frames = self.captured_video.total_frames
             self.is_tiff = True
             # Read one frame
-            self.video_frame = self.captured_video.pages.get(0).asarray()
+            self.video_frame = self.captured_video.get_frame(0)
         else:
             # This is a video file
-            # OpenCV Method:
-            self.captured_video = cv2.VideoCapture(self.video_file)
+            # OpenCV with a read ahead thread, a frame cache and a key frame index (if ffprobe is available):
+            frame_index = load_frame_index(self.video_file, find_ffprobe(self.config))
+            self.captured_video = VideoFrameReader(
+                self.video_file, frame_index=frame_index if frame_index[0] is not None else None)
 
             # This is the frame rate in the video files meta data. This can be wrong!
-            # self.fps = self.captured_video.get(cv2.CAP_PROP_FPS)
-            self.total_frames = int(self.captured_video.get(cv2.CAP_PROP_FRAME_COUNT))
+            # self.fps = self.captured_video.capture.get(cv2.CAP_PROP_FPS)
+            self.total_frames = self.captured_video.total_frames
 
-            self.captured_video.set(cv2.CAP_PROP_POS_FRAMES, self.current_frame - 1)
-            ret, self.video_frame = self.captured_video.read()
+            self.video_frame = self.captured_video.get_frame(self.current_frame)
             self.is_tiff = False
 
+        self.rotate_overlay()
         self.frame_slider.setRange(0, self.total_frames - 1)
         self.current_frame_label.setText(f"Current Frame: {self.current_frame}")
-        self.image_view.setImage(self.rotate_frame(self.video_frame), autoLevels=True)
+        self.image_view.setImage(self.video_frame, autoLevels=True, transform=self.display_transform())
         self.frame_slider.setValue(0)
         self.video_label.setText(f'Sampling Rate: {self.fps:.2f} Hz')
 
@@ -331,16 +371,29 @@ class VideoViewer(QMainWindow):
         self.faster_button.setDisabled(state)
         self.slower_button.setDisabled(state)
         self.connect_video_to_data_trace_button.setDisabled(state)
+        self.extract_traces_button.setDisabled(state or self.roi_list is None)
+
+    def playback_speed(self):
+        # Speed factor of the current speed level (1: real time)
+        return self.ms_per_frame_base / self.ms_per_frame[self.ms_per_frame_id]
+
+    def update_speed_label(self):
+        self.current_speed_label.setText(f', speed: {self.playback_speed():g}x, dropped frames: {self.dropped_frames}')
 
     def play_video(self):
         if self.video_frame is None:
             return
-        # ms = 33
-        # self.timer.start(ms)  # 30 frames per second (33 milliseconds per frame)
-        # ms = self.ms_per_frame[self.ms_per_frame_id]
-        ms = int((1 / self.fps)*1000)
-        print(ms, end='\r')
-        self.timer.start(ms)  # 30 frames per second (33 milliseconds per frame)
+        # The frame to show is computed from the elapsed (wall clock) time, so playback does not fall behind when
+        # decoding is slower than real time (frames are skipped instead)
+        self.play_start_time = time.perf_counter()
+        self.play_start_frame = self.current_frame
+        self.play_last_frame = self.current_frame
+        self.dropped_frames = 0
+        self.update_speed_label()
+        # The timer only asks for new frames, at most 100 times per second
+        ms = max(int(1000 / (self.fps * self.playback_speed())), 10)
+        self.timer.setTimerType(Qt.TimerType.PreciseTimer)
+        self.timer.start(ms)
 
     def pause_video(self):
         self.timer.stop()
@@ -349,39 +402,51 @@ class VideoViewer(QMainWindow):
         self.timer.stop()
         self.current_frame = 0
         if self.captured_video is not None:
-            if self.is_tiff:
-                self.video_frame = self.captured_video.pages.get(self.current_frame).asarray()
-            else:
-                self.captured_video.set(cv2.CAP_PROP_POS_FRAMES, self.current_frame - 1)
-                ret, self.video_frame = self.captured_video.read()
+            self.video_frame = self.captured_video.get_frame(self.current_frame)
 
-            self.image_view.setImage(self.rotate_frame(self.video_frame), autoLevels=True)
+            self.image_view.setImage(self.video_frame, autoLevels=True, transform=self.display_transform())
             self.current_frame_label.setText(f"Current Frame: {self.current_frame}")
             self.frame_slider.setValue(0)
 
     def speed_up(self):
         if self.ms_per_frame_id > 0:
             self.ms_per_frame_id -= 1
-            self.current_speed_label.setText(f', speed lvl: {self.ms_per_frame_id}')
             self.timer.stop()
             self.play_video()
 
     def slow_down(self):
         if self.ms_per_frame_id < len(self.ms_per_frame) - 1:
             self.ms_per_frame_id += 1
-            self.current_speed_label.setText(f', speed lvl: {self.ms_per_frame_id}')
             self.timer.stop()
             self.play_video()
 
     def update_frame(self):
         # Update frame while playing video
         if self.captured_video is not None:
-            self.current_frame += 1
-            if self.current_frame >= self.total_frames:
-                self.current_frame = 0
-            self.change_frame(self.current_frame)
+            if self.current_frame != self.play_last_frame:
+                # The frame was changed by the user (slider) while playing: continue from there
+                self.play_start_time = time.perf_counter()
+                self.play_start_frame = self.current_frame
+                self.play_last_frame = self.current_frame
+            elapsed = time.perf_counter() - self.play_start_time
+            target_frame = self.play_start_frame + int(elapsed * self.fps * self.playback_speed())
+            if target_frame == self.current_frame:
+                return
+            if target_frame >= self.total_frames:
+                # Start again from the beginning
+                target_frame = 0
+                self.play_start_time = time.perf_counter()
+                self.play_start_frame = 0
+            elif target_frame > self.current_frame + 1:
+                self.dropped_frames += target_frame - self.current_frame - 1
+                self.update_speed_label()
+            self.change_frame(target_frame)
+            self.play_last_frame = self.current_frame
             # self.FrameChanged.emit()
+            # The frame is already shown, so the slider must not load it again
+            self.frame_slider.blockSignals(True)
             self.frame_slider.setValue(self.current_frame)
+            self.frame_slider.blockSignals(False)
 
     def change_frame(self, frame):
         if self.captured_video is not None:
@@ -390,18 +455,15 @@ class VideoViewer(QMainWindow):
                 self.current_frame = 0
 
             self.FrameChanged.emit()
-            if self.is_tiff:
-                self.video_frame = self.captured_video.pages.get(self.current_frame).asarray()
-            else:
-                # Capture the next frame
-                self.captured_video.set(cv2.CAP_PROP_POS_FRAMES, self.current_frame - 1)
-                ret, self.video_frame = self.captured_video.read()
-                if not ret:
-                    return
+            # Get the frame (videos: sequential playback is decoded in advance, tiff: memory mapped)
+            frame = self.captured_video.get_frame(self.current_frame)
+            if frame is None:
+                return
+            self.video_frame = frame
 
             current_time_point = (self.current_frame/self.fps) + self.time_offset
             self.current_frame_label.setText(f"Current Frame / Time: {self.current_frame} / {current_time_point:.2f}")
-            self.image_view.setImage(self.rotate_frame(self.video_frame), autoLevels=False)
+            self.image_view.setImage(self.video_frame, autoLevels=False, transform=self.display_transform())
             # Draw the ROIs on the new frame
             self.TimePoint.emit(current_time_point)
 
@@ -418,27 +480,37 @@ class VideoViewer(QMainWindow):
             self.connected_to_data_trace = False
             self.connect_video_to_data_trace_button.setText("Connect to Data")
 
-    def rotate_frame(self, frame):
+    def display_transform(self):
+        # Rotation (clockwise) of the image item, so the frames themselves are never copied for rotating
+        # Image item coordinates: x = column (0 ... width), y = row (0 ... height)
+        height, width = self.video_frame.shape[:2]
+        transform = QtGui.QTransform()
         if self.rotation_angle == 90:
-            return cv2.rotate(frame, cv2.ROTATE_90_CLOCKWISE)
+            transform.translate(height, 0).rotate(90)
         elif self.rotation_angle == 180:
-            return cv2.rotate(frame, cv2.ROTATE_180)
+            transform.translate(width, height).rotate(180)
         elif self.rotation_angle == 270:
-            return cv2.rotate(frame, cv2.ROTATE_90_COUNTERCLOCKWISE)
-        else:
-            return frame
+            transform.translate(0, width).rotate(270)
+        return transform
+
+    def rotate_overlay(self):
+        # ROI outlines are in image coordinates, so they get the same transform as the image
+        transform = self.display_transform()
+        for item in self.roi_overlay_items:
+            if item is not self.roi_hover_label:
+                item.setTransform(transform)
+        self.clear_roi_hover()
 
     def rotate_video(self):
         if self.captured_video is not None:
             self.rotation_angle = (self.rotation_angle + 90) % 360
+            self.rotate_overlay()
             self.change_frame(self.current_frame)
+            self.image_view.autoRange()
 
     def close_file(self):
-        if self.is_tiff:
-            # Close the TIFF file
-            self.captured_video.close()
-        else:
-            self.captured_video.release()
+        # Stops the read ahead thread (videos) or closes the TIFF file
+        self.captured_video.close()
 
     def closeEvent(self, event):
         if self.captured_video is not None:
@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+from scipy import signal
+from roibaview.peak_tables import PeakCandidates
+
+PARAMETER_SETS = [
+    dict(distance=3),
+    dict(distance=20),
+    dict(height=2, distance=7),
+    dict(threshold=1, distance=5),
+    dict(prominence=2, distance=10),
+    dict(height=1, prominence=1, width=1.5, distance=4),
+]
+
+
+def assert_same_as_find_peaks(trace, parameters):
+    peaks, props = signal.find_peaks(trace, **parameters)
+    selected, selected_props = PeakCandidates(trace).select(**parameters)
+    np.testing.assert_array_equal(selected, peaks)
+    assert selected_props.keys() == props.keys()
+    for k in props:
+        np.testing.assert_allclose(selected_props[k], props[k])
+
+
+@pytest.mark.parametrize('parameters', PARAMETER_SETS)
+def test_tied_heights(parameters):
+    # Integer (quantized) traces: many peaks with the same height
+    rng = np.random.default_rng(0)
+    for n in [10, 100, 3000]:
+        for _ in range(20):
+            assert_same_as_find_peaks(rng.integers(0, 5, n).astype(float), parameters)
+
+
+@pytest.mark.parametrize('parameters', PARAMETER_SETS)
+def test_float_trace(parameters):
+    rng = np.random.default_rng(1)
+    trace = np.cumsum(rng.normal(0, 1, 5000)).astype(np.float32)
+    assert_same_as_find_peaks(trace, parameters)
+
+
+def test_no_peaks():
+    selected, _ = PeakCandidates(np.arange(10.0)).select(distance=3)
+    assert selected.shape == (0,)
@@ -0,0 +1,152 @@
+import time
+import numpy as np
+import pytest
+import cv2
+import tifffile
+from roibaview import video_frames
+from roibaview.video_frames import VideoFrameReader, TiffFrameReader
+
+
+class FakeCapture:
+    # Stands in for cv2.VideoCapture: frame k is filled with the value k, reads and seeks are counted
+    def __init__(self, video_file, n_frames=200, frame_shape=(64, 64, 3)):
+        self.n_frames = n_frames
+        self.frame_shape = frame_shape
+        self.pos = 0
+        self.last = None
+        self.n_reads = 0
+        self.n_seeks = 0
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FRAME_COUNT:
+            return self.n_frames
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            return self.pos
+        return 0
+
+    def set(self, prop, value):
+        self.n_seeks += 1
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            self.pos = int(value)
+        return True
+
+    def grab(self):
+        if self.pos >= self.n_frames:
+            return False
+        self.last = self.pos
+        self.pos += 1
+        return True
+
+    def retrieve(self):
+        if self.last is None:
+            return False, None
+        self.n_reads += 1
+        return True, np.full(self.frame_shape, self.last % 256, dtype=np.uint8)
+
+    def read(self):
+        if not self.grab():
+            return False, None
+        return self.retrieve()
+
+    def release(self):
+        pass
+
+
+def test_read_ahead_stops_when_the_cache_is_small(monkeypatch):
+    monkeypatch.setattr(video_frames.cv2, 'VideoCapture', FakeCapture)
+    frame_bytes = 64 * 64 * 3
+    # The cache holds 20 frames, the read ahead asks for 32
+    reader = VideoFrameReader('fake.mp4', cache_bytes=20 * frame_bytes, read_ahead=32)
+    try:
+        assert reader.get_frame(0)[0, 0, 0] == 0
+        time.sleep(0.3)
+        n_reads, n_seeks = reader.capture.n_reads, reader.capture.n_seeks
+        # Idle: the read ahead window is complete, nothing is decoded any more
+        time.sleep(0.5)
+        assert reader.capture.n_reads == n_reads
+        assert reader.capture.n_seeks == n_seeks
+        assert reader.read_ahead < 20
+        for idx in range(1, reader.read_ahead + 1):
+            assert idx in reader.cache
+    finally:
+        reader.close()
+
+
+def test_frames_in_order(monkeypatch):
+    monkeypatch.setattr(video_frames.cv2, 'VideoCapture', FakeCapture)
+    reader = VideoFrameReader('fake.mp4', read_ahead=8)
+    try:
+        for idx in list(range(0, 50)) + [150, 3, 199, 100]:
+            assert reader.get_frame(idx)[0, 0, 0] == idx
+    finally:
+        reader.close()
+
+
+class FakeKeyFrameCapture(FakeCapture):
+    # Key frame every 10 frames at 25 fps. Seeking by time is inexact: it lands on the first key frame after the time.
+    FPS = 25
+    KEY_FRAMES = np.arange(0, 200, 10)
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_POS_MSEC:
+            return 0 if self.last is None else self.last / self.FPS * 1000
+        return super().get(prop)
+
+    def set(self, prop, value):
+        if prop == cv2.CAP_PROP_POS_MSEC:
+            self.n_seeks += 1
+            target = int(round(value / 1000 * self.FPS))
+            later = self.KEY_FRAMES[self.KEY_FRAMES > target]
+            self.pos = int(later[0]) if later.shape[0] > 0 else self.n_frames
+            return True
+        return super().set(prop, value)
+
+
+def test_seek_with_frame_index(monkeypatch):
+    monkeypatch.setattr(video_frames.cv2, 'VideoCapture', FakeKeyFrameCapture)
+    frame_index = (np.arange(200) / FakeKeyFrameCapture.FPS, FakeKeyFrameCapture.KEY_FRAMES)
+    reader = VideoFrameReader('fake.mp4', read_ahead=0, frame_index=frame_index)
+    try:
+        assert reader.total_frames == 200
+        for idx in [150, 10, 3, 199, 100, 101, 55, 0, 120]:
+            assert reader.get_frame(idx)[0, 0, 0] == idx
+    finally:
+        reader.close()
+
+
+def test_tiff_stack(tmp_path):
+    stack = np.arange(10 * 8 * 6, dtype=np.uint16).reshape(10, 8, 6)
+    tiff_file = str(tmp_path / 'stack.tif')
+    tifffile.imwrite(tiff_file, stack)
+    reader = TiffFrameReader(tiff_file)
+    assert reader.mode == 'memmap' and reader.total_frames == 10
+    np.testing.assert_array_equal(reader.get_frame(9), stack[9])
+    reader.close()
+
+
+@pytest.mark.parametrize('compression', [None, 'zlib'])
+def test_multi_series_tiff(tmp_path, compression):
+    # Two series (1 and 9 pages): tifffile.memmap would only see the first one
+    stack = np.arange(10 * 8 * 6, dtype=np.uint16).reshape(10, 8, 6)
+    tiff_file = str(tmp_path / 'series.tif')
+    with tifffile.TiffWriter(tiff_file) as tif:
+        tif.write(stack[:1], compression=compression)
+        tif.write(stack[1:], compression=compression)
+    reader = TiffFrameReader(tiff_file)
+    assert reader.mode != 'memmap'
+    assert reader.total_frames == 10
+    for idx in [0, 5, 9]:
+        np.testing.assert_array_equal(reader.get_frame(idx), stack[idx])
+    reader.close()
+
+
+def test_tiled_tiff(tmp_path):
+    stack = np.arange(4 * 32 * 32, dtype=np.uint8).reshape(4, 32, 32)
+    tiff_file = str(tmp_path / 'tiled.tif')
+    with tifffile.TiffWriter(tiff_file) as tif:
+        for frame in stack:
+            tif.write(frame, tile=(16, 16), metadata=None)
+    reader = TiffFrameReader(tiff_file)
+    assert reader.mode == 'decoder'
+    np.testing.assert_array_equal(reader.get_frame(3), stack[3])
+    reader.close()
@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+from benchmarks.bench_vr_concatenation import FR, make_synthetic_sweep, legacy_transform
+from roibaview.ventral_root import transform_ventral_root_recording, convert_time_stamps_to_secs
+
+
+@pytest.mark.parametrize('gap_secs', [0.5, 0, 1.2345, 7])
+def test_same_values_as_np_append(tmp_path, gap_secs):
+    vr_files = make_synthetic_sweep(str(tmp_path), n_files=4, secs_per_file=1, gap_secs=gap_secs)
+    legacy_values = legacy_transform(vr_files, FR)
+    vr_trace = transform_ventral_root_recording(vr_files, FR)
+    np.testing.assert_array_equal(vr_trace['Volt'].to_numpy(), legacy_values)
+
+
+def test_first_file_missing(tmp_path):
+    vr_files = make_synthetic_sweep(str(tmp_path), n_files=2, secs_per_file=1)
+    legacy_values = np.append(np.zeros(FR * 60), legacy_transform(vr_files, FR))
+    vr_trace = transform_ventral_root_recording(vr_files, FR, first_file_missing=60)
+    np.testing.assert_array_equal(vr_trace['Volt'].to_numpy(), legacy_values)
+
+
+def test_time_stamps_before_10_am():
+    assert convert_time_stamps_to_secs(93417.4532) == 9 * 3600 + 34 * 60 + 17.4532
+    assert convert_time_stamps_to_secs('093417.4532') == 9 * 3600 + 34 * 60 + 17.4532
+    assert convert_time_stamps_to_secs(163417.4532) == 16 * 3600 + 34 * 60 + 17.4532
@@ -0,0 +1,29 @@
+import os
+import h5py
+import numpy as np
+from benchmarks.bench_vr_concatenation import FR, make_synthetic_sweep, legacy_transform
+from roibaview.ventral_root import convert_ventral_root_sweeps
+
+
+def test_sweeps_are_written_to_hdf5(tmp_path):
+    base_dir = tmp_path / 'vr_data'
+    sweeps = {sw: make_synthetic_sweep(str(base_dir / sw), n_files=3, secs_per_file=1, seed=k)
+              for k, sw in enumerate(['sweep_01', 'sweep_02'])}
+    save_dir = str(base_dir)
+
+    sweep_files, failed = convert_ventral_root_sweeps(str(base_dir), save_dir, vr_fr=FR, n_jobs=1)
+    assert failed == []
+    assert sorted(sweep_files) == sorted(sweeps)
+    for sw, vr_files in sweeps.items():
+        # The results are file names of the hdf5 sweeps, not arrays
+        assert sweep_files[sw].endswith(f'{sw}_ventral_root.h5')
+        with h5py.File(sweep_files[sw], 'r') as f:
+            np.testing.assert_array_equal(f['global_data_sets'][sw][:, 0], legacy_transform(vr_files, FR))
+    # Nothing is pickled (the old "all_ventral_root.pickle" of the in-memory results)
+    assert not any(f.endswith('.pickle') for f in os.listdir(save_dir))
+    with h5py.File(f'{save_dir}/ventral_root_sweeps.h5', 'r') as f:
+        assert sorted(f['global_data_sets']) == sorted(sweeps)
+
+    # Second run: nothing changed, nothing is converted again
+    sweep_files_again, _ = convert_ventral_root_sweeps(str(base_dir), save_dir, vr_fr=FR, n_jobs=1)
+    assert sweep_files_again == sweep_files
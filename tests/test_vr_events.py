@@ -0,0 +1,127 @@
+import numpy as np
+import pytest
+from roibaview.peak_tables import find_vr_event_edges, merge_vr_events
+from roibaview.ventral_root import StreamingVentralRootDetector, vr_envelope
+
+VR_PARAMETERS = {
+    'threshold': 5,
+    'vr_cutoff': 5,
+    'movingaverage_window': 2,
+    'duration_th_secs': 5,
+    'minimal_event_distance': 4,
+}
+
+
+def legacy_merge(binary, time_axis, duration_th_secs, minimal_event_distance):
+    # The per event loop VentralRootDetection.find_vr_events used before (returns the merged onset and offset times)
+    onsets_offsets = np.diff(binary, append=0)
+    onset_times = time_axis[np.where(onsets_offsets > 0)[0]]
+    offset_times = time_axis[np.where(onsets_offsets < 0)[0]]
+    event_duration = offset_times - onset_times
+    idx_remove = event_duration > duration_th_secs
+    onset_times = onset_times[np.invert(idx_remove)]
+    offset_times = offset_times[np.invert(idx_remove)]
+
+    events = sorted(zip(onset_times, offset_times), key=lambda x: x[0])
+    merged_onset_times = []
+    merged_offset_times = []
+    current_onset_time, current_offset_time = events[0]
+    for onset_time, offset_time in events[1:]:
+        if onset_time - current_offset_time <= minimal_event_distance:
+            current_offset_time = max(current_offset_time, offset_time)
+        else:
+            merged_onset_times.append(current_onset_time)
+            merged_offset_times.append(current_offset_time)
+            current_onset_time, current_offset_time = onset_time, offset_time
+    merged_onset_times.append(current_onset_time)
+    merged_offset_times.append(current_offset_time)
+    return np.array(merged_onset_times), np.array(merged_offset_times)
+
+
+def in_memory_vr_events(data, fr, parameters):
+    # Same steps as VentralRootDetection.find_vr_events (without the dialog)
+    th = np.std(data) * parameters['threshold']
+    env = vr_envelope(data, rate=fr, freq=parameters['vr_cutoff'])
+    window = int(parameters['movingaverage_window'])
+    env_fil = np.convolve(env, np.ones(window) / window, mode='same')
+    env_vr_z = (env_fil - np.mean(env_fil)) / np.std(env_fil)
+    onset_idx, offset_idx = find_vr_event_edges(env_vr_z > th)
+    time_axis = np.linspace(0, data.shape[0] / fr, data.shape[0])
+    return merge_vr_events(
+        onset_idx, offset_idx, time_axis[1] - time_axis[0],
+        duration_th_secs=parameters['duration_th_secs'],
+        minimal_event_distance=parameters['minimal_event_distance']
+    )
+
+
+def test_empty_input():
+    onset_idx, offset_idx = find_vr_event_edges(np.zeros(0))
+    assert onset_idx.shape == (0,) and offset_idx.shape == (0,)
+    onset_idx, offset_idx = find_vr_event_edges(np.zeros(100))
+    assert onset_idx.shape == (0,) and offset_idx.shape == (0,)
+    onset_idx, offset_idx = merge_vr_events(onset_idx, offset_idx, 0.1, 5, 4)
+    assert onset_idx.shape == (0,) and offset_idx.shape == (0,)
+
+
+def test_single_event():
+    binary = np.zeros(100)
+    binary[20:30] = 1
+    onset_idx, offset_idx = find_vr_event_edges(binary)
+    np.testing.assert_array_equal(onset_idx, [19])
+    np.testing.assert_array_equal(offset_idx, [29])
+    merged = merge_vr_events(onset_idx, offset_idx, 0.1, 5, 4)
+    np.testing.assert_array_equal(merged[0], [19])
+    np.testing.assert_array_equal(merged[1], [29])
+
+
+@pytest.mark.parametrize('active', [slice(0, 10), slice(90, 100), slice(0, 100)])
+def test_active_at_borders(active):
+    binary = np.zeros(100)
+    binary[40:50] = 1
+    binary[active] = 1
+    onset_idx, offset_idx = find_vr_event_edges(binary)
+    assert onset_idx.shape == offset_idx.shape
+    assert np.all(offset_idx >= onset_idx)
+    if active.start == 0:
+        assert onset_idx[0] == 0
+    if active.stop == 100:
+        assert offset_idx[-1] == 99
+
+
+def test_same_result_as_legacy_loop():
+    fr = 100
+    binary = np.zeros(60 * fr)
+    # Events (onset, duration in secs): short and long ones, some close to each other, not active at the borders
+    events = [(1, 0.5), (2, 0.3), (2.5, 2), (8, 7), (16, 0.1), (16.2, 0.1), (20, 3), (25.5, 1.5), (30, 12), (43, 0.8),
+              (44, 0.05), (50, 4.5), (56, 0.2)]
+    for onset, duration in events:
+        binary[int(onset * fr):int((onset + duration) * fr)] = 1
+    time_axis = np.linspace(0, binary.shape[0] / fr, binary.shape[0])
+    dt = time_axis[1] - time_axis[0]
+
+    for duration_th_secs, minimal_event_distance in [(5, 4), (2, 0.5), (100, 0), (1, 10)]:
+        onset_idx, offset_idx = find_vr_event_edges(binary)
+        onset_idx, offset_idx = merge_vr_events(onset_idx, offset_idx, dt, duration_th_secs, minimal_event_distance)
+        legacy_onset_times, legacy_offset_times = legacy_merge(
+            binary, time_axis, duration_th_secs, minimal_event_distance)
+        np.testing.assert_allclose(time_axis[onset_idx], legacy_onset_times)
+        np.testing.assert_allclose(time_axis[offset_idx], legacy_offset_times)
+
+
+def test_streaming_detector_matches_in_memory():
+    rng = np.random.default_rng(1)
+    fr = 1000
+    t = np.arange(120 * fr) / fr
+    data = rng.normal(0, 0.1, t.shape[0])
+    # Bursts of activity: single events, two events that are merged, one event that is too long
+    for start, end in [(5, 6), (15, 16), (25, 26), (35, 36), (60, 61), (61.5, 62.5), (80, 88), (100, 101)]:
+        burst = (t >= start) & (t < end)
+        data[burst] += np.sin(2 * np.pi * 100 * t[burst])
+
+    onset_idx, offset_idx = in_memory_vr_events(data, fr, VR_PARAMETERS)
+    assert onset_idx.shape[0] > 0
+    # Small blocks, so that many events are close to a block border
+    vr_events = StreamingVentralRootDetector.from_array(data, fr, VR_PARAMETERS, block_size=2**13).detect()
+    assert vr_events['onset_idx'].shape == onset_idx.shape
+    np.testing.assert_allclose(vr_events['onset_idx'], onset_idx, atol=2)
+    np.testing.assert_allclose(vr_events['offset_idx'], offset_idx, atol=2)